@@ -0,0 +1,507 @@
+__author__ = "Andrew Garcia <angarcia@marketo.com>"
+
+import asyncio
+import base64
+import functools
+import json
+import logging
+import time
+
+from marketo_wrapper import MIN_TOKEN_REFRESH_INTERVAL, MarketoWrapper, RateLimiter, RetryPolicy
+
+# aiohttp is only needed by this module, so the rest of the package works without it.
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+############################################################################################
+#                                                                                          #
+#                                 Request Builder                                          #
+#                                                                                          #
+############################################################################################
+
+class _Request(tuple):
+    """
+    This class holds the arguments of one API call, as built by _RequestBuilder. A few
+    MarketoWrapper methods return part of the response rather than all of it, such as
+    response["nextPageToken"]. Looking a key up on the request records it instead, so that
+    the asyncio client can look the same key up once it has the response.
+
+    Attributes:
+        keys (tuple):       The keys to look up on the response, in order.
+        download (bool):    Whether the call returns a file. If so, the request holds the call
+                            and the path to save the file to, instead of the usual arguments.
+    """
+
+    keys = ()
+    download = False
+
+    def __getitem__(self, index):
+        if not isinstance(index, str):
+            return tuple.__getitem__(self, index)
+        request = _Request(self)
+        request.keys = self.keys + (index,)
+        return request
+
+class _RequestBuilder(MarketoWrapper):
+    """
+    This class lets the asyncio client reuse the URL and payload construction of every
+    MarketoWrapper call. It never touches the network: where a MarketoWrapper method would
+    send its request, this class hands the request back to the caller instead.
+    """
+
+    def __init__(self):
+        """
+        The MarketoWrapper constructor is skipped on purpose, since it requests a token.
+        """
+        pass
+
+    def _MarketoWrapper__generic_api_call(self, call, method, content_type=None, payload=None, headers=None,
+                                          idempotent=None, cache=None):
+        """
+        This method replaces MarketoWrapper.__generic_api_call.
+
+        Args:
+            Same as MarketoWrapper.__generic_api_call.
+
+        Returns:
+            _Request:   The arguments it was given, in order, except for cache. The asyncio client
+                        does not cache responses.
+        """
+        return _Request((call, method, content_type, payload, headers, idempotent))
+
+    def _MarketoWrapper__download(self, call, path=None):
+        """
+        This method replaces MarketoWrapper.__download.
+
+        Args:
+            Same as MarketoWrapper.__download.
+
+        Returns:
+            _Request:   The call and the path, marked as a download.
+        """
+        request = _Request((call, path))
+        request.download = True
+        return request
+
+# Every MarketoWrapper method that makes exactly one API call and returns the response, or part of it.
+# Each of them gets a coroutine with the same name and arguments on AsyncMarketoWrapper. Methods that
+# are not implemented yet, such as add_leads_to_list, are left out.
+_MIRRORED_CALLS = (
+    # Paging token
+    "get_paging_token",
+    # Leads
+    "get_lead_by_id", "get_multiple_leads_by_filter_type", "get_multiple_leads_by_list_id",
+    "get_multiple_leads_by_program_id", "create_update_leads", "associate_lead", "merge_lead",
+    "get_lead_partitions", "import_lead", "get_import_status", "get_import_failure_file",
+    "get_import_warning_file", "describe_lead", "get_lead_activity_types", "get_lead_activities",
+    "add_lead_activities", "get_lead_changes", "delete_lead", "get_deleted_leads",
+    "update_lead_partition",
+    # Lists
+    "get_list_by_id", "get_multiple_lists", "remove_leads_from_list", "is_member_of_list",
+    # Campaigns
+    "get_campaign_by_id", "get_multiple_campaigns", "schedule_campaign", "request_campaign",
+    # Opportunities
+    "describe_opportunity", "create_update_opportunities", "delete_opportunities", "get_opportunities",
+    "describe_opportunity_role", "create_update_opportunity_roles", "delete_opportunity_roles",
+    "get_oportunity_roles",
+    # Companies
+    "describe_company", "create_update_companies", "delete_companies", "get_companies",
+    # Sales people
+    "describe_sales_person", "create_update_sales_persons", "delete_sales_persons", "get_sales_persons",
+    # Custom objects
+    "list_custom_objects", "describe_custom_object", "create_update_custom_objects",
+    "delete_custom_objects", "get_custom_objects",
+    # Folders
+    "browse_folders", "get_folder_by_id", "get_folder_by_name", "create_folder", "delete_folder",
+    "update_folder",
+    # Tokens
+    "create_token", "get_tokens", "delete_tokens",
+    # Emails
+    "get_emails", "get_email_by_id", "get_email_content_by_id",
+    # Email templates
+    "get_email_templates", "get_email_template_by_id", "get_email_template_by_name",
+    "get_email_template_content_by_id", "update_email_template", "approve_email_template",
+    "unapprove_email_template", "delete_email_template", "discard_email_template_draft",
+    "clone_email_template",
+    # Programs
+    "create_program",
+    # Administrative
+    "get_daily_usage", "get_weekly_usage", "get_daily_errors",
+)
+
+############################################################################################
+#                                                                                          #
+#                                Class Definition                                          #
+#                                                                                          #
+############################################################################################
+
+class AsyncMarketoWrapper:
+    """
+    This class is the asyncio counterpart of MarketoWrapper. It has a coroutine for every
+    public API call of MarketoWrapper, with the same name, arguments and return value, and
+    it builds each request with the MarketoWrapper code so the two can never drift apart.
+    Requests go through an aiohttp session that keeps a bounded number of persistent
+    connections to the Marketo instance.
+
+    It should be closed when it is no longer needed, either with close() or by using it as
+    an async context manager:
+
+        async with AsyncMarketoWrapper(munchkin, client_id, client_secret) as marketo:
+            lead = await marketo.get_lead_by_id(5)
+
+    Attributes:
+        __endpoint (string):                The base URL of the REST API, ending in a slash.
+        __credentials (string):             The Authorization header of the identity endpoint, built from
+                                            the client ID and secret. It is only sent to that endpoint.
+        __max_connections (int):            The most connections the session keeps open.
+        __session (aiohttp.ClientSession):  The HTTP session. It is created on first use, since it
+                                            has to be created inside the running event loop.
+        __builder (_RequestBuilder):        Builds each request the same way MarketoWrapper does.
+        __token (string):                   The access token used to authenticate API calls.
+        __expire_time (float):              When the access token expires.
+        __refresh_time (float):             When to start fetching the next access token. After a failed
+                                            request, it is pushed back by MIN_TOKEN_REFRESH_INTERVAL.
+        __refresh_margin (float):           How many seconds before expiry a new token is requested.
+        __refresh_task (asyncio.Future):    The token request in flight, if there is one. Every
+                                            coroutine that needs a new token waits on this same task.
+        __rate_limiter (RateLimiter):       Books a slot in Marketo's rate limit window for every call.
+        __concurrent (asyncio.Semaphore):   Bounds the calls in flight to the rate limiter's
+                                            max_concurrent. It is created along with the session.
+        __retry_policy (RetryPolicy):       Decides which calls that fail inside a 200 response are retried.
+    """
+
+############################################################################################
+#                                                                                          #
+#                                   Constructor                                            #
+#                                                                                          #
+############################################################################################
+
+    def __init__(self, munchkin_id, client_id, client_secret, max_connections=10, token_refresh_margin=60,
+                 rate_limiter=None, retry_policy=None, endpoint=None):
+        """
+        Unlike MarketoWrapper, the constructor does not request a token, since it cannot
+        wait on the network. The first API call does. It needs aiohttp to be installed.
+
+        Args:
+            munchkin_id (string):                   The munchkin ID of the Marketo instance.
+            client_id (string):                     The client ID of the appropriate API user.
+            client_secret (string):                 The client secret of the appropriate API user.
+            max_connections (int, optional):        The most persistent connections to keep open to
+                                                    the Marketo instance.
+            token_refresh_margin (float, optional): How many seconds before the access token expires
+                                                    to request a new one.
+            rate_limiter (RateLimiter, optional):   The limiter to pace API calls with. It can be shared
+                                                    with MarketoWrapper objects that talk to the same
+                                                    Marketo instance, although the concurrent call limit
+                                                    is then enforced separately on each side.
+            retry_policy (RetryPolicy, optional):   Decides which failed calls are retried and how long
+                                                    to back off. If omitted, the default policy is used.
+            endpoint (string, optional):            The base URL of the REST API, such as a proxy in front
+                                                    of it. It defaults to https://<munchkin_id>.mktorest.com/.
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncMarketoWrapper requires aiohttp. Install it with: pip install aiohttp")
+        if endpoint is None:
+            endpoint = "https://"+munchkin_id+".mktorest.com/"
+        self.__endpoint = endpoint.rstrip("/")+"/"
+        self.__credentials = "Basic "+base64.b64encode((client_id+":"+client_secret).encode("utf-8")).decode("ascii")
+        self.__max_connections = max_connections
+        self.__session = None
+        self.__builder = _RequestBuilder()
+        self.__token = None
+        self.__expire_time = 0
+        self.__refresh_time = 0
+        self.__refresh_margin = token_refresh_margin
+        self.__refresh_task = None
+        if rate_limiter is None:
+            rate_limiter = RateLimiter()
+        self.__rate_limiter = rate_limiter
+        self.__concurrent = None
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.__retry_policy = retry_policy
+
+    async def close(self):
+        """
+        This method closes the HTTP session and its connections.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+############################################################################################
+#                                                                                          #
+#                                   Private Methods                                        #
+#                                                                                          #
+############################################################################################
+
+    def __get_session(self):
+        """
+        This method returns the HTTP session, creating it the first time it is needed.
+
+        Args:
+            None
+
+        Returns:
+            aiohttp.ClientSession:  The HTTP session.
+        """
+        if self.__session is None:
+            connector = aiohttp.TCPConnector(limit=self.__max_connections)
+            self.__session = aiohttp.ClientSession(connector=connector)
+            self.__concurrent = asyncio.Semaphore(self.__rate_limiter.max_concurrent)
+        return self.__session
+
+    async def __get_token(self):
+        """
+        This method returns a valid access token. Once the token is inside the refresh
+        margin, a new one is requested in the background while callers keep using the
+        current one. Callers only wait when the token has actually expired, and then they
+        all wait on the same identity call. If a background request fails, the next one is
+        not made for MIN_TOKEN_REFRESH_INTERVAL seconds, or until the token expires.
+
+        Args:
+            None
+
+        Returns:
+            string: The access token.
+        """
+        now = time.time()
+        if self.__refresh_time > now:
+            return self.__token
+        if self.__refresh_task is None:
+            self.__refresh_task = asyncio.ensure_future(self.__generate_access_token())
+            self.__refresh_task.add_done_callback(self.__log_refresh_failure)
+        if self.__expire_time > now:
+            return self.__token
+        # Shield the shared task so that one cancelled caller does not cancel it for the rest.
+        return await asyncio.shield(self.__refresh_task)
+
+    async def __generate_access_token(self):
+        """
+        This method requests a new access token from the REST API identity endpoint.
+
+        Args:
+            None
+
+        Returns:
+            string: The access token given by the server.
+        """
+        try:
+            url = self.__endpoint+"identity/oauth/token?grant_type=client_credentials"
+            async with self.__get_session().get(url, headers={"Authorization": self.__credentials}) as response:
+                if response.status != 200:
+                    raise Exception(str(response.status)+"\n"+response.reason)
+                content = json.loads((await response.read()).decode("utf-8"))
+            expire_time = time.time() + content["expires_in"]
+            # Marketo hands back the same token until it expires, so there is no point in
+            # asking again before then.
+            if content["access_token"] == self.__token:
+                self.__refresh_time = expire_time
+            else:
+                self.__refresh_time = expire_time - self.__refresh_margin
+            self.__token = content["access_token"]
+            self.__expire_time = expire_time
+            return self.__token
+        except Exception:
+            # Otherwise every call inside the refresh margin would start another identity call.
+            self.__refresh_time = min(self.__expire_time, time.time() + MIN_TOKEN_REFRESH_INTERVAL)
+            raise
+        finally:
+            self.__refresh_task = None
+
+    def __log_refresh_failure(self, task):
+        """
+        This method logs a failed background token request, since no caller may be
+        waiting on it to see the exception.
+
+        Args:
+            task (asyncio.Future):  The finished token request.
+
+        Returns:
+            None
+        """
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Access token refresh failed: "+str(task.exception()))
+
+    async def __generic_api_call(self, call, method, content_type=None, payload=None, headers=None,
+                                 idempotent=None):
+        """
+        This method executes a generic API call to the REST API endpoint. It is the
+        counterpart of MarketoWrapper.__generic_api_call, and retries failed calls
+        in the same way.
+
+        Args:
+            call (string):                    The actual API call to make. This method contains the endpoint itself,
+                                              but the desired call must be given from outside.
+            method (string):                  The HTTP method to use (GET, POST, PUT etc.).
+            content_type (string, optional):  What to set as the Content-type HTTP header.
+            payload (optional):               Any payload that should be sent to the server. It can be a string,
+                                              or a file-like object such as a MultipartFile, which is streamed
+                                              and closed once the call is done.
+            headers (dict, optional):         Any custom headers to send. The access token is added automatically.
+            idempotent (bool, optional):      Whether the call can safely be made twice. By default, only calls that
+                                              read data (GET, or POST with _method=GET) are.
+
+        Returns:
+            dict: A dictionary representing the JSON response from the Marketo server.
+        """
+        try:
+            return await self.__send(call, method, content_type, payload, headers, idempotent)
+        finally:
+            if hasattr(payload, "close"):
+                payload.close()
+
+    async def __send(self, call, method, content_type, payload, headers, idempotent):
+        """
+        This method sends an API call, and sends it again for as long as the retry policy
+        says so.
+
+        Args:
+            Same as __generic_api_call().
+
+        Returns:
+            dict: The JSON response of the last attempt.
+        """
+        if content_type is None:
+            content_type = "application/json"
+        if headers is None:
+            headers = {}
+        if idempotent is None:
+            idempotent = method == "GET" or "_method=GET" in call
+        headers["Content-type"] = content_type
+        url = self.__endpoint+call
+        session = self.__get_session()
+        attempt = 0
+        while True:
+            attempt += 1
+            token = await self.__get_token()
+            headers["Authorization"] = "Bearer "+token
+            data = payload
+            if hasattr(payload, "read"):
+                # A file-like payload is read from the start on every attempt.
+                payload.seek(0)
+                data = self.__read_blocks(payload)
+            async with self.__concurrent:
+                await asyncio.sleep(self.__rate_limiter.reserve())
+                async with session.request(method, url, data=data, headers=headers) as response:
+                    if response.status != 200:
+                        raise Exception(str(response.status)+"\n"+response.reason)
+                    content = json.loads((await response.read()).decode("utf-8"))
+
+            error = self.__retry_policy.classify(content)
+            delay = self.__retry_policy.delay(error, attempt, idempotent)
+            if delay is None:
+                return content
+            logging.warning("Retrying "+method+" "+call.split("?")[0]+" after "+json.dumps(content.get("errors"))+
+                            " (attempt "+str(attempt)+")")
+            if error == RetryPolicy.TOKEN and token == self.__token:
+                self.__refresh_time = self.__expire_time = 0
+            await asyncio.sleep(delay)
+
+    async def __read_blocks(self, body):
+        """
+        This method hands a file-like request body to aiohttp a block at a time. The blocks
+        come from a local file and are small, so reading them does not hold up the event loop
+        for long.
+
+        Args:
+            body:   The file-like request body.
+
+        Returns:
+            async generator:    The body, as bytes, one block at a time.
+        """
+        while True:
+            block = body.read(65536)
+            if not block:
+                return
+            yield block
+
+    async def __download(self, call, path=None):
+        """
+        This method is the counterpart of MarketoWrapper.__download. It gets the body of a
+        call that returns a file, and retries the errors that Marketo reports as JSON in place
+        of the file in the same way as __generic_api_call().
+
+        Args:
+            call (string):              The API call to make.
+            path (string, optional):    Where to write the file. It is replaced if it already exists.
+
+        Returns:
+            int or bytes:   The number of bytes written if a path was given, or else the contents of the file.
+        """
+        url = self.__endpoint+call
+        session = self.__get_session()
+        attempt = 0
+        while True:
+            attempt += 1
+            token = await self.__get_token()
+            headers = {"Authorization": "Bearer "+token}
+            async with self.__concurrent:
+                await asyncio.sleep(self.__rate_limiter.reserve())
+                async with session.get(url, headers=headers) as response:
+                    if response.status != 200:
+                        raise Exception(str(response.status)+"\n"+response.reason)
+                    if not response.headers.get("Content-Type", "").startswith("application/json"):
+                        if path is None:
+                            return await response.read()
+                        written = 0
+                        with open(path, "wb") as output:
+                            async for block in response.content.iter_chunked(65536):
+                                output.write(block)
+                                written += len(block)
+                        return written
+                    content = json.loads((await response.read()).decode("utf-8"))
+
+            error = self.__retry_policy.classify(content)
+            delay = self.__retry_policy.delay(error, attempt, True)
+            if delay is None:
+                raise Exception(json.dumps(content.get("errors")))
+            logging.warning("Retrying GET "+call+" after "+json.dumps(content.get("errors"))+
+                            " (attempt "+str(attempt)+")")
+            if error == RetryPolicy.TOKEN and token == self.__token:
+                self.__refresh_time = self.__expire_time = 0
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def __mirror(name):
+        """
+        This method creates the coroutine for one of the calls in _MIRRORED_CALLS.
+
+        Args:
+            name (string):  The name of the MarketoWrapper method.
+
+        Returns:
+            function:   A coroutine function with the same name, arguments and docstring.
+        """
+        build = getattr(MarketoWrapper, name)
+
+        @functools.wraps(build)
+        async def api_call(self, *args, **kwargs):
+            request = build(self.__builder, *args, **kwargs)
+            # Calls that have not been implemented yet build nothing.
+            if request is None:
+                return None
+            if request.download:
+                return await self.__download(*request)
+            response = await self.__generic_api_call(*request)
+            for key in request.keys:
+                response = response[key]
+            return response
+        return api_call
+
+for _name in _MIRRORED_CALLS:
+    setattr(AsyncMarketoWrapper, _name, AsyncMarketoWrapper._AsyncMarketoWrapper__mirror(_name))
@@ -0,0 +1,156 @@
+__author__ = "Andrew Garcia <angarcia@marketo.com>"
+
+import argparse
+import collections
+import csv
+import json
+import logging
+import time
+
+from marketo_wrapper import MarketoWrapper
+
+############################################################################################
+#                                                                                          #
+#                                     Readers                                              #
+#                                                                                          #
+############################################################################################
+
+def read_ndjson(path):
+    """
+    This method reads a file with one JSON object per line, one line at a time, so the
+    file is never held in memory. Blank lines are skipped.
+
+    Args:
+        path (string):  The path of the file.
+
+    Returns:
+        generator:  A dictionary for each line.
+    """
+    with open(path) as records:
+        for line in records:
+            if line.strip():
+                yield json.loads(line)
+
+def read_csv(path):
+    """
+    This method reads a CSV file with a header row, one row at a time. A CSV file cannot
+    tell an empty value from a missing one, so empty cells are left out of the record
+    rather than blanking the field in Marketo.
+
+    Args:
+        path (string):  The path of the file.
+
+    Returns:
+        generator:  A dictionary for each row, keyed by the column names in the header.
+    """
+    with open(path, newline="") as records:
+        for row in csv.DictReader(records):
+            yield {field: value for field, value in row.items() if value != ""}
+
+READERS = {"ndjson": read_ndjson, "csv": read_csv}
+
+############################################################################################
+#                                                                                          #
+#                                     Uploader                                             #
+#                                                                                          #
+############################################################################################
+
+def upload(marketo, records, kind="leads", interval=10, **options):
+    """
+    This method feeds records into the bulk helper for their kind, and logs the progress
+    and throughput as it goes. The records are only read as fast as they are sent, so
+    memory use stays the same however many there are.
+
+    Args:
+        marketo (MarketoWrapper):   The wrapper to send the records with.
+        records (iterable):         The records to send, usually from read_ndjson() or read_csv().
+        kind (string, optional):    What the records are: "leads", "activities", "opportunities",
+                                    "companies" or "custom_objects".
+        interval (float, optional): How many seconds apart to log the progress.
+        options:                    Any other arguments of the bulk helper, such as lookup_field,
+                                    partition, dead_letter or, for custom objects, name.
+
+    Returns:
+        collections.Counter:    How many records ended up with each status.
+    """
+    if kind == "leads":
+        results = marketo.bulk_create_update_leads(records, **options)
+    elif kind == "activities":
+        results = marketo.bulk_add_lead_activities(records, **options)
+    elif kind == "opportunities":
+        results = marketo.bulk_create_update_opportunities(records, **options)
+    elif kind == "companies":
+        results = marketo.bulk_create_update_companies(records, **options)
+    elif kind == "custom_objects":
+        results = marketo.bulk_create_update_custom_objects(options.pop("name"), records, **options)
+    else:
+        raise Exception("Unknown record kind: "+str(kind))
+
+    statuses = collections.Counter()
+    start = last_report = time.time()
+    for _, result in results:
+        statuses[result.get("status")] += 1
+        if time.time() - last_report >= interval:
+            last_report = time.time()
+            _report(statuses, last_report - start)
+    _report(statuses, time.time() - start)
+    return statuses
+
+def _report(statuses, elapsed):
+    """
+    This method logs how many records have been sent so far, and how fast.
+
+    Args:
+        statuses (collections.Counter): How many records ended up with each status.
+        elapsed (float):                How many seconds the upload has been running.
+
+    Returns:
+        None
+    """
+    total = sum(statuses.values())
+    rate = total / elapsed if elapsed > 0 else 0
+    logging.info("Uploaded "+str(total)+" records in "+str(round(elapsed, 1))+" seconds ("+
+                 str(round(rate, 1))+" per second): "+json.dumps(dict(statuses)))
+
+############################################################################################
+#                                                                                          #
+#                                        Main                                              #
+#                                                                                          #
+############################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream an NDJSON or CSV file into Marketo.")
+    parser.add_argument("path", help="the file to upload")
+    parser.add_argument("--format", choices=sorted(READERS),
+                        help="the file format, guessed from the extension if omitted")
+    parser.add_argument("--kind", default="leads",
+                        choices=["leads", "activities", "opportunities", "companies", "custom_objects"])
+    parser.add_argument("--name", help="the API name of the custom object")
+    parser.add_argument("--action", help="createOnly, updateOnly, createOrUpdate or createDuplicate")
+    parser.add_argument("--lookup-field", help="the field leads are matched on")
+    parser.add_argument("--partition", help="the lead partition")
+    parser.add_argument("--dedupe-by", help="dedupeFields or idField")
+    parser.add_argument("--workers", type=int, help="the most requests to have in flight at once")
+    parser.add_argument("--dead-letter", help="a file to append records that failed for good to")
+    parser.add_argument("--interval", type=float, default=10, help="seconds between progress reports")
+    args = parser.parse_args()
+    if args.kind == "custom_objects" and not args.name:
+        parser.error("--name is required with --kind custom_objects")
+
+    import settings
+
+    logging.basicConfig(level=logging.INFO)
+    file_format = args.format or ("csv" if args.path.lower().endswith(".csv") else "ndjson")
+    options = {"workers": args.workers, "dead_letter": args.dead_letter}
+    if args.kind == "leads":
+        options.update(action=args.action, lookup_field=args.lookup_field, partition=args.partition)
+    elif args.kind == "custom_objects":
+        options.update(name=args.name, action=args.action, dedupe_by=args.dedupe_by)
+    elif args.kind != "activities":
+        options.update(action=args.action, dedupe_by=args.dedupe_by)
+
+    marketo = MarketoWrapper(settings.MUNCHKIN, settings.CLIENT_ID, settings.CLIENT_SECRET)
+    try:
+        print(json.dumps(dict(upload(marketo, READERS[file_format](args.path), args.kind, args.interval, **options))))
+    finally:
+        marketo.close()
@@ -1,6 +1,7 @@
 import json
 import datetime
 import csv
+import os
 from statistics import mean
 
 #def map_ids(activity):
@@ -140,14 +141,13 @@ def add_partition(lead):
 #with open("Trello/Carter/update100k.json", "w") as out_leads:
 #    out_leads.write("\n".join(list(map(json.dumps, leads))))
 
-with open("Trello/leads-100.json") as data:
-    results = data.readlines()
-    results = list(map(json.loads, results))
-    
-    for result in results:
+# Stream the results through a temporary file, so the input is never held in memory.
+with open("Trello/leads-100.json") as data, open("Trello/leads-100.json.tmp", "w") as out_data:
+    for index, line in enumerate(data):
+        result = json.loads(line)
         result["mean_time"] = mean(result["execution_times"])
+        out_data.write(("\n" if index else "")+json.dumps(result))
     
-with open("Trello/leads-100.json", "w") as out_data:
-    out_data.write("\n".join(list(map(json.dumps, results))))
+os.replace("Trello/leads-100.json.tmp", "Trello/leads-100.json")
     
     
\ No newline at end of file
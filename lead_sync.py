@@ -0,0 +1,178 @@
+__author__ = "Andrew Garcia <angarcia@marketo.com>"
+
+import datetime
+import heapq
+import logging
+import threading
+
+############################################################################################
+#                                                                                          #
+#                                Class Definition                                          #
+#                                                                                          #
+############################################################################################
+
+class LeadSync:
+    """
+    This class keeps an outside copy of the Marketo lead database up to date by pulling
+    only what changed. Each poll reads the lead changes and deleted leads since the last
+    one, and hands them to a sink in the order they happened, as events like these:
+
+        {"type": "upsert", "leadId": 5, "activityDate": "2016-01-01T00:00:00Z", "id": 123,
+         "fields": {"email": "new@example.com"}}
+        {"type": "delete", "leadId": 6, "activityDate": "2016-01-01T00:00:01Z", "id": 124}
+
+    The watermark is the paging token of each of the two streams, kept in a checkpoint
+    store. A page is only committed once the sink has taken every event in it, so if the
+    sink raises or the process dies, the next poll starts over from the first page that
+    was not fully handled. The sink should therefore be able to see an event twice.
+
+    Attributes:
+        __marketo (MarketoWrapper):             Makes the API calls.
+        __fields (list):                        The lead fields to watch for changes.
+        __sink (callable):                      Takes each event.
+        __checkpoints (FileCheckpointStore):    Keeps the watermark.
+        __job (string):                         The name the watermark is kept under. The two streams
+                                                are stored as job+":changes" and job+":deleted".
+        __since (string):                       Where to start if there is no watermark yet.
+        __batch_size (int):                     The number of changes to request per page.
+        __list_id (int):                        The id of a list of leads to limit the sync to.
+    """
+
+############################################################################################
+#                                                                                          #
+#                                   Constructor                                            #
+#                                                                                          #
+############################################################################################
+
+    def __init__(self, marketo, fields, sink, checkpoints, job="lead_sync", since=None, batch_size=None,
+                 list_id=None):
+        """
+        Args:
+            marketo (MarketoWrapper):               The wrapper to make API calls with.
+            fields (list):                          The lead fields to watch for changes.
+            sink (callable):                        Takes each event, as a dictionary.
+            checkpoints (FileCheckpointStore):      Where to keep the watermark between polls and runs.
+            job (string, optional):                 The name to keep the watermark under. It must be unique
+                                                    among the jobs that share the checkpoint store.
+            since (string, optional):               The date and time to start from the first time the job
+                                                    runs, such as "2016-01-01T00:00:00Z". It defaults to now.
+            batch_size (int, optional):             The number of changes to request per page. Default and
+                                                    max is 300.
+            list_id (int, optional):                The id of a list of leads to limit the sync to. Deleted
+                                                    leads are no longer on any list, so they are not limited.
+        """
+        if since is None:
+            since = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        self.__marketo = marketo
+        self.__fields = fields
+        self.__sink = sink
+        self.__checkpoints = checkpoints
+        self.__job = job
+        self.__since = since
+        self.__batch_size = batch_size
+        self.__list_id = list_id
+
+############################################################################################
+#                                                                                          #
+#                                   Private Methods                                        #
+#                                                                                          #
+############################################################################################
+
+    def __start_token(self, job):
+        """
+        This method returns the paging token to start a stream from when it has no
+        watermark yet. If it does, the wrapper resumes from the watermark instead, so no
+        token is requested.
+
+        Args:
+            job (string):   The name the stream's watermark is kept under.
+
+        Returns:
+            string: The paging token for the start date, or None if there is a watermark.
+        """
+        if self.__checkpoints.load(job) is not None:
+            return None
+        return self.__marketo.get_paging_token(self.__since)
+
+    def __upserts(self):
+        """
+        This method reads the lead changes since the watermark.
+
+        Args:
+            None
+
+        Returns:
+            generator:  An upsert event for each change, oldest first.
+        """
+        job = self.__job+":changes"
+        changes = self.__marketo.iter_lead_changes(self.__start_token(job), self.__fields, self.__batch_size,
+                                                   self.__list_id, checkpoints=self.__checkpoints, job=job)
+        for change in changes:
+            yield {"type": "upsert", "leadId": change["leadId"], "activityDate": change["activityDate"],
+                   "id": change["id"],
+                   "fields": {field["name"]: field.get("newValue") for field in change.get("fields", [])}}
+
+    def __deletes(self):
+        """
+        This method reads the deleted leads since the watermark.
+
+        Args:
+            None
+
+        Returns:
+            generator:  A delete event for each deleted lead, oldest first.
+        """
+        job = self.__job+":deleted"
+        deleted = self.__marketo.iter_deleted_leads(self.__start_token(job), self.__batch_size,
+                                                    checkpoints=self.__checkpoints, job=job)
+        for lead in deleted:
+            yield {"type": "delete", "leadId": lead["leadId"], "activityDate": lead["activityDate"],
+                   "id": lead["id"]}
+
+############################################################################################
+#                                                                                          #
+#                                    Public Methods                                        #
+#                                                                                          #
+############################################################################################
+
+    def poll(self):
+        """
+        This method hands every change since the watermark to the sink, and moves the
+        watermark forward as it goes. The two streams are merged by date, and then by
+        activity id, so a lead that is changed and then deleted is never brought back.
+
+        Args:
+            None
+
+        Returns:
+            int:    The number of events handed to the sink.
+        """
+        count = 0
+        events = heapq.merge(self.__upserts(), self.__deletes(),
+                             key=lambda event: (event["activityDate"], event["id"]))
+        for event in events:
+            self.__sink(event)
+            count += 1
+        return count
+
+    def run(self, interval=300, stop=None):
+        """
+        This method polls on a schedule until it is told to stop. A poll that fails is
+        logged and tried again at the next interval, from the last watermark.
+
+        Args:
+            interval (float, optional):         How many seconds to wait between polls.
+            stop (threading.Event, optional):   Ends the loop once it is set. If omitted, the
+                                                loop never ends.
+
+        Returns:
+            None
+        """
+        if stop is None:
+            stop = threading.Event()
+        while not stop.is_set():
+            try:
+                logging.info("Lead sync "+self.__job+" handled "+str(self.poll())+" events")
+            except Exception as e:
+                logging.error("Lead sync "+self.__job+" failed: "+str(e))
+            stop.wait(interval)
@@ -1,16 +1,32 @@
 __author__ = "Andrew Garcia <angarcia@marketo.com>"
 
 import time
-import httplib2
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import datetime
+import dbm
+import fcntl
+import hashlib
+import http.client
+import itertools
 import json
 import logging
-import settings
+import os
+import queue
+import random
+import re
+import tempfile
+import threading
 import time
+import urllib.parse
+import zoneinfo
 from statistics import mean
 
 # TODO
 
-# Figure out how to fix the POST calls that take multipart files
 # Do more elegant error handling and document the exceptions
 # Be more consistent with folder_id vs. folder
 # Double check all the call URLs
@@ -21,7 +37,6 @@ from statistics import mean
 
 # Incomplete calls
 
-# import_lead
 # create_token
 
 ############################################################################################
@@ -64,6 +79,1835 @@ def convert_to_ms(seconds):
     """
     return 1000*float(seconds)
 
+# Marketo rejects request bodies over 1 MB. Some room is left for the rest of the payload,
+# such as the action and lookup field, around the records themselves.
+MAX_BATCH_SIZE = 300
+MAX_BATCH_BYTES = 1000000 - 1024
+
+def batch_records(records, size=MAX_BATCH_SIZE, max_bytes=MAX_BATCH_BYTES):
+    """
+    This method splits any iterable of records into lists that a bulk API call accepts:
+    no more than the given number of records, and no more than the given number of bytes
+    once serialized. Each batch is filled as far as both limits allow. Records are read
+    lazily, so only one batch is held in memory at a time.
+    
+    Args:
+        records (iterable): The records to split, such as leads or activities.
+        size (int):         The most records per batch. Marketo accepts at most 300.
+        max_bytes (int):    The most bytes the records of a batch can take up in the JSON payload.
+                            A record that is larger on its own is sent alone, and left for the
+                            server to reject.
+    
+    Returns:
+        generator:  A list for each batch, in order.
+    """
+    for batch, _ in coalesce_records(records, None, size, max_bytes):
+        yield batch
+
+def coalesce_records(records, key, size=MAX_BATCH_SIZE, max_bytes=MAX_BATCH_BYTES, window=10*MAX_BATCH_SIZE):
+    """
+    This method splits records into batches like batch_records(), but merges the records
+    of a batch that share a key into one, so each key is only sent once per batch. Fields
+    of later records win over those of earlier ones. The records themselves are not changed.
+    
+    Args:
+        records (iterable): The records to split.
+        key (callable):     Takes a record and returns its key, or None if it should never be merged.
+                            If key itself is None, nothing is merged.
+        size (int):         The most records per batch, once merged.
+        max_bytes (int):    The most bytes the records of a batch can take up, once merged.
+        window (int):       The most original records a batch can take in. This bounds how long
+                            records wait, and how many are held, when most of them are merged.
+    
+    Returns:
+        generator:  A tuple for each batch, of the list of merged records to send and a list
+                    of each original record paired with the index of its merged record.
+    """
+    batch, sizes, originals, slots, batch_bytes = [], [], [], {}, 0
+    for record in records:
+        if len(originals) == window:
+            yield batch, originals
+            batch, sizes, originals, slots, batch_bytes = [], [], [], {}, 0
+        record_key = None if key is None else key(record)
+        if record_key is not None and record_key in slots:
+            index = slots[record_key]
+            merged = dict(batch[index])
+            merged.update(record)
+            merged_bytes = len(json.dumps(merged)) + 2
+            if batch_bytes - sizes[index] + merged_bytes <= max_bytes:
+                batch_bytes += merged_bytes - sizes[index]
+                batch[index], sizes[index] = merged, merged_bytes
+                originals.append((record, index))
+                continue
+            # The merged record no longer fits, so the key starts over in the next batch.
+            yield batch, originals
+            batch, sizes, originals, slots, batch_bytes = [], [], [], {}, 0
+        # The separator between records takes up two more bytes.
+        record_bytes = len(json.dumps(record)) + 2
+        if batch and (len(batch) == size or batch_bytes + record_bytes > max_bytes):
+            yield batch, originals
+            batch, sizes, originals, slots, batch_bytes = [], [], [], {}, 0
+        if record_key is not None:
+            slots[record_key] = len(batch)
+        originals.append((record, len(batch)))
+        batch.append(record)
+        sizes.append(record_bytes)
+        batch_bytes += record_bytes
+    if batch:
+        yield batch, originals
+
+def field_key(fields):
+    """
+    This method makes a key function for coalesce_records() out of one or more fields.
+    Records that are missing any of the fields are never merged.
+    
+    Args:
+        fields (string or list):    The name of the field, or the names of the fields, that
+                                    identify a record.
+    
+    Returns:
+        callable:   Takes a record and returns a tuple of its values for the fields, or None.
+    """
+    if isinstance(fields, str):
+        fields = [fields]
+    
+    def key(record):
+        values = tuple(record.get(field) for field in fields)
+        return None if None in values else values
+    return key
+
+############################################################################################
+#                                                                                          #
+#                                 Connection Pool                                          #
+#                                                                                          #
+############################################################################################
+
+class RequestNotSentError(ConnectionError):
+    """
+    This exception is raised by HttpConnectionPool when a request failed before all of it
+    was written to the server, so the server cannot have acted on it.
+    """
+    pass
+
+class HttpConnectionPool:
+    """
+    This class keeps a bounded set of persistent HTTPS connections for each host that it
+    talks to. Every request checks a connection out of the pool, uses it, and puts it back
+    so the next request can skip the TCP and TLS handshakes. The pool is safe to share
+    between threads, and between several MarketoWrapper objects.
+
+    Attributes:
+        __max_connections (int):    The most connections that will be open to a single host.
+        __timeout (float):          The socket timeout, in seconds, of each connection.
+        __lock (threading.Lock):    Guards the idle connections and the per host semaphores.
+        __idle (dict):              Maps each host to a list of open connections that are not in use.
+        __slots (dict):             Maps each host to a semaphore that bounds how many connections
+                                    can be in use at once.
+    """
+
+    def __init__(self, max_connections=10, timeout=60):
+        """
+        Args:
+            max_connections (int, optional):    The most connections to keep open to each host. Marketo
+                                                only allows 10 concurrent calls per instance, so there
+                                                is nothing to gain from going above that.
+            timeout (float, optional):          The socket timeout, in seconds, of each connection.
+        """
+        self.__max_connections = max_connections
+        self.__timeout = timeout
+        self.__lock = threading.Lock()
+        self.__idle = {}
+        self.__slots = {}
+
+    def request(self, url, method="GET", body=None, headers=None):
+        """
+        This method sends a request and reads the whole response body.
+
+        Args:
+            url (string):               The absolute URL to request.
+            method (string, optional):  The HTTP method to use (GET, POST, PUT etc.).
+            body (optional):            The request body. It can be a string, bytes, or a file-like object.
+            headers (dict, optional):   Any headers to send with the request.
+
+        Returns:
+            tuple:  The http.client.HTTPResponse and the response body as bytes.
+        """
+        with self.stream(url, method, body=body, headers=headers) as response:
+            return response, response.read()
+
+    @contextlib.contextmanager
+    def stream(self, url, method="GET", body=None, headers=None):
+        """
+        This method sends a request and hands back the response without reading it, so that
+        large bodies can be read in pieces. It is meant to be used in a with statement. The
+        connection goes back into the pool when the with block exits.
+
+        Args:
+            url (string):               The absolute URL to request.
+            method (string, optional):  The HTTP method to use (GET, POST, PUT etc.).
+            body (optional):            The request body. It can be a string, bytes, or a file-like object.
+            headers (dict, optional):   Any headers to send with the request.
+
+        Returns:
+            http.client.HTTPResponse:   The response from the server.
+        """
+        parts = urllib.parse.urlsplit(url)
+        host = parts.netloc
+        path = parts.path
+        if parts.query:
+            path += "?"+parts.query
+        if headers is None:
+            headers = {}
+
+        with self.__host_slots(host):
+            connection, response = self.__send(host, path, method, body, headers)
+            try:
+                yield response
+                # Anything left unread has to be drained before the connection can be reused.
+                response.read()
+            except BaseException:
+                connection.close()
+                raise
+            with self.__lock:
+                self.__idle[host].append(connection)
+
+    def close(self):
+        """
+        This method closes every idle connection in the pool. Connections that are in use
+        are left alone.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        with self.__lock:
+            for connections in self.__idle.values():
+                while connections:
+                    connections.pop().close()
+
+    def __host_slots(self, host):
+        """
+        This method returns the semaphore that bounds the connections to the given host,
+        creating it the first time the host is seen.
+
+        Args:
+            host (string):  The host (and port, if any) of the request.
+
+        Returns:
+            threading.BoundedSemaphore: The semaphore for the host.
+        """
+        with self.__lock:
+            if host not in self.__slots:
+                self.__slots[host] = threading.BoundedSemaphore(self.__max_connections)
+                self.__idle[host] = []
+            return self.__slots[host]
+
+    def __send(self, host, path, method, body, headers):
+        """
+        This method sends the request on an idle connection if there is one, or on a new
+        connection otherwise. Servers are free to close keep-alive connections that have been
+        idle too long, so if a reused connection turns out to be dead the request is sent once
+        more on a new connection. A file-like body is rewound first, and if it has no seek()
+        method the error is raised instead. Any other error while the request is being written
+        is raised as RequestNotSentError.
+
+        Args:
+            host (string):      The host (and port, if any) of the request.
+            path (string):      The path and query string of the request.
+            method (string):    The HTTP method to use.
+            body:               The request body.
+            headers (dict):     The request headers.
+
+        Returns:
+            tuple:  The connection that was used and the http.client.HTTPResponse.
+        """
+        with self.__lock:
+            idle = self.__idle[host]
+            connection = idle.pop() if idle else None
+
+        if connection is not None:
+            try:
+                self.__write(connection, method, path, body, headers)
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                # A file-like body has already been read, so it can only be sent again if it
+                # can be rewound.
+                if hasattr(body, "read"):
+                    if not hasattr(body, "seek"):
+                        raise
+                    body.seek(0)
+            except BaseException:
+                connection.close()
+                raise
+
+        connection = http.client.HTTPSConnection(host, timeout=self.__timeout)
+        try:
+            try:
+                self.__write(connection, method, path, body, headers)
+            except (ConnectionResetError, BrokenPipeError) as e:
+                raise RequestNotSentError(str(e)) from e
+            return connection, connection.getresponse()
+        except BaseException:
+            connection.close()
+            raise
+
+    def __write(self, connection, method, path, body, headers):
+        """
+        This method writes the request to the connection. The server cannot act on a request
+        it did not get all of, so errors are raised as RequestNotSentError, except for those
+        that a stale connection raises, which __send() handles itself.
+
+        Args:
+            connection (http.client.HTTPSConnection):   The connection to write to.
+            method (string):                            The HTTP method to use.
+            path (string):                              The path and query string of the request.
+            body:                                       The request body.
+            headers (dict):                             The request headers.
+
+        Returns:
+            None
+        """
+        try:
+            connection.request(method, path, body=body, headers=headers)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            raise
+        except OSError as e:
+            raise RequestNotSentError(str(e)) from e
+
+############################################################################################
+#                                                                                          #
+#                                  Access Tokens                                           #
+#                                                                                          #
+############################################################################################
+
+# The shortest time, in seconds, between background token refreshes.
+MIN_TOKEN_REFRESH_INTERVAL = 5
+
+class AccessTokenManager:
+    """
+    This class hands out access tokens to any number of threads and keeps them fresh. A
+    background timer requests a new token a configurable margin before the current one
+    expires, so callers normally get a valid token without waiting. If a caller does find
+    the token expired, it requests a new one under a lock, and every other caller that
+    arrives in the meantime waits for that same request instead of making its own.
+
+    Note:
+        Marketo hands back the same token until it expires. When a refresh returns a token
+        that is already inside the margin, the next refresh is scheduled for the moment
+        that token runs out, but never sooner than MIN_TOKEN_REFRESH_INTERVAL seconds.
+
+    Attributes:
+        __fetch_token (callable):   Requests a new token from the identity endpoint. It takes no
+                                    arguments and returns the token and the seconds until it expires.
+        __refresh_margin (float):   How many seconds before expiry the background refresh runs.
+        __lock (threading.Lock):    Held while a token is being requested.
+        __current (tuple):          The current token and the time it expires. They are kept in one
+                                    tuple so that both can be read without taking the lock.
+        __timer (threading.Timer):  The pending background refresh.
+        __closed (bool):            Set by close() so that no more refreshes are scheduled.
+    """
+
+    def __init__(self, fetch_token, refresh_margin=60):
+        """
+        Args:
+            fetch_token (callable):             Requests a new token. It takes no arguments and returns
+                                                a tuple of the token and the seconds until it expires.
+            refresh_margin (float, optional):   How many seconds before expiry to refresh the token.
+        """
+        self.__fetch_token = fetch_token
+        self.__refresh_margin = refresh_margin
+        self.__lock = threading.Lock()
+        self.__current = (None, 0)
+        self.__timer = None
+        self.__closed = False
+
+    def get_token(self):
+        """
+        This method returns a valid access token. It only blocks when there is no valid
+        token, which in steady state means never.
+
+        Args:
+            None
+
+        Returns:
+            string: The access token.
+        """
+        token, expire_time = self.__current
+        if expire_time > time.time():
+            return token
+        with self.__lock:
+            # Another thread may have refreshed the token while this one was waiting.
+            token, expire_time = self.__current
+            if expire_time > time.time():
+                return token
+            return self.__refresh()
+
+    def invalidate(self, token):
+        """
+        This method marks the given token as expired, for example when the server rejects
+        it. It does nothing if the token has already been replaced.
+
+        Args:
+            token (string): The token that was rejected.
+
+        Returns:
+            None
+        """
+        with self.__lock:
+            if self.__current[0] == token:
+                self.__current = (token, 0)
+
+    def close(self):
+        """
+        This method cancels the background refresh. Tokens are still refreshed on demand
+        if get_token() is called afterwards.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        with self.__lock:
+            self.__closed = True
+            if self.__timer is not None:
+                self.__timer.cancel()
+
+    def __refresh(self):
+        """
+        This method requests a new token and schedules the next background refresh. The
+        lock must be held by the caller.
+
+        Args:
+            None
+
+        Returns:
+            string: The new access token.
+        """
+        token, expires_in = self.__fetch_token()
+        self.__current = (token, time.time() + expires_in)
+        if expires_in > self.__refresh_margin:
+            delay = expires_in - self.__refresh_margin
+        else:
+            delay = expires_in
+        # A token that is about to expire would otherwise have the timer call the identity
+        # endpoint over and over until it does.
+        self.__schedule_refresh(max(delay, MIN_TOKEN_REFRESH_INTERVAL))
+        return token
+
+    def __schedule_refresh(self, delay):
+        """
+        This method schedules the background refresh. The lock must be held by the caller.
+
+        Args:
+            delay (float):  The seconds to wait before refreshing.
+
+        Returns:
+            None
+        """
+        if self.__closed:
+            return
+        if self.__timer is not None:
+            self.__timer.cancel()
+        self.__timer = threading.Timer(delay, self.__refresh_in_background)
+        self.__timer.daemon = True
+        self.__timer.start()
+
+    def __refresh_in_background(self):
+        """
+        This method is run by the background timer. If the identity call fails, it is tried
+        again later, but never sooner than MIN_TOKEN_REFRESH_INTERVAL seconds, and callers
+        keep using the current token until it expires.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        with self.__lock:
+            if self.__closed:
+                return
+            try:
+                self.__refresh()
+            except Exception:
+                logging.exception("Background access token refresh failed")
+                remaining = self.__current[1] - time.time()
+                self.__schedule_refresh(min(30, max(remaining/2, MIN_TOKEN_REFRESH_INTERVAL)))
+
+class LockedJsonFile:
+    """
+    This class is a JSON file that several threads and processes can read and update
+    safely. Every access happens while holding an exclusive lock on a companion ".lock"
+    file, and the file is replaced as a whole, so readers never see a half written file.
+    FileTokenStore and FileCheckpointStore keep their data in one.
+
+        store = LockedJsonFile(path)
+        with store.locked():
+            data = store.read()
+            data["key"] = "value"
+            store.write(data)
+
+    Attributes:
+        __path (string):        The path of the JSON file.
+        __lock_path (string):   The path of the file that is locked around every access.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (string):  The path of the file. It is created on the first write, and is only
+                            readable by its owner, since it may hold live credentials.
+        """
+        self.__path = path
+        self.__lock_path = path+".lock"
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        This method holds an exclusive lock on the lock file for the duration of a with
+        block. The lock is shared between threads and processes alike.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        descriptor = os.open(self.__lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(descriptor)
+
+    def read(self):
+        """
+        This method reads the file. A missing or unreadable file counts as empty. The lock
+        should be held by the caller.
+
+        Args:
+            None
+
+        Returns:
+            dict:   The contents of the file.
+        """
+        try:
+            with open(self.__path) as json_file:
+                return json.load(json_file)
+        except (IOError, ValueError):
+            return {}
+
+    def write(self, data):
+        """
+        This method replaces the file. The new contents are written and synced to a temporary
+        file first so that a crash never leaves a half written file behind. The lock must be
+        held by the caller.
+
+        Args:
+            data (dict):    The new contents of the file.
+
+        Returns:
+            None
+        """
+        temp_path = self.__path+".tmp"
+        descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, "w") as json_file:
+            json.dump(data, json_file)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        os.replace(temp_path, self.__path)
+
+class FileTokenStore:
+    """
+    This class keeps access tokens in a JSON file so that every process on a host can share
+    them. Tokens are keyed by munchkin ID and client ID. All reads and writes happen while
+    holding the file's lock, so when the stored token has expired only the first process to
+    notice requests a new one, and the rest pick it up from the file.
+
+    Attributes:
+        __file (LockedJsonFile):    The file that holds the tokens.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (string):  The path of the token file. It is created if it does not exist.
+                            Since it holds live credentials, it is only readable by its owner.
+        """
+        self.__file = LockedJsonFile(path)
+
+    def fetch(self, key, generate_token):
+        """
+        This method returns the stored token for the given key if it has not expired. If it
+        has, a new token is generated, stored and returned.
+
+        Args:
+            key (string):               Identifies the Marketo instance and API user.
+            generate_token (callable):  Requests a new token. It takes no arguments and returns
+                                        a tuple of the token and the seconds until it expires.
+
+        Returns:
+            tuple:  The access token and the number of seconds until it expires.
+        """
+        with self.__file.locked():
+            tokens = self.__file.read()
+            entry = tokens.get(key)
+            if entry is not None and entry["expire_time"] > time.time():
+                return entry["access_token"], entry["expire_time"] - time.time()
+            token, expires_in = generate_token()
+            tokens[key] = {"access_token": token, "expire_time": time.time() + expires_in}
+            self.__file.write(tokens)
+            return token, expires_in
+
+    def invalidate(self, key, token):
+        """
+        This method removes the given token from the store, for example when the server
+        rejects it. It does nothing if the stored token has already been replaced.
+
+        Args:
+            key (string):   Identifies the Marketo instance and API user.
+            token (string): The token that was rejected.
+
+        Returns:
+            None
+        """
+        with self.__file.locked():
+            tokens = self.__file.read()
+            if key in tokens and tokens[key]["access_token"] == token:
+                del tokens[key]
+                self.__file.write(tokens)
+
+############################################################################################
+#                                                                                          #
+#                                  Rate Limiting                                           #
+#                                                                                          #
+############################################################################################
+
+class RateLimiter:
+    """
+    This class paces API calls so that they stay under Marketo's limits, which are 100 calls
+    in any rolling 20 second window and 10 calls in flight at once for each instance. Each
+    call books the next free slot in the window and sleeps until that slot comes up, so
+    bulk jobs run as fast as the limits allow without tripping errors 606 and 615. One
+    limiter should be shared by every client that talks to the same Marketo instance.
+
+    Attributes:
+        __max_calls (int):                      The most calls allowed in any window.
+        __period (float):                       The length of the window in seconds.
+        __max_concurrent (int):                 The most calls allowed in flight at once.
+        __lock (threading.Lock):                Guards the booked slots.
+        __calls (collections.deque):            The start times of the calls booked in the current
+                                                window, oldest first. Some of them may be in the future.
+        __concurrent (threading.BoundedSemaphore):  Bounds the number of calls in flight.
+    """
+
+    def __init__(self, max_calls=100, period=20, max_concurrent=10):
+        """
+        Args:
+            max_calls (int, optional):      The most calls allowed in any window.
+            period (float, optional):       The length of the window in seconds.
+            max_concurrent (int, optional): The most calls allowed in flight at once.
+        """
+        self.__max_calls = max_calls
+        self.__period = period
+        self.__max_concurrent = max_concurrent
+        self.__lock = threading.Lock()
+        self.__calls = collections.deque()
+        self.__concurrent = threading.BoundedSemaphore(max_concurrent)
+
+    @property
+    def max_concurrent(self):
+        """
+        int: The most calls allowed in flight at once.
+        """
+        return self.__max_concurrent
+
+    @contextlib.contextmanager
+    def limit(self):
+        """
+        This method waits until a call may be made, and holds one of the concurrent call
+        slots until the with block it is used in exits.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        with self.__concurrent:
+            time.sleep(self.reserve())
+            yield
+
+    def reserve(self):
+        """
+        This method books the next free slot in the window. It does not wait, and it does
+        not count towards the concurrent calls, so that callers that cannot block (e.g. the
+        asyncio client) can do the waiting themselves.
+
+        Args:
+            None
+
+        Returns:
+            float:  The number of seconds to wait before making the call.
+        """
+        with self.__lock:
+            now = time.time()
+            while self.__calls and self.__calls[0] <= now - self.__period:
+                self.__calls.popleft()
+            start = now
+            if len(self.__calls) >= self.__max_calls:
+                # The window is full, so the call has to wait for the oldest call
+                # that would share its window to drop out.
+                start = max(now, self.__calls[-self.__max_calls] + self.__period)
+            self.__calls.append(start)
+            return start - now
+
+class AdaptiveConcurrencyLimiter:
+    """
+    This class finds out how many calls can be in flight at once without being throttled,
+    which changes through the day when other integrations share the instance's limits. It
+    works like TCP congestion control (AIMD). The limit grows by about one for every limit's
+    worth of healthy calls. It is halved when a call is throttled, or when a call takes much
+    longer than the usual latency, which is the first sign of a queue building up on the
+    server. It is used as a context manager around each unit of work.
+
+    Attributes:
+        __minimum (int):                    The lowest the limit can go.
+        __maximum (int):                    The highest the limit can go.
+        __latency_tolerance (float):        How many times the usual latency a call can take before it
+                                            counts as a sign of congestion.
+        __limit (float):                    The current limit. Only its integer part is enforced.
+        __in_flight (int):                  How many units of work are running.
+        __latencies (dict):                 Maps each kind of call to a list of two moving averages of its
+                                            latency. The baseline moves slowly, and the recent average
+                                            moves fast, so comparing them smooths over the odd slow call.
+                                            They are kept apart for each kind of call, since a describe
+                                            and a bulk write of 300 records take very different times.
+        __last_decrease (float):            When the limit was last cut. Signals from calls that were
+                                            already in flight at the time are ignored, so that one burst
+                                            of throttling only cuts the limit once.
+        __condition (threading.Condition):  Guards all of the above, and wakes up waiting callers.
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=10, latency_tolerance=2.0):
+        """
+        Args:
+            initial (int, optional):                The limit to start with.
+            minimum (int, optional):                The lowest the limit can go.
+            maximum (int, optional):                The highest the limit can go.
+            latency_tolerance (float, optional):    How many times the usual latency a call can take
+                                                    before the limit is cut.
+        """
+        self.__minimum = minimum
+        self.__maximum = maximum
+        self.__latency_tolerance = latency_tolerance
+        self.__limit = float(initial)
+        self.__in_flight = 0
+        self.__latencies = {}
+        self.__last_decrease = 0
+        self.__condition = threading.Condition()
+
+    @property
+    def limit(self):
+        """
+        int: The current number of units of work allowed in flight.
+        """
+        return int(self.__limit)
+
+    def __enter__(self):
+        with self.__condition:
+            while self.__in_flight >= int(self.__limit):
+                self.__condition.wait()
+            self.__in_flight += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.__condition:
+            self.__in_flight -= 1
+            self.__condition.notify()
+
+    def record(self, started, latency, throttled, kind=None):
+        """
+        This method adjusts the limit based on the outcome of one API call.
+
+        Args:
+            started (float):        When the call was sent, from time.time().
+            latency (float):        How many seconds the call took.
+            throttled (bool):       Whether the server throttled the call (error 606 or 615).
+            kind (string, optional):    What kind of call it was, such as its method and endpoint.
+                                        Its latency is only compared with calls of the same kind.
+
+        Returns:
+            None
+        """
+        with self.__condition:
+            latencies = self.__latencies.setdefault(kind, [latency, latency])
+            latencies[1] += 0.3*(latency - latencies[1])
+            if not throttled:
+                # Slow calls move the baseline too, so a kind of call that has become slower
+                # for good stops counting as congested after a while.
+                latencies[0] += 0.05*(latency - latencies[0])
+            if throttled or latencies[1] > self.__latency_tolerance*latencies[0]:
+                if started > self.__last_decrease:
+                    self.__limit = max(self.__minimum, self.__limit/2)
+                    self.__last_decrease = time.time()
+                    latencies[1] = latencies[0]
+                return
+            previous = int(self.__limit)
+            self.__limit = min(self.__maximum, self.__limit + 1/self.__limit)
+            if int(self.__limit) > previous:
+                self.__condition.notify_all()
+
+# Marketo documents the daily quota as resetting at 12:00 AM Central Time.
+QUOTA_RESET_TIMEZONE = "America/Chicago"
+
+class QuotaExceededError(Exception):
+    """
+    This exception is raised when a MarketoWrapper has used up the call budget it was given.
+    """
+    pass
+
+class QuotaGovernor:
+    """
+    This class keeps bulk work from using up the instance's daily API quota. It samples the
+    instance's usage with get_daily_usage() every so often, and adds the calls made locally
+    since then, so it has an estimate of the day's usage at all times without spending much
+    quota on the sampling itself. Calls from high priority clients always go through. Calls
+    from low priority clients are spread out over the rest of the day once usage passes the
+    slow down point, and wait for the quota to reset once it reaches the pause point, so
+    that the reserve is left for the work that matters most.
+
+    One governor should be shared by every client that talks to the same Marketo instance.
+
+    Attributes:
+        __daily_limit (int):        The number of calls the instance is allowed each day.
+        __slow_down_at (float):     The estimated usage at which low priority calls are paced.
+        __pause_at (float):         The estimated usage at which low priority calls wait for the reset.
+        __sample_interval (float):  How many seconds an usage sample is trusted for.
+        __lock (threading.Lock):    Guards the attributes below.
+        __sampled_usage (int):      The day's usage at the last sample.
+        __sampled_at (float):       When the last sample was taken.
+        __local_calls (int):        The calls made through the governor since the last sample. It
+                                    never goes past the daily limit, however long sampling keeps failing.
+        __resets_at (float):        When the quota next resets after the last sample that worked.
+        __sampling (int):           The ident of the thread that is taking a sample, or None.
+        __next_slot (float):        When the next paced low priority call may go.
+    """
+
+    def __init__(self, daily_limit=50000, slow_down=0.7, pause=0.9, sample_interval=300):
+        """
+        Args:
+            daily_limit (int, optional):        The number of calls the instance is allowed each day.
+            slow_down (float, optional):        The fraction of the daily limit at which low priority
+                                                calls start being paced.
+            pause (float, optional):            The fraction of the daily limit at which low priority
+                                                calls wait for the quota to reset. The rest is the
+                                                reserve for high priority clients.
+            sample_interval (float, optional):  How many seconds to wait between usage samples.
+        """
+        self.__daily_limit = daily_limit
+        self.__slow_down_at = slow_down*daily_limit
+        self.__pause_at = pause*daily_limit
+        self.__sample_interval = sample_interval
+        self.__lock = threading.Lock()
+        self.__sampled_usage = 0
+        self.__sampled_at = 0
+        self.__local_calls = 0
+        self.__resets_at = time.time() + self.__seconds_until_reset()
+        self.__sampling = None
+        self.__next_slot = 0
+
+    def estimated_usage(self):
+        """
+        This method returns the estimated number of calls made today across all API users.
+
+        Args:
+            None
+
+        Returns:
+            int:    The estimated usage.
+        """
+        with self.__lock:
+            return self.__sampled_usage + self.__local_calls
+
+    def admit(self, sample_usage, low_priority=False):
+        """
+        This method is called before every API call. It waits as long as the call's priority
+        requires, and then counts the call.
+
+        Args:
+            sample_usage (callable):        Returns the day's usage across all API users. It is only
+                                            called when the last sample is older than the interval.
+            low_priority (bool, optional):  Whether the call is part of work that can wait.
+
+        Returns:
+            None
+        """
+        with self.__lock:
+            # The sample is an API call in its own right, and comes back through here.
+            if self.__sampling == threading.get_ident():
+                return
+        self.__sample(sample_usage)
+        while True:
+            with self.__lock:
+                used = self.__sampled_usage + self.__local_calls
+                if not low_priority or used < self.__pause_at:
+                    self.__local_calls = min(self.__local_calls + 1, self.__daily_limit)
+                    delay = 0
+                    if low_priority and used >= self.__slow_down_at:
+                        # Spread what is left before the pause point over the rest of the day.
+                        now = time.time()
+                        spacing = self.__seconds_until_reset() / max(self.__pause_at - used, 1)
+                        start = max(now, self.__next_slot)
+                        self.__next_slot = start + spacing
+                        delay = start - now
+                    break
+            logging.warning("Daily API usage is estimated at "+str(used)+" of "+str(self.__daily_limit)+
+                            ", so low priority calls are paused")
+            time.sleep(min(self.__sample_interval, self.__seconds_until_reset()))
+            self.__sample(sample_usage, force=True)
+        time.sleep(delay)
+
+    def __sample(self, sample_usage, force=False):
+        """
+        This method takes a new usage sample if the last one is too old. Only one thread
+        samples at a time, and the others carry on with the current estimate.
+
+        Args:
+            sample_usage (callable):    Returns the day's usage across all API users.
+            force (bool, optional):     Sample even if the last sample is recent.
+
+        Returns:
+            None
+        """
+        with self.__lock:
+            if self.__sampling is not None:
+                return
+            if not force and time.time() - self.__sampled_at < self.__sample_interval:
+                return
+            self.__sampling = threading.get_ident()
+            local_calls = self.__local_calls
+        usage = None
+        try:
+            usage = sample_usage()
+        except Exception:
+            logging.exception("Sampling the daily API usage failed")
+        with self.__lock:
+            self.__sampling = None
+            self.__sampled_at = time.time()
+            if usage is not None:
+                self.__sampled_usage = usage
+                # Calls made while the sample was being taken may not be part of it.
+                self.__local_calls -= local_calls
+                self.__resets_at = time.time() + self.__seconds_until_reset()
+            elif time.time() >= self.__resets_at:
+                # The quota has reset since the last sample that worked, so yesterday's usage no
+                # longer counts, and low priority calls are not paused for the rest of the outage.
+                self.__sampled_usage = 0
+                self.__local_calls = 0
+                self.__next_slot = 0
+                self.__resets_at = time.time() + self.__seconds_until_reset()
+
+    def __seconds_until_reset(self):
+        """
+        This method works out how long it is until the daily quota resets, which happens at
+        midnight in QUOTA_RESET_TIMEZONE. Daylight saving time is taken into account.
+
+        Args:
+            None
+
+        Returns:
+            float:  The number of seconds until the reset.
+        """
+        zone = zoneinfo.ZoneInfo(QUOTA_RESET_TIMEZONE)
+        now = datetime.datetime.now(zone)
+        midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(), zone)
+        # Subtracting aware datetimes in the same zone ignores their offsets, so compare in UTC.
+        return (midnight.astimezone(datetime.timezone.utc) - now.astimezone(datetime.timezone.utc)).total_seconds()
+
+############################################################################################
+#                                                                                          #
+#                                   Retry Policy                                           #
+#                                                                                          #
+############################################################################################
+
+# Marketo reports these errors inside a 200 response whose "success" attribute is false.
+# The access token was invalid or has expired.
+TOKEN_ERRORS = ("601", "602")
+# Too many calls in the rolling window, or too many calls in flight at once.
+THROTTLE_ERRORS = ("606", "615")
+# Timeouts and temporary backend failures. The request may or may not have been processed.
+TRANSIENT_ERRORS = ("604", "608", "611", "713")
+# Reasons a single record of a bulk write can be skipped for that may go away on their own:
+# an import in progress, an object in use, or too many jobs in the queue. Throttled batches
+# are also included, since Marketo rejects them without processing any of their records.
+# The wrapper gives the records of a batch that never reached the server a reason with its
+# own code, and retries them in the same way, but only if the write is idempotent.
+NOT_SENT_ERROR = "not_sent"
+RETRYABLE_RECORD_ERRORS = ("1019", "1022", "1029", NOT_SENT_ERROR) + THROTTLE_ERRORS
+# The wrapper gives the records of any other batch whose call failed, for example after a 5xx
+# or a read timeout, a reason with this code. The server may have processed the batch, so
+# they are not retried.
+SEND_FAILED_ERROR = "send_failed"
+# The wrapper gives records that the server left out of a batch's results a reason with this
+# code. It is not retried, since the record may well have been processed.
+MISSING_RESULT_ERROR = "missing_result"
+# The wrapper gives a record that is waiting to be sent again a reason with this code, instead
+# of sending it, once a later record with the same key has been written. Sending it would
+# overwrite the newer value, so it is neither retried nor written to the dead-letter file.
+SUPERSEDED_ERROR = "superseded"
+
+class RetryPolicy:
+    """
+    This class decides which failed API calls are worth retrying and how long to wait
+    before each retry. Calls rejected for a bad token are retried right away with a new
+    token. Throttled calls were never processed, so they are always retried after a back
+    off. Calls that hit a transient error may have been processed, so they are only
+    retried when they are idempotent.
+
+    Attributes:
+        __max_attempts (int):   The most times a call is made, counting the first.
+        __base_delay (float):   The back off, in seconds, before the first retry. It doubles on every retry.
+        __max_delay (float):    The longest back off in seconds.
+    """
+
+    TOKEN = "token"
+    THROTTLE = "throttle"
+    TRANSIENT = "transient"
+
+    def __init__(self, max_attempts=5, base_delay=1, max_delay=30):
+        """
+        Args:
+            max_attempts (int, optional):   The most times a call is made, counting the first.
+            base_delay (float, optional):   The back off, in seconds, before the first retry.
+            max_delay (float, optional):    The longest back off in seconds.
+        """
+        self.__max_attempts = max_attempts
+        self.__base_delay = base_delay
+        self.__max_delay = max_delay
+
+    def classify(self, response):
+        """
+        This method finds out whether a response failed with an error that can be retried.
+
+        Args:
+            response (dict):    The JSON response from the Marketo server.
+
+        Returns:
+            string: RetryPolicy.TOKEN, RetryPolicy.THROTTLE or RetryPolicy.TRANSIENT, or None
+                    if the call succeeded or failed with an error that cannot be retried.
+        """
+        if not isinstance(response, dict) or response.get("success", True):
+            return None
+        codes = [str(error.get("code")) for error in response.get("errors", [])]
+        if any(code in TOKEN_ERRORS for code in codes):
+            return RetryPolicy.TOKEN
+        if any(code in THROTTLE_ERRORS for code in codes):
+            return RetryPolicy.THROTTLE
+        if any(code in TRANSIENT_ERRORS for code in codes):
+            return RetryPolicy.TRANSIENT
+        return None
+
+    def delay(self, error, attempt, idempotent):
+        """
+        This method decides whether a failed call should be made again.
+
+        Args:
+            error (string):     What classify() returned for the response.
+            attempt (int):      How many times the call has been made so far.
+            idempotent (bool):  Whether making the call twice has the same effect as making it once.
+
+        Returns:
+            float:  The number of seconds to wait before the next attempt, or None if the call
+                    should not be retried.
+        """
+        if error is None or attempt >= self.__max_attempts:
+            return None
+        if error == RetryPolicy.TOKEN:
+            return 0
+        if error == RetryPolicy.TRANSIENT and not idempotent:
+            return None
+        # Full jitter keeps a crowd of throttled callers from retrying in lockstep.
+        return random.uniform(0, min(self.__max_delay, self.__base_delay * 2**(attempt-1)))
+
+############################################################################################
+#                                                                                          #
+#                                Request Coalescing                                        #
+#                                                                                          #
+############################################################################################
+
+class SingleFlight:
+    """
+    This class lets concurrent callers that ask for the same thing share a single piece of
+    work. The first caller with a given key does the work, and callers that arrive with the
+    same key before it finishes wait for it and get a copy of the same result, or the same
+    exception. Once the work is done the key is forgotten, so nothing is cached.
+
+    Attributes:
+        __lock (threading.Lock):    Guards the work in flight.
+        __in_flight (dict):         Maps each key to a list of a concurrent.futures.Future for its
+                                    result and the number of callers waiting on it.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__in_flight = {}
+
+    def do(self, key, function):
+        """
+        This method runs the function, unless a call with the same key is already running,
+        in which case it waits for that call instead.
+
+        Args:
+            key (string):           Identifies the work. Calls with the same key must do the same work.
+            function (callable):    Does the work. It takes no arguments.
+
+        Returns:
+            The return value of the function. When the work was shared, every caller gets its own
+            deep copy, so callers are free to change what they get back.
+        """
+        with self.__lock:
+            entry = self.__in_flight.get(key)
+            leader = entry is None
+            if leader:
+                entry = [concurrent.futures.Future(), 0]
+                self.__in_flight[key] = entry
+            else:
+                entry[1] += 1
+        future = entry[0]
+        if not leader:
+            return copy.deepcopy(future.result())
+
+        try:
+            result = function()
+        except BaseException as error:
+            with self.__lock:
+                del self.__in_flight[key]
+            future.set_exception(error)
+            raise
+        with self.__lock:
+            del self.__in_flight[key]
+        future.set_result(result)
+        # The waiters copy the result in the future, so the caller that did the work has
+        # to take a copy too before it can change anything.
+        return copy.deepcopy(result) if entry[1] else result
+
+############################################################################################
+#                                                                                          #
+#                                  Response Cache                                          #
+#                                                                                          #
+############################################################################################
+
+# How many seconds the responses of the schema and metadata calls are cached for, by the
+# name of the MarketoWrapper method. These rarely change, and jobs tend to ask for them
+# every time they start.
+DEFAULT_CACHE_TTLS = {
+    "describe_lead": 3600,
+    "get_lead_activity_types": 3600,
+    "get_lead_partitions": 3600,
+    "list_custom_objects": 3600,
+    "describe_custom_object": 3600,
+    "describe_opportunity": 3600,
+    "describe_opportunity_role": 3600,
+    "describe_company": 3600,
+    "describe_sales_person": 3600,
+}
+
+class ResponseCache:
+    """
+    This class caches API responses, each for its own time to live. It keeps the most
+    recently used responses in memory, and if it is given a directory, it also keeps every
+    response on disk so that other processes and later runs can use them. The same cache
+    can be shared by several MarketoWrapper objects, since the keys include the munchkin ID
+    and the client ID.
+
+    Attributes:
+        __max_entries (int):                    The most responses kept in memory.
+        __directory (string):                   Where responses are kept on disk, or None.
+        __lock (threading.Lock):                Guards the in-memory entries.
+        __entries (collections.OrderedDict):    Maps each key to its expiry time and the response as
+                                                JSON, least recently used first.
+    """
+
+    def __init__(self, max_entries=256, directory=None):
+        """
+        Args:
+            max_entries (int, optional):    The most responses to keep in memory.
+            directory (string, optional):   A directory to keep responses in on disk. It is created
+                                            if it does not exist.
+        """
+        self.__max_entries = max_entries
+        self.__directory = directory
+        self.__lock = threading.Lock()
+        self.__entries = collections.OrderedDict()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        """
+        This method looks up a response.
+
+        Args:
+            key (string):   The key the response was stored under.
+
+        Returns:
+            dict:   A copy of the response, or None if there is no live response for the key.
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self.__entries.move_to_end(key)
+                    return json.loads(entry[1])
+                del self.__entries[key]
+        if self.__directory is None:
+            return None
+        try:
+            with open(self.__path(key)) as cache_file:
+                entry = json.load(cache_file)
+        except (IOError, ValueError):
+            return None
+        if entry["key"] != key or entry["expire_time"] <= time.time():
+            return None
+        self.__remember(key, entry["expire_time"], json.dumps(entry["response"]))
+        return entry["response"]
+
+    def set(self, key, response, ttl):
+        """
+        This method stores a response.
+
+        Args:
+            key (string):       The key to store the response under.
+            response (dict):    The response to store.
+            ttl (float):        How many seconds the response is good for.
+
+        Returns:
+            None
+        """
+        expire_time = time.time() + ttl
+        self.__remember(key, expire_time, json.dumps(response))
+        if self.__directory is not None:
+            # Each writer gets its own temporary file, since other processes may be storing
+            # the same key at the same time.
+            descriptor, temp_path = tempfile.mkstemp(".tmp", dir=self.__directory)
+            try:
+                with os.fdopen(descriptor, "w") as cache_file:
+                    json.dump({"key": key, "expire_time": expire_time, "response": response}, cache_file)
+                os.replace(temp_path, self.__path(key))
+            except BaseException:
+                os.remove(temp_path)
+                raise
+
+    def invalidate(self, prefix=""):
+        """
+        This method throws away every response whose key starts with the given prefix.
+
+        Args:
+            prefix (string, optional):  The start of the keys to throw away. By default, everything
+                                        is thrown away.
+
+        Returns:
+            None
+        """
+        with self.__lock:
+            for key in [key for key in self.__entries if key.startswith(prefix)]:
+                del self.__entries[key]
+        if self.__directory is None:
+            return
+        for name in os.listdir(self.__directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.__directory, name)
+            try:
+                with open(path) as cache_file:
+                    key = json.load(cache_file)["key"]
+                if key.startswith(prefix):
+                    os.remove(path)
+            except (IOError, ValueError, KeyError):
+                pass
+
+    def __remember(self, key, expire_time, serialized):
+        """
+        This method puts a response in memory, and drops the least recently used one if
+        there are too many.
+
+        Args:
+            key (string):           The key to store the response under.
+            expire_time (float):    When the response expires.
+            serialized (string):    The response as JSON. Responses are kept serialized so that
+                                    callers can never change the cached copy.
+
+        Returns:
+            None
+        """
+        with self.__lock:
+            self.__entries[key] = (expire_time, serialized)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+
+    def __path(self, key):
+        """
+        This method works out the file a response is kept in on disk.
+
+        Args:
+            key (string):   The key of the response.
+
+        Returns:
+            string: The path of the file.
+        """
+        return os.path.join(self.__directory, hashlib.sha1(key.encode("utf-8")).hexdigest()+".json")
+
+############################################################################################
+#                                                                                          #
+#                                    Checkpoints                                           #
+#                                                                                          #
+############################################################################################
+
+class FileCheckpointStore:
+    """
+    This class keeps the progress of long paged exports in a JSON file, so that an export
+    can pick up where it left off after the process dies. Each export is stored under a job
+    name, along with the paging token of the next page and the number of records so far.
+    Like FileTokenStore, every access happens while holding the file's lock, so several
+    processes can share one file for different jobs.
+
+    Attributes:
+        __file (LockedJsonFile):    The file that holds the checkpoints.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (string):  The path of the checkpoint file. It is created if it does not exist.
+        """
+        self.__file = LockedJsonFile(path)
+
+    def load(self, job):
+        """
+        This method returns the last checkpoint of a job.
+
+        Args:
+            job (string):   The name of the export.
+
+        Returns:
+            dict:   The "nextPageToken" to resume from and the "count" of records committed so
+                    far, or None if the job has no checkpoint.
+        """
+        with self.__file.locked():
+            return self.__file.read().get(job)
+
+    def save(self, job, paging_token, count):
+        """
+        This method records the progress of a job. It only returns once the checkpoint is
+        on disk.
+
+        Args:
+            job (string):           The name of the export.
+            paging_token (string):  The token of the first page that has not been committed.
+            count (int):            The number of records committed so far.
+
+        Returns:
+            None
+        """
+        with self.__file.locked():
+            checkpoints = self.__file.read()
+            checkpoints[job] = {"nextPageToken": paging_token, "count": count}
+            self.__file.write(checkpoints)
+
+    def clear(self, job):
+        """
+        This method removes the checkpoint of a job, so that it starts over next time.
+
+        Args:
+            job (string):   The name of the export.
+
+        Returns:
+            None
+        """
+        with self.__file.locked():
+            checkpoints = self.__file.read()
+            if job in checkpoints:
+                del checkpoints[job]
+                self.__file.write(checkpoints)
+
+############################################################################################
+#                                                                                          #
+#                                 Change Detection                                         #
+#                                                                                          #
+############################################################################################
+
+class FingerprintStore:
+    """
+    This class remembers what was last sent for each record, so that records that have
+    not changed since can be left out of the next upsert. It keeps a hash of each record
+    in a dbm database on disk, keyed by the field that identifies the record and its
+    value, so it can hold millions of records without loading them into memory. Anything
+    else that changes what sending a record does, such as the action and the partition
+    of an upsert, is part of the key too, so a record sent in another way is never taken
+    for unchanged.
+
+    Attributes:
+        __database (dbm object):    Maps each record key to the hash of the record last sent.
+        __lock (threading.Lock):    Guards the database, which is not safe to share between threads.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (string):  The path of the database. It is created if it does not exist.
+        """
+        self.__database = dbm.open(path, "c")
+        self.__lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def unchanged(self, field, record, scope=()):
+        """
+        This method checks whether a record is the same as when it was last sent.
+
+        Args:
+            field (string):             The field that identifies the record, such as the lookup field.
+            record (dict):              The record.
+            scope (tuple, optional):    How the record is sent, such as the action and partition.
+
+        Returns:
+            bool:   True if the record was sent before, in the same scope, with exactly the same
+                    fields and values.
+        """
+        key = self.__key(field, record, scope)
+        if key is None:
+            return False
+        with self.__lock:
+            stored = self.__database.get(key)
+        return stored is not None and stored.decode("utf-8") == self.__fingerprint(record)
+
+    def update(self, field, record, scope=()):
+        """
+        This method records that a record was sent successfully.
+
+        Args:
+            field (string):             The field that identifies the record, such as the lookup field.
+            record (dict):              The record.
+            scope (tuple, optional):    How the record was sent, such as the action and partition.
+
+        Returns:
+            None
+        """
+        key = self.__key(field, record, scope)
+        if key is not None:
+            with self.__lock:
+                self.__database[key] = self.__fingerprint(record)
+
+    def close(self):
+        """
+        This method closes the database, which writes out anything still in memory.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        with self.__lock:
+            self.__database.close()
+
+    def __key(self, field, record, scope):
+        """
+        This method returns the database key of a record.
+
+        Args:
+            field (string): The field that identifies the record.
+            record (dict):  The record.
+            scope (tuple):  How the record is sent.
+
+        Returns:
+            string: The field, its value and the scope, or None if the record does not have the field.
+        """
+        if record.get(field) is None:
+            return None
+        # JSON keeps the parts apart even if a value contains a separator.
+        return json.dumps([field, str(record[field])] + list(scope))
+
+    def __fingerprint(self, record):
+        """
+        This method hashes a record. Keys are sorted first, so the hash does not depend on
+        the order the fields were set in.
+
+        Args:
+            record (dict):  The record.
+
+        Returns:
+            string: The hex digest of the record.
+        """
+        return hashlib.sha1(json.dumps(record, sort_keys=True).encode("utf-8")).hexdigest()
+
+############################################################################################
+#                                                                                          #
+#                                Write-Behind Buffer                                       #
+#                                                                                          #
+############################################################################################
+
+class LeadWriteBuffer:
+    """
+    This class lets callers upsert leads one at a time without spending an API call on
+    each. Leads are held briefly and sent together with bulk_create_update_leads(), one
+    request for every group of leads that share an action, lookup field and partition.
+    A group is sent once it is full, or once its oldest lead has waited long enough.
+    Each caller gets a future that resolves to the result of its own lead:
+
+        buffer = LeadWriteBuffer(marketo, linger=2)
+        future = buffer.submit({"email": "someone@example.com"}, lookup_field="email")
+        future.result()["status"]
+
+    It is safe to use from many threads, and it should be closed when it is no longer
+    needed so that the last leads are sent.
+
+    Attributes:
+        __marketo (MarketoWrapper):             Sends the leads.
+        __max_records (int):                    The most leads in a group before it is sent.
+        __max_bytes (int):                      The most bytes the leads of a group can take up once serialized.
+        __linger (float):                       The most seconds a lead waits before its group is sent.
+        __groups (dict):                        Maps each (action, lookup field, partition) to the leads
+                                                waiting to be sent, their futures, their size, and when the
+                                                group is due.
+        __condition (threading.Condition):      Guards the groups, and wakes the linger thread.
+        __closed (bool):                        Whether close() has been called.
+        __executor (concurrent.futures.ThreadPoolExecutor): Sends the groups, so callers never wait on the network.
+        __linger_thread (threading.Thread):     Sends groups once they are due.
+    """
+
+    def __init__(self, marketo, max_records=MAX_BATCH_SIZE, max_bytes=MAX_BATCH_BYTES, linger=1.0, workers=2):
+        """
+        Args:
+            marketo (MarketoWrapper):       The wrapper to send the leads with.
+            max_records (int, optional):    The most leads to send in one request. Marketo accepts at most 300.
+            max_bytes (int, optional):      The most bytes the leads of one request can take up.
+            linger (float, optional):       The most seconds to hold a lead before sending it.
+            workers (int, optional):        The most requests to have in flight at once.
+        """
+        self.__marketo = marketo
+        self.__max_records = max_records
+        self.__max_bytes = max_bytes
+        self.__linger = linger
+        self.__groups = {}
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.__executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.__linger_thread = threading.Thread(target=self.__send_due, daemon=True)
+        self.__linger_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, lead, action=None, lookup_field=None, partition=None):
+        """
+        This method queues one lead to be upserted.
+
+        Args:
+            lead (dict):                        The lead and its attributes.
+            action (string, optional):          See create_update_leads().
+            lookup_field (string, optional):    See create_update_leads().
+            partition (string, optional):       See create_update_leads().
+
+        Returns:
+            concurrent.futures.Future:  Resolves to the result of the lead once its request is done,
+                                        or raises the exception that made the request fail.
+        """
+        future = concurrent.futures.Future()
+        # Count the separator between records, as batch_records() does.
+        lead_bytes = len(json.dumps(lead)) + 2
+        key = (action, lookup_field, partition)
+        with self.__condition:
+            if self.__closed:
+                raise Exception("The lead write buffer is closed")
+            group = self.__groups.get(key)
+            if group is not None and group["bytes"] + lead_bytes > self.__max_bytes:
+                self.__send(key)
+                group = None
+            if group is None:
+                group = {"leads": [], "futures": [], "bytes": 0, "due": time.time() + self.__linger}
+                self.__groups[key] = group
+                self.__condition.notify()
+            group["leads"].append(lead)
+            group["futures"].append(future)
+            group["bytes"] += lead_bytes
+            if len(group["leads"]) >= self.__max_records:
+                self.__send(key)
+        return future
+
+    def flush(self):
+        """
+        This method sends every waiting lead now, without waiting for the results.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        with self.__condition:
+            for key in list(self.__groups):
+                self.__send(key)
+
+    def close(self):
+        """
+        This method sends every waiting lead, and waits for all of the requests to finish.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        with self.__condition:
+            self.__closed = True
+            for key in list(self.__groups):
+                self.__send(key)
+            self.__condition.notify()
+        self.__linger_thread.join()
+        self.__executor.shutdown(wait=True)
+
+    def __send(self, key):
+        """
+        This method hands a group over to the executor. The condition must be held.
+
+        Args:
+            key (tuple):    The action, lookup field and partition of the group.
+
+        Returns:
+            None
+        """
+        group = self.__groups.pop(key)
+        self.__executor.submit(self.__write, key, group["leads"], group["futures"])
+
+    def __write(self, key, leads, futures):
+        """
+        This method upserts a group of leads and resolves the future of each one.
+
+        Args:
+            key (tuple):    The action, lookup field and partition of the group.
+            leads (list):   The leads of the group.
+            futures (list): The future of each lead, in the same order.
+
+        Returns:
+            None
+        """
+        action, lookup_field, partition = key
+        try:
+            results = self.__marketo.bulk_create_update_leads(leads, action, lookup_field, partition=partition,
+                                                              workers=1)
+            for future, (_, result) in zip(futures, results):
+                future.set_result(result)
+        except BaseException as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+
+    def __send_due(self):
+        """
+        This method runs on the linger thread. It sends each group once its oldest lead
+        has waited long enough, and sleeps until the next group is due.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        with self.__condition:
+            while not self.__closed:
+                now = time.time()
+                for key, group in list(self.__groups.items()):
+                    if group["due"] <= now:
+                        self.__send(key)
+                due = [group["due"] for group in self.__groups.values()]
+                self.__condition.wait(min(due) - now if due else None)
+
+############################################################################################
+#                                                                                          #
+#                                   Bulk Import                                            #
+#                                                                                          #
+############################################################################################
+
+# Marketo takes at most 10 MB per import file, and queues at most 10 imports at once.
+MAX_IMPORT_BYTES = 10*1024*1024
+MAX_CONCURRENT_IMPORTS = 10
+
+def split_import_file(path, max_bytes=MAX_IMPORT_BYTES):
+    """
+    This method works out how to split a delimited file into pieces that each fit in one
+    import. Pieces end at record boundaries, and each one leaves room for the header
+    record, which has to be sent at the top of every piece. A quoted field can hold line
+    breaks, so a line only ends a record once every quote opened on it or the lines before
+    it has been closed, as the csv module reads it. Quotes inside a quoted field are doubled,
+    which keeps the count even. The file is read one line at a time and nothing is written,
+    so this works on files of any size.
+    
+    Args:
+        path (string):      The path of the file. Its first record must be the header.
+        max_bytes (int):    The most bytes a piece can take up, header included. A record that
+                            is larger on its own is put in a piece by itself.
+    
+    Returns:
+        tuple:  The header record as bytes, and a list of the start and end offset of each piece
+                in the file, not counting the header.
+    """
+    def read_records(import_file):
+        lines, quotes = [], 0
+        for line in import_file:
+            lines.append(line)
+            quotes += line.count(b'"')
+            if quotes % 2 == 0:
+                yield b"".join(lines)
+                lines, quotes = [], 0
+        if lines:
+            yield b"".join(lines)
+    
+    with open(path, "rb") as import_file:
+        records = read_records(import_file)
+        header = next(records, b"")
+        pieces = []
+        start = offset = len(header)
+        for record in records:
+            if offset > start and len(header) + offset - start + len(record) > max_bytes:
+                pieces.append((start, offset))
+                start = offset
+            offset += len(record)
+        if offset > start:
+            pieces.append((start, offset))
+    return header, pieces
+
+class MultipartFile:
+    """
+    This class is a multipart/form-data request body that uploads part of a file without
+    reading it into memory. It reads like a binary file, so http.client sends it a block at
+    a time, and it can be rewound so that a call that is retried sends the whole body again.
+    The file is only opened while the body is being read, and reading it again after close()
+    opens it again, so the body can be built in one place and sent from another.
+
+    Attributes:
+        __head (bytes):     Everything before the file contents: the form fields, the headers of
+                            the file part, and the header line of the file if one was given.
+        __tail (bytes):     The closing boundary.
+        __path (string):    The path of the file being uploaded.
+        __file (file):      The file being uploaded, or None if it is not open.
+        __start (int):      Where the uploaded part of the file starts.
+        __end (int):        Where the uploaded part of the file ends.
+        __position (int):   How much of the body has been read.
+        __content_type (string):    The Content-type header, including the boundary.
+    """
+
+    def __init__(self, fields, path, start=0, end=None, header=b""):
+        """
+        Args:
+            fields (list):              A tuple of the name and value of each form field to send
+                                        before the file.
+            path (string):              The path of the file to upload.
+            start (int, optional):      Where in the file to start uploading from.
+            end (int, optional):        Where in the file to stop. It defaults to the end of the file.
+            header (bytes, optional):   Anything to send ahead of the file contents, such as a header
+                                        line that the uploaded part does not include.
+        """
+        boundary = "MarketoWrapper"+os.urandom(16).hex()
+        lines = []
+        for name, value in fields:
+            lines += ["--"+boundary, "Content-Disposition: form-data; name=\""+name+"\"", "", str(value)]
+        lines += ["--"+boundary,
+                  "Content-Disposition: form-data; name=\"file\"; filename=\""+os.path.basename(path)+"\"",
+                  "Content-Type: text/plain", "", ""]
+        self.__head = "\r\n".join(lines).encode("utf-8") + header
+        self.__tail = ("\r\n--"+boundary+"--\r\n").encode("utf-8")
+        self.__path = path
+        self.__file = None
+        self.__start = start
+        self.__end = os.path.getsize(path) if end is None else end
+        self.__position = 0
+        self.__content_type = "multipart/form-data; boundary="+boundary
+
+    @property
+    def content_type(self):
+        return self.__content_type
+
+    @property
+    def length(self):
+        return len(self.__head) + self.__end - self.__start + len(self.__tail)
+
+    def read(self, size=-1):
+        """
+        This method reads the next piece of the body.
+
+        Args:
+            size (int, optional):   The most bytes to read. If negative, the rest of the body is read.
+
+        Returns:
+            bytes:  The data, which is empty once the whole body has been read.
+        """
+        if size is None or size < 0:
+            size = self.length - self.__position
+        data = b""
+        body_start = len(self.__head)
+        body_end = body_start + self.__end - self.__start
+        while size > 0 and self.__position < self.length:
+            position = self.__position
+            if position < body_start:
+                chunk = self.__head[position:position+size]
+            elif position < body_end:
+                if self.__file is None:
+                    self.__file = open(self.__path, "rb")
+                self.__file.seek(self.__start + position - body_start)
+                chunk = self.__file.read(min(size, body_end - position))
+                if not chunk:
+                    raise Exception("The file being uploaded was truncated: "+self.__path)
+            else:
+                chunk = self.__tail[position-body_end:position-body_end+size]
+            data += chunk
+            self.__position += len(chunk)
+            size -= len(chunk)
+        return data
+
+    def seek(self, offset, whence=0):
+        """
+        This method moves to a position in the body. Only seeking from the start is supported,
+        which is all a retry needs.
+
+        Args:
+            offset (int):           The position to move to.
+            whence (int, optional): Must be 0.
+
+        Returns:
+            int:    The new position.
+        """
+        if whence != 0:
+            raise Exception("A multipart body can only be rewound from the start")
+        self.__position = offset
+        return offset
+
+    def close(self):
+        """
+        This method closes the file being uploaded.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
 ############################################################################################
 #                                                                                          #
 #                                Class Definition                                          # 
@@ -76,11 +1920,32 @@ class MarketoWrapper:
     in marketo_connector.py as the interface to a marketo instance.
     
     Attributes:
-        __token (string):       The access token to be used to authenticate
-                                API calls. 
-        __expire_time (float):  When the access token expires and needs to be regenerated.
-                                It is checked before every API call.
-        __http (httplib2.Http): The HTTP object the wraps all of the HTTP functionality required.
+        __tokens (AccessTokenManager):  Hands out the access token used to authenticate API calls,
+                                        and refreshes it in the background before it expires.
+        __token_store (FileTokenStore): Shares access tokens with other processes. It is None unless
+                                        one was given to the constructor.
+        __client_id (string):   The client ID of the API user. It is part of the token store key.
+        __rate_limiter (RateLimiter):   Paces every API call to stay under Marketo's rate limits.
+        __retry_policy (RetryPolicy):   Decides which calls that fail inside a 200 response are retried.
+        __concurrency (AdaptiveConcurrencyLimiter): Learns how many calls can be in flight from the
+                                                    latency and throttling of every call. Bulk helpers
+                                                    run with adaptive=True follow its limit.
+        __quota_governor (QuotaGovernor):   Paces calls to save the daily quota. It is None unless one
+                                            was given to the constructor.
+        __low_priority (bool):  Whether this wrapper's calls give way to others when the quota runs low.
+        __call_budget (int):    The most calls this wrapper may make, or None for no limit.
+        __calls_made (int):     The calls this wrapper has made so far.
+        __calls_lock (threading.Lock):  Guards __calls_made.
+        __response_cache (ResponseCache):   Caches the responses of the schema and metadata calls. It is
+                                            None unless one was given to the constructor.
+        __cache_ttls (dict):    How long each cached call's responses are kept, by method name.
+        __single_flight (SingleFlight): Lets identical GETs that are in flight at once share one round trip.
+        __import_slots (threading.BoundedSemaphore):    Bounds this wrapper's bulk imports that are queued
+                                                        or running to the 10 Marketo allows.
+        __http (HttpConnectionPool):    The pool of persistent connections that every request goes
+                                        through. It can be shared with other MarketoWrapper objects.
+        __credentials (string): The HTTP basic authorization header built from the client ID and
+                                secret. It is only sent to the identity endpoint.
         __munchkin (string):    The munchkin ID of the Marketo instance.
     """
 
@@ -90,28 +1955,96 @@ class MarketoWrapper:
 #                                                                                          #             
 ############################################################################################
 
-    def __init__(self, munchkin_id, client_id, client_secret):
+    def __init__(self, munchkin_id, client_id, client_secret, max_connections=10, pool=None,
+                 token_refresh_margin=60, token_store=None, rate_limiter=None, retry_policy=None,
+                 quota_governor=None, low_priority=False, call_budget=None, response_cache=None,
+                 cache_ttls=None, single_flight=None):
         """
         The constructor performs all initialization as well as generates
         the first access token. All API calls will double check to make 
         sure the token is still valid before executing.
         
         Args:
-            munchkin_id (string):    The munchkin ID of the Marketo instance.
-            client_id (string):      The client ID of the appropriate API user.
-            client_secret (string):  The client secret of the appropriate API user.
+            munchkin_id (string):               The munchkin ID of the Marketo instance.
+            client_id (string):                 The client ID of the appropriate API user.
+            client_secret (string):             The client secret of the appropriate API user.
+            max_connections (int, optional):    The most persistent connections to keep open to the
+                                                Marketo instance. It is ignored if pool is given.
+            pool (HttpConnectionPool, optional):    A connection pool to share with other wrappers.
+                                                    If omitted, the wrapper creates its own.
+            token_refresh_margin (float, optional): How many seconds before the access token expires
+                                                    to request a new one in the background.
+            token_store (FileTokenStore, optional): A store to share access tokens through, so that
+                                                    short lived processes do not each have to request
+                                                    their own token.
+            rate_limiter (RateLimiter, optional):   The limiter to pace API calls with. Clients that
+                                                    talk to the same Marketo instance should share one.
+                                                    If omitted, the wrapper creates its own.
+            retry_policy (RetryPolicy, optional):   Decides which failed calls are retried and how long
+                                                    to back off. If omitted, the default policy is used.
+            quota_governor (QuotaGovernor, optional):   Keeps track of the instance's daily usage. Clients
+                                                        that talk to the same instance should share one.
+            low_priority (bool, optional):  If true, and there is a quota governor, this wrapper's calls
+                                            slow down and then pause as the daily quota runs low. Bulk
+                                            jobs that can wait should use a low priority wrapper.
+            call_budget (int, optional):    The most calls this wrapper may make, retries included. Once
+                                            it is spent, every call raises QuotaExceededError.
+            response_cache (ResponseCache, optional):   A cache for the responses of the schema and metadata
+                                                        calls listed in DEFAULT_CACHE_TTLS.
+            cache_ttls (dict, optional):    Overrides the number of seconds the responses of each call are
+                                            cached for, by method name. A call can be added to the cache
+                                            only if it is already listed in DEFAULT_CACHE_TTLS.
+            single_flight (SingleFlight, optional): Coalesces identical GETs that are in flight at the
+                                                    same time. Wrappers can share one to coalesce calls
+                                                    across each other. If omitted, the wrapper creates
+                                                    its own.
         """
         self.__munchkin = munchkin_id
-        # The httplib2.Http constructor takes an optional directory argument
-        # where caching will be done. The directory does not need to exist beforehand.
-        self.__http = httplib2.Http()
-        # This will store credentials in __http so they do not need to be passed
-        # each time a token is requested.
-        self.__http.add_credentials(client_id, client_secret)
-        # This value will be overwritten by _getAccessToken, so it is just
-        # used for initialization
-        self.__expire_time = 0
-        self.__token = self.__generateAccessToken(self.__munchkin)
+        if pool is None:
+            pool = HttpConnectionPool(max_connections)
+        self.__http = pool
+        # The credentials are only needed by the identity endpoint, so the header
+        # is built once here instead of every time a token is requested.
+        self.__credentials = "Basic "+base64.b64encode((client_id+":"+client_secret).encode("utf-8")).decode("ascii")
+        self.__client_id = client_id
+        self.__token_store = token_store
+        self.__tokens = AccessTokenManager(self.__fetch_access_token, token_refresh_margin)
+        if rate_limiter is None:
+            rate_limiter = RateLimiter()
+        self.__rate_limiter = rate_limiter
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.__retry_policy = retry_policy
+        self.__concurrency = AdaptiveConcurrencyLimiter(maximum=rate_limiter.max_concurrent)
+        self.__quota_governor = quota_governor
+        self.__low_priority = low_priority
+        self.__call_budget = call_budget
+        self.__calls_made = 0
+        self.__calls_lock = threading.Lock()
+        self.__response_cache = response_cache
+        self.__cache_ttls = dict(DEFAULT_CACHE_TTLS)
+        if cache_ttls is not None:
+            self.__cache_ttls.update(cache_ttls)
+        if single_flight is None:
+            single_flight = SingleFlight()
+        self.__single_flight = single_flight
+        self.__import_slots = threading.BoundedSemaphore(MAX_CONCURRENT_IMPORTS)
+        # Request the first token right away so that bad credentials fail here.
+        self.__tokens.get_token()
+
+    def close(self):
+        """
+        This method stops the background token refresh and closes the idle connections.
+        The wrapper should not be used afterwards.
+        
+        Args:
+            None
+            
+        Returns:
+            None
+        """
+        self.__tokens.close()
+        self.__http.close()
 
 ############################################################################################
 #                                                                                          #
@@ -124,33 +2057,71 @@ class MarketoWrapper:
         This method requests a new access token from the REST API identity endpoint.
         
         Note:
-            The client ID and secret required to generate the token were added to the 
-            __http attribute in the class constructor, so if the server requires authentication
-            (it does), the httplib2 module does the credential handling automatically.
+            The client ID and secret required to generate the token were encoded into the
+            __credentials attribute in the class constructor, and they are sent as HTTP basic
+            authentication.
         
         Args:
             None
             
         Returns:
-            string: The access token given by the server.
+            tuple:  The access token given by the server and the number of seconds until it expires.
         """
         # Request the token
         response, content = self.__http.request("https://"+self.__munchkin+
                                                ".mktorest.com/identity/"+
-                                               "oauth/token?grant_type=client_credentials")
+                                               "oauth/token?grant_type=client_credentials",
+                                               headers={"Authorization": self.__credentials})
         # If the request was successful, return the token.
         if (response.status == 200):
             content = json.loads(content.decode("utf-8"))
-            self.__reset_expire_time(content["expires_in"])
-            return content["access_token"]
+            return content["access_token"], content["expires_in"]
         else:
             raise Exception(str(response.status)+"\n"+response.reason)
 
-    def __generic_api_call(self, call, method, content_type=None, payload=None, headers=None):
+    def __fetch_access_token(self):
+        """
+        This method is used by the token manager to get a new access token. If there is a
+        token store, the token is taken from it, and the identity endpoint is only called
+        when the stored token has expired.
+        
+        Args:
+            None
+            
+        Returns:
+            tuple:  The access token and the number of seconds until it expires.
+        """
+        if self.__token_store is None:
+            return self.__generateAccessToken(self.__munchkin)
+        return self.__token_store.fetch(self.__munchkin+":"+self.__client_id,
+                                        lambda: self.__generateAccessToken(self.__munchkin))
+
+    def __invalidate_access_token(self, token):
+        """
+        This method throws away an access token that the server rejected, so that the next
+        call gets a new one.
+        
+        Args:
+            token (string): The rejected token.
+            
+        Returns:
+            None
+        """
+        # The store goes first, otherwise the token manager would just read the
+        # rejected token back out of it.
+        if self.__token_store is not None:
+            self.__token_store.invalidate(self.__munchkin+":"+self.__client_id, token)
+        self.__tokens.invalidate(token)
+
+    def __generic_api_call(self, call, method, content_type=None, payload=None, headers=None, idempotent=None,
+                           cache=None):
         """
         This method executes a generic API call to the REST API endpoint. The correct syntax
         should be passed into this method from inside of each call wrapper. 
         
+        Marketo reports some failures inside a 200 response, and the retry policy decides
+        which of those are retried. Only the response of the last attempt is returned.
+        
         Args:
             call (string):                    The actual API call to make. This method contains the endpoint itself,
                                               but the desired call must be given from outside.
@@ -159,6 +2130,10 @@ class MarketoWrapper:
             payload (string, optional):       Any payload that should be sent to the server.
             headers (dict, optional):         Any custom headers to send. The access token is added automatically.
                                               inside the method, so it does not need to be added manually from outside.
+            idempotent (bool, optional):      Whether the call can safely be made twice. By default, only calls that
+                                              read data (GET, or POST with _method=GET) are.
+            cache (string, optional):         The name of the method making the call, if its responses can be
+                                              taken from the response cache.
         
         Returns:
 			dict: A dictionary representing the JSON response from the Marketo server.
@@ -168,44 +2143,715 @@ class MarketoWrapper:
         # this link for a full description: http://effbot.org/zone/default-values.htm
         if content_type is None:
             content_type = "application/json"
-        if payload is None:
-            payload = {}
         if headers is None:
             headers = {}
+        if idempotent is None:
+            idempotent = method == "GET" or "_method=GET" in call
+        
+        cache_key = None
+        if cache is not None and self.__response_cache is not None:
+            # Responses can differ between API users, so each one gets its own entries.
+            cache_key = self.__munchkin+":"+cache+":"+self.__client_id+":"+call
+            response = self.__response_cache.get(cache_key)
+            if response is not None:
+                return response
+        
+        # Identical GETs that are in flight at the same time share one round trip. The
+        # client ID is part of the key, so callers only share what they could see anyway.
+        coalesce = method == "GET" and payload is None and not headers
+        # Prevents mismatch errors by exlicitly requesting json.
+        headers["Content-type"] = content_type
+        if coalesce:
+            content = self.__single_flight.do(self.__munchkin+":"+self.__client_id+":"+call,
+                                              lambda: self.__send(call, method, payload, headers, idempotent))
+        else:
+            content = self.__send(call, method, payload, headers, idempotent)
+        
+        if cache_key is not None and content.get("success"):
+            self.__response_cache.set(cache_key, content, self.__cache_ttls[cache])
+        return content
+
+    def __send(self, call, method, payload, headers, idempotent):
+        """
+        This method sends an API call, and sends it again for as long as the retry policy
+        says so.
+        
+        Args:
+            call (string):      The API call to make.
+            method (string):    The HTTP method to use.
+            payload (string):   The payload to send, or None.
+            headers (dict):     The headers to send. The access token is added here.
+            idempotent (bool):  Whether the call can safely be made twice.
+        
+        Returns:
+            dict:   The JSON response of the last attempt.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            # Add the access token to the HTTP header. The token manager takes care of
+            # generating a new one when it expires.
+            token = self.__tokens.get_token()
+            headers["Authorization"] = "Bearer "+token
+            self.__spend_call()
+            # A file-like payload was read by the last attempt, so start it over.
+            if hasattr(payload, "seek"):
+                payload.seek(0)
+            # Make the API call once the rate limiter allows it.
+            with self.__rate_limiter.limit():
+                started = time.time()
+                response, content = self.__http.request("https://"+self.__munchkin+".mktorest.com/"+
+                                                            call, method, body=payload, headers=headers)
+                latency = time.time() - started
+            
+            # If the call was successful, return the content retrieved from the server.
+            if (response.status == 200):
+                content = json.loads(content.decode("utf-8"))
+            else:
+                raise Exception(str(response.status)+"\n"+response.reason)
+            
+            error = self.__retry_policy.classify(content)
+            self.__concurrency.record(started, latency, error == RetryPolicy.THROTTLE,
+                                      method+" "+re.sub(r"/\d+", "/{id}", call.split("?")[0]))
+            delay = self.__retry_policy.delay(error, attempt, idempotent)
+            if delay is None:
+                return content
+            logging.warning("Retrying "+method+" "+call.split("?")[0]+" after "+json.dumps(content.get("errors"))+
+                            " (attempt "+str(attempt)+")")
+            if error == RetryPolicy.TOKEN:
+                self.__invalidate_access_token(token)
+            time.sleep(delay)
+
+    def __spend_call(self):
+        """
+        This method accounts for an API call that is about to be made. It raises
+        QuotaExceededError if the wrapper's call budget is spent, and waits for the
+        quota governor if there is one.
+        
+        Args:
+            None
+            
+        Returns:
+            None
+        """
+        with self.__calls_lock:
+            if self.__call_budget is not None and self.__calls_made >= self.__call_budget:
+                raise QuotaExceededError("The budget of "+str(self.__call_budget)+" calls has been spent")
+            self.__calls_made += 1
+        if self.__quota_governor is not None:
+            self.__quota_governor.admit(self.__sample_daily_usage, self.__low_priority)
+    
+    def __sample_daily_usage(self):
+        """
+        This method is used by the quota governor to sample the instance's usage.
+        
+        Args:
+            None
+            
+        Returns:
+            int:    The number of calls made today across all API users, or None if the
+                    server did not say.
+        """
+        response = self.get_daily_usage()
+        if not response.get("success") or not response.get("result"):
+            return None
+        return sum(day.get("total", 0) for day in response["result"])
+    
+    def __dispatch(self, function, jobs, workers=None, adaptive=False):
+        """
+        This method runs a function over many sets of arguments on a pool of worker threads.
+        Only a bounded number of jobs are queued ahead of the caller, so the jobs can come
+        from a generator of any size without being held in memory all at once.
+        
+        Args:
+            function (callable):        The function to run. It usually makes one or more API calls.
+            jobs (iterable):            A tuple of positional arguments for each call of the function.
+            workers (int, optional):    The most jobs to run at once. It defaults to the number of
+                                        concurrent calls the rate limiter allows.
+            adaptive (bool, optional):  If true, the number of jobs in flight follows the adaptive
+                                        concurrency limit, which never goes above workers.
+        
+        Returns:
+            generator:  The return value of each job, in the same order as the jobs. If a job raised
+                        an exception, it is raised again when its result is reached.
+        """
+        if workers is None:
+            workers = self.__rate_limiter.max_concurrent
+        
+        def run(job):
+            if adaptive:
+                with self.__concurrency:
+                    return function(*job)
+            return function(*job)
+        
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            try:
+                for job in jobs:
+                    if len(pending) >= 2*workers:
+                        yield pending.popleft().result()
+                    pending.append(executor.submit(run, job))
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                # Jobs that have not started are dropped if the caller stops early.
+                for future in pending:
+                    future.cancel()
+
+    def __bulk_write(self, write, records, workers=None, adaptive=False, dead_letter=None, key=None,
+                     idempotent=True):
+        """
+        This method sends records to a bulk API call and reconciles each result against
+        its record. Records that were skipped for a reason in RETRYABLE_RECORD_ERRORS are
+        collected and sent again in a later round, on their own, backing off between rounds
+        like the retry policy does. Once the retry policy gives up, they count as failed.
+        When records have keys, a record is not sent again if a later record with the same
+        key has been written in the meantime, so the latest value of each key still wins.
+        
+        Args:
+            write (callable):               The API call. It takes a list of records and returns the response.
+            records (iterable):             The records to send. They are read lazily.
+            workers (int, optional):        The most batches to have in flight at once. It defaults to
+                                            the number of concurrent calls Marketo allows.
+            adaptive (bool, optional):      If true, the number of batches in flight follows the adaptive
+                                            concurrency limit. See run_in_parallel().
+            dead_letter (string, optional): The path of a file to append every record that failed for good
+                                            to, one JSON object per line with the "record" and its "result".
+            key (callable, optional):       If given, records of a batch with the same key are merged before
+                                            they are sent. See coalesce_records().
+            idempotent (bool, optional):    Whether sending a record twice has the same effect as sending it
+                                            once. If not, records of a batch whose call failed are never sent
+                                            again. See __write_batches().
+        
+        Returns:
+            generator:  A tuple of each record and its final result, in the same order as the records.
+                        Once a record is waiting to be sent again, the results after it are held back
+                        until it has its final result.
+        """
+        failures = None
+        # Each entry is a list of a record, its latest result, whether it is waiting to be sent
+        # again, and its position. Once one is waiting, it and every entry after it are held here.
+        held = collections.deque()
+        # Maps the key of each record that started waiting in this round to the latest position
+        # of a record with that key that has been written since.
+        written = {}
+        
+        def finish(entry):
+            nonlocal failures
+            record, result = entry[0], entry[1]
+            superseded = any(reason.get("code") == SUPERSEDED_ERROR for reason in result.get("reasons", []))
+            if dead_letter is not None and result.get("status") == "skipped" and not superseded:
+                if failures is None:
+                    failures = open(dead_letter, "a")
+                failures.write(json.dumps({"record": record, "result": result})+"\n")
+                failures.flush()
+            return record, result
+        
+        attempt = 0
+        retries = None
+        try:
+            while True:
+                attempt += 1
+                sending, retries = retries, []
+                if sending is None:
+                    results = self.__write_batches(write, records, workers, adaptive, key, idempotent)
+                else:
+                    results = self.__write_batches(write, [entry[0] for entry in sending], workers, adaptive, key,
+                                                   idempotent)
+                for index, (record, result) in enumerate(results):
+                    if sending is None:
+                        entry = [record, result, False, index]
+                    else:
+                        entry = sending[index]
+                        entry[1] = result
+                    codes = [str(reason.get("code")) for reason in result.get("reasons", [])]
+                    entry[2] = result.get("status") == "skipped" and any(code in RETRYABLE_RECORD_ERRORS
+                                                                         for code in codes)
+                    record_key = None if key is None else key(record)
+                    if entry[2]:
+                        retries.append(entry)
+                        if record_key is not None:
+                            written.setdefault(record_key, -1)
+                    elif record_key in written and result.get("status") != "skipped":
+                        written[record_key] = max(written[record_key], entry[3])
+                    if sending is None:
+                        if held or entry[2]:
+                            held.append(entry)
+                        else:
+                            yield finish(entry)
+                
+                # Results come in the same order as the records, so a record written after one
+                # with the same key started waiting is a later one, and sending the waiting one
+                # again would overwrite it.
+                for entry in retries:
+                    if key is not None and written.get(key(entry[0]), -1) > entry[3]:
+                        entry[1] = {"status": "skipped", "reasons": [
+                            {"code": SUPERSEDED_ERROR, "message": "A later record with the same key was written"}]}
+                        entry[2] = False
+                retries = [entry for entry in retries if entry[2]]
+                written.clear()
+                
+                delay = None
+                if retries:
+                    delay = self.__retry_policy.delay(RetryPolicy.THROTTLE, attempt, True)
+                if delay is None:
+                    # The retry policy gave up, so the records still waiting count as failed.
+                    for entry in retries:
+                        entry[2] = False
+                    retries = []
+                while held and not held[0][2]:
+                    yield finish(held.popleft())
+                if not retries:
+                    return
+                logging.warning("Resending "+str(len(retries))+" skipped records (attempt "+str(attempt)+")")
+                time.sleep(delay)
+        finally:
+            if failures is not None:
+                failures.close()
+    
+    def __download(self, call, path=None):
+        """
+        This method gets the body of a call that returns a file. If a path is given, the body
+        is streamed straight to disk, a block at a time, so that large files are never held in
+        memory. Otherwise it is read into memory and returned. Marketo reports errors, such
+        as an expired token or throttling, as a JSON response in place of the file, so those
+        are retried the same way __send() retries them, and never end up in the file.
+        
+        Args:
+            call (string):              The API call to make.
+            path (string, optional):    Where to write the file. It is replaced if it already exists.
+        
+        Returns:
+            int or bytes:   The number of bytes written if a path was given, or else the contents of the file.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            token = self.__tokens.get_token()
+            headers = {"Authorization": "Bearer "+token}
+            self.__spend_call()
+            with self.__rate_limiter.limit():
+                with self.__http.stream("https://"+self.__munchkin+".mktorest.com/"+call, "GET",
+                                        headers=headers) as response:
+                    if response.status != 200:
+                        raise Exception(str(response.status)+"\n"+response.reason)
+                    if not (response.getheader("Content-Type") or "").startswith("application/json"):
+                        if path is None:
+                            return response.read()
+                        written = 0
+                        with open(path, "wb") as output:
+                            while True:
+                                block = response.read(65536)
+                                if not block:
+                                    break
+                                output.write(block)
+                                written += len(block)
+                        return written
+                    content = json.loads(response.read().decode("utf-8"))
+            
+            error = self.__retry_policy.classify(content)
+            delay = self.__retry_policy.delay(error, attempt, True)
+            if delay is None:
+                raise Exception(json.dumps(content.get("errors")))
+            logging.warning("Retrying GET "+call+" after "+json.dumps(content.get("errors"))+
+                            " (attempt "+str(attempt)+")")
+            if error == RetryPolicy.TOKEN:
+                self.__invalidate_access_token(token)
+            time.sleep(delay)
+    
+    def __import_piece(self, file_format, file_name, piece, header, fields, download_dir, max_poll_interval):
+        """
+        This method imports one piece of a file, and waits for the import to finish. Up to
+        10 imports run at once. Any more wait here for a slot, since Marketo would reject them.
+        
+        Args:
+            file_format (string):           The format of the file.
+            file_name (string):             The path of the file.
+            piece (tuple):                  The start and end offset of the piece, not counting the header.
+            header (bytes):                 The header line of the file.
+            fields (list):                  The other form fields of the import call.
+            download_dir (string):          Where to save the failure and warning files, or None.
+            max_poll_interval (float):      The longest to wait between status checks.
+        
+        Returns:
+            dict:   The final status of the import.
+        """
+        with self.__import_slots:
+            body = MultipartFile([("format", file_format)]+fields, file_name, piece[0], piece[1], header)
+            try:
+                response = self.__generic_api_call("bulk/v1/leads.json", "POST", body.content_type, body,
+                                                   {"Content-Length": str(body.length)})
+            finally:
+                body.close()
+            if not response.get("success"):
+                raise Exception(json.dumps(response.get("errors")))
+            batch_id = response["result"][0]["batchId"]
             
-        # Check to see if the token has expired. If so, generate a new one.
-        if self.__expire_time < time.time():
-            self.__token = self.__generateAccessToken(self.__munchkin)
+            # Imports take anywhere from seconds to hours, so back off between status checks.
+            delay = 1
+            while True:
+                response = self.get_import_status(batch_id)
+                if not response.get("success"):
+                    raise Exception(json.dumps(response.get("errors")))
+                status = response["result"][0]
+                if status["status"] in ("Complete", "Failed"):
+                    break
+                time.sleep(delay)
+                delay = min(2*delay, max_poll_interval)
+        
+        if download_dir is not None:
+            # The files are in the same format as the file that was imported.
+            if status.get("numOfRowsFailed"):
+                self.get_import_failure_file(batch_id, os.path.join(download_dir,
+                                                                    str(batch_id)+"_failures."+file_format))
+            if status.get("numOfRowsWithWarning"):
+                self.get_import_warning_file(batch_id, os.path.join(download_dir,
+                                                                    str(batch_id)+"_warnings."+file_format))
+        return status
+    
+    def __changed(self, records, field, scope, fingerprints):
+        """
+        This method leaves out the records that have not changed since they were last sent.
+        
+        Args:
+            records (iterable):                 The records.
+            field (string):                     The field that identifies each record.
+            scope (tuple):                      How the records are sent. See FingerprintStore.
+            fingerprints (FingerprintStore):    What was last sent. If None, every record is kept.
+        
+        Returns:
+            iterable:   The records that changed, in order.
+        """
+        if fingerprints is None:
+            return records
+        return (record for record in records if not fingerprints.unchanged(field, record, scope))
+    
+    def __remember(self, results, field, scope, fingerprints):
+        """
+        This method updates the fingerprint of each record the server confirms, as the
+        results go by.
+        
+        Args:
+            results (iterable):                 A tuple of each record and its result.
+            field (string):                     The field that identifies each record.
+            scope (tuple):                      How the records were sent. See FingerprintStore.
+            fingerprints (FingerprintStore):    Where to record what was sent.
+        
+        Returns:
+            generator:  The same results.
+        """
+        for record, result in results:
+            if result.get("status") in ("created", "updated"):
+                fingerprints.update(field, record, scope)
+            yield record, result
+    
+    def __write_batches(self, write, records, workers=None, adaptive=False, key=None, idempotent=True):
+        """
+        This method sends records to a bulk API call in batches, with several batches in
+        flight at once, and matches each record with its own result. Marketo lists the
+        results of a batch in the same order as its input. When records are merged by key,
+        a batch that holds a key that is still in flight in an earlier batch is only sent
+        once the earlier one is done, so the latest value of each key always lands last. This
+        only holds within one call. __bulk_write() keeps it across its retry rounds.
+        
+        Args:
+            write (callable):           The API call. It takes a list of records and returns the response.
+            records (iterable):         The records to send. They are read lazily.
+            workers (int, optional):    The most batches to have in flight at once. It defaults to
+                                        the number of concurrent calls Marketo allows.
+            adaptive (bool, optional):  If true, the number of batches in flight follows the adaptive
+                                        concurrency limit. See run_in_parallel().
+            key (callable, optional):   If given, records of a batch with the same key are merged before
+                                        they are sent. See coalesce_records().
+            idempotent (bool, optional):    Whether sending a batch twice has the same effect as sending it once.
+        
+        Returns:
+            generator:  A tuple of each record and its result, in the same order as the records. Records
+                        that were merged share the result of the merged record. If a whole batch was
+                        rejected, the result of each of its records has a "status" of "skipped" and the
+                        batch's errors as "reasons". A batch whose call failed has a single reason: with the
+                        code NOT_SENT_ERROR if it never reached the server and the write is idempotent, or
+                        SEND_FAILED_ERROR otherwise. A record the server did not return a result for has
+                        one with the code MISSING_RESULT_ERROR.
+        """
+        batches = collections.deque()
+        # Maps each key in flight to the event that is set once the last batch holding it is done,
+        # and lists the keys and event of each batch in flight, oldest first.
+        last_batch = {}
+        in_flight = collections.deque()
+        
+        def jobs():
+            for batch, originals in coalesce_records(records, key):
+                done = threading.Event()
+                if key is not None:
+                    while in_flight and in_flight[0][1].is_set():
+                        finished_keys, finished = in_flight.popleft()
+                        for record_key in finished_keys:
+                            if last_batch.get(record_key) is finished:
+                                del last_batch[record_key]
+                    batch_keys = set(record_key for record_key in map(key, batch) if record_key is not None)
+                    # Batches in flight land in any order, so a batch that shares a key with an
+                    # earlier one waits for it, or the older value could end up winning.
+                    for record_key in batch_keys:
+                        if record_key in last_batch:
+                            last_batch[record_key].wait()
+                    for record_key in batch_keys:
+                        last_batch[record_key] = done
+                    in_flight.append((batch_keys, done))
+                batches.append((len(batch), originals))
+                yield batch, done
+        
+        def send(batch, done):
+            try:
+                return write(batch)
+            except QuotaExceededError:
+                raise
+            except Exception as e:
+                # One batch failing must not lose the results of the others, so its records are
+                # reported as skipped. They are only left for the retry rounds to send again if
+                # sending them twice is known to be harmless.
+                logging.warning("Sending a batch of "+str(len(batch))+" records failed: "+str(e))
+                code = NOT_SENT_ERROR if idempotent and isinstance(e, RequestNotSentError) else SEND_FAILED_ERROR
+                return {"success": False, "errors": [{"code": code, "message": str(e)}]}
+            finally:
+                done.set()
+        
+        for response in self.__dispatch(send, jobs(), workers, adaptive):
+            size, originals = batches.popleft()
+            if response.get("success"):
+                results = response.get("result", [])
+            else:
+                # Each record gets a result of its own, so that changing one does not change the others.
+                results = [{"status": "skipped", "reasons": copy.deepcopy(response.get("errors", []))}
+                           for _ in range(size)]
+            for record, index in originals:
+                if index < len(results):
+                    yield record, results[index]
+                else:
+                    yield record, {"status": "skipped", "reasons": [
+                        {"code": MISSING_RESULT_ERROR, "message": "The server did not return a result for the record"}]}
+    
+    def __iter_pages(self, fetch, paging_token=None):
+        """
+        This method follows nextPageToken from page to page until the server says there
+        is nothing more. Calls that report "moreResult" stop when it is false. Calls that
+        do not, stop when a page comes back without a "nextPageToken".
+        
+        Args:
+            fetch (callable):               Gets one page. It takes the paging token, which is None for
+                                            the first page of calls that do not need one to start.
+            paging_token (string, optional):    The token of the first page.
+        
+        Returns:
+            generator:  The response of each page, in order.
+        """
+        while True:
+            response = fetch(paging_token)
+            if not response.get("success"):
+                raise Exception(json.dumps(response.get("errors")))
+            yield response
+            next_token = response.get("nextPageToken")
+            if not next_token or not response.get("moreResult", True):
+                return
+            paging_token = next_token
+    
+    def __iter_records(self, pages, prefetch=0, commit=None):
+        """
+        This method yields the records of each page in turn.
+        
+        Args:
+            pages (iterable):           The responses of each page.
+            prefetch (int, optional):   How many pages to fetch ahead of the caller. See __prefetch().
+            commit (callable, optional):    Called with each page once the caller has asked for the
+                                            record after its last one.
+        
+        Returns:
+            generator:  Every record in the "result" attribute of every page.
+        """
+        if prefetch:
+            pages = self.__prefetch(pages, prefetch)
+        for page in pages:
+            yield from page.get("result", [])
+            if commit is not None:
+                commit(page)
+    
+    def __resume(self, checkpoints, job, paging_token):
+        """
+        This method picks the paging token to start an export from, and makes the function
+        that records its progress. A page is only committed once the caller has moved past
+        all of its records, so after a crash the export resumes at the first page that was
+        not fully processed. Records may be seen twice, but never skipped.
+        
+        Args:
+            checkpoints (FileCheckpointStore):  Where progress is kept. If None, nothing is kept.
+            job (string):                       The name of the export.
+            paging_token (string):              The token to start from if the job has no checkpoint.
+        
+        Returns:
+            tuple:  The paging token to start from, and the commit function for __iter_records(),
+                    which is None if there is no checkpoint store.
+        """
+        if checkpoints is None:
+            return paging_token, None
+        if job is None:
+            raise Exception("A job name is required to checkpoint an export")
+        count = 0
+        checkpoint = checkpoints.load(job)
+        if checkpoint is not None:
+            paging_token, count = checkpoint["nextPageToken"], checkpoint["count"]
+        
+        def commit(page):
+            nonlocal count
+            count += len(page.get("result", []))
+            if page.get("nextPageToken"):
+                checkpoints.save(job, page["nextPageToken"], count)
+        return paging_token, commit
+    
+    def __crawl_offsets(self, fetch, page_size, workers=None):
+        """
+        This method pages through a call that takes an offset and a page size. The offsets
+        of later pages do not depend on earlier ones, so several pages are fetched at once.
+        Pages are yielded in order, and the crawl stops at the first page that comes back
+        short. Since most listings are only a few pages long, the crawl starts with one page
+        in flight and doubles that with every full page, up to the number of workers. That
+        way only a few pages past the end are ever requested, and they are dropped.
+        
+        Args:
+            fetch (callable):           Gets one page. It takes the offset of the page.
+            page_size (int):            How many records to request per page.
+            workers (int, optional):    The most pages to fetch at once. It defaults to the
+                                        number of concurrent calls the rate limiter allows.
+        
+        Returns:
+            generator:  The response of each page, in order.
+        """
+        if workers is None:
+            workers = self.__rate_limiter.max_concurrent
+        offsets = itertools.count(0, page_size)
+        pending = collections.deque()
+        in_flight = 1
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            try:
+                while True:
+                    while len(pending) < in_flight:
+                        pending.append(executor.submit(fetch, next(offsets)))
+                    page = pending.popleft().result()
+                    if not page.get("success"):
+                        raise Exception(json.dumps(page.get("errors")))
+                    yield page
+                    # Asset calls leave "result" out altogether once the offset is past the end.
+                    if len(page.get("result", [])) < page_size:
+                        return
+                    in_flight = min(2*in_flight, workers)
+            finally:
+                # Pages past the end that have not been sent yet are dropped.
+                for future in pending:
+                    future.cancel()
+    
+    def __prefetch(self, pages, prefetch):
+        """
+        This method fetches pages on a worker thread while the caller is still processing
+        earlier ones. Each page depends on the token of the one before it, so the pages
+        are still requested one at a time. The worker stops once the given number of
+        fetched pages are waiting to be processed, and it stops for good when the caller
+        closes the generator.
+        
+        Args:
+            pages (iterable):   The responses of each page. It is consumed on the worker thread.
+            prefetch (int):     The most fetched pages that can wait for the caller.
+        
+        Returns:
+            generator:  The same pages, in order. Any exception raised while fetching is raised
+                        here when the caller reaches it.
+        """
+        for _, page in self.__fan_in([pages], 1, prefetch):
+            yield page
+    
+    def __fan_in(self, sources, workers, buffer):
+        """
+        This method consumes several iterables at once, each on a worker thread, and yields
+        their items as they come in. The items of each iterable keep their order, but the
+        iterables are interleaved. The workers stop once the given number of items are
+        waiting to be processed, and they stop for good when the caller closes the generator.
         
-        # Add the access token to the HTTP header. 
-        headers["Authorization"] = "Bearer "+self.__token
-        # Prevents mismatch errors by exlicitly requesting json.
-        headers["Content-type"] = content_type
-        # Make the API call.
-        response, content = self.__http.request("https://"+self.__munchkin+".mktorest.com/"+
-                                                    call, method, body=payload, headers=headers)
+        Args:
+            sources (list):     The iterables to consume.
+            workers (int):      The most iterables to consume at once.
+            buffer (int):       The most items that can wait for the caller.
         
-        # If the call was successful, return the content retrieved from the server.
-        if (response.status == 200):
-            return json.loads(content.decode("utf-8"))
-        else:
-            raise Exception(str(response.status)+"\n"+response.reason)
+        Returns:
+            generator:  A tuple of the index of the iterable in sources and the item, for every
+                        item. Any exception raised by an iterable is raised here when the caller
+                        reaches it.
+        """
+        buffered = queue.Queue(buffer)
+        stopped = threading.Event()
+        done = object()
+        
+        def put(item):
+            # Check every so often whether the caller has gone away, so the worker is not
+            # left blocked on a full queue forever.
+            while not stopped.is_set():
+                try:
+                    buffered.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def drain(index, source):
+            try:
+                for item in source:
+                    if not put((index, item, None)):
+                        return
+            except BaseException as e:
+                put((index, done, e))
+            else:
+                put((index, done, None))
+        
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(drain, index, source) for index, source in enumerate(sources)]
+            try:
+                remaining = len(futures)
+                while remaining:
+                    index, item, error = buffered.get()
+                    if item is not done:
+                        yield index, item
+                    elif error is not None:
+                        raise error
+                    else:
+                        remaining -= 1
+            finally:
+                stopped.set()
+                for future in futures:
+                    future.cancel()
     
-    def __reset_expire_time(self, expiresIn):
+    def __activity_shard(self, activity_type_ids, since, until, list_id=None, batch_size=None):
         """
-        This method is used to reset the clock on an access token. When a new token is 
-        generated, this method should be called with the "expires_in" field of the
-        response from the Marketo identity endpoint. 
+        This method pages through the activities from one point in time up to another.
+        Activities come back oldest first, so paging stops at the first activity that is
+        not before the upper bound.
         
         Args:
-            expiresIn (int):    The number of seconds until the new token expires. It should
-                                be retrieved from the response of the Marketo identity endpoint.
-                                
+            activity_type_ids (list):   A list of integers indicating the activity ids to filter on.
+            since (string):             The start of the shard, in the "activityDate" format.
+            until (string):             The end of the shard, which is left out, in the same format.
+            list_id (int, optional):    The id of a list of leads to retrieve activities for.
+            batch_size (int, optional): The number of activities to request per page.
+        
         Returns:
-            None
-        """
-        self.__expire_time = time.time() + expiresIn
-
+            generator:  A list of the activities in each page that fall inside the shard.
+        """
+        paging_token = self.get_paging_token(since)
+        pages = self.__iter_pages(
+            lambda token: self.get_lead_activities(activity_type_ids, token, list_id, batch_size), paging_token)
+        for page in pages:
+            result = page.get("result", [])
+            activities = [activity for activity in result if activity["activityDate"] < until]
+            yield activities
+            if len(activities) < len(result):
+                return
+    
 ############################################################################################
 #                                                                                          #
 #                                   Paging Token                                           # 
@@ -348,7 +2994,7 @@ class MarketoWrapper:
         method = "GET"
         return self.__generic_api_call(call, method)
     
-    def create_update_leads(self, leads, action=None, lookup_field=None, async=None, partition=None):
+    def create_update_leads(self, leads, action=None, lookup_field=None, async_processing=None, partition=None):
         """
         This method makes takes an array of dictionaries that represent all of the leads
 		and their attributes that should be updated in Marketo. It takes that array, and
@@ -364,7 +3010,7 @@ class MarketoWrapper:
                                                 'createDuplicate'
             lookup_field (string, optional):    This specifies which field to use to identify 
                                                 duplicates. Deault is email.
-            async (bool, optional):             Tells the server to process the updates asynchronously. The
+            async_processing (bool, optional):  Tells the server to process the updates asynchronously. The
                                                 default is false.
             partition (string, optional):       Specifies which partition to do the operation on. This becomes
                                                 a required parameter if the Marketo instance has lead partitions.
@@ -379,8 +3025,8 @@ class MarketoWrapper:
             payload["action"] = str(action)
         if lookup_field is not None:
             payload["lookupField"] = str(lookup_field)
-        if async is not None:
-            payload["asyncProcessing"] = str(async)
+        if async_processing is not None:
+            payload["asyncProcessing"] = str(async_processing)
         if partition is not None:
             payload["partitionName"] = str(partition)
         # Use json.dumps() because the httplib2 does not serialize dictionary
@@ -438,12 +3084,11 @@ class MarketoWrapper:
         Returns:
             dict:   The response from the server indicating success or failure.
         """
-        call = "rest/v1/leads/"+leadID+"/merge.json"
+        call = "rest/v1/leads/"+str(winner)+"/merge.json?leadIds="+",".join(map(str, losers))
         method = "POST"
-        headers = {"leadIds": ",".join(map(str, losers))}
         if crm_merge is not None:
-            headers["mergeInCRM"] = str(crm_merge)
-        return self.__generic_api_call(call, method, headers=headers)
+            call += "&mergeInCRM="+str(crm_merge).lower()
+        return self.__generic_api_call(call, method)
     
     def get_lead_partitions(self):
         """
@@ -458,7 +3103,7 @@ class MarketoWrapper:
         """
         call = "rest/v1/leads/partitions.json"
         method = "GET"
-        return self.__generic_api_call(call, method)
+        return self.__generic_api_call(call, method, cache="get_lead_partitions")
     
     def import_lead(self, file_format, file_name, lookup_field=None, list_id=None, partition=None):
         """
@@ -481,9 +3126,25 @@ class MarketoWrapper:
         Returns:
             dict:   The response from the server. The result attribute contains a batch id which can
                     be used to query the system for the status of the import since the import
-                    is asynchronous.
+                    is asynchronous. Use bulk_import_leads() to import larger files and wait for
+                    the import to finish.
         """
-        pass
+        call = "bulk/v1/leads.json"
+        method = "POST"
+        fields = [("format", file_format)]
+        if lookup_field is not None:
+            fields.append(("lookupField", lookup_field))
+        if list_id is not None:
+            fields.append(("listId", list_id))
+        if partition is not None:
+            fields.append(("partitionName", partition))
+        # The file is streamed from disk rather than read into memory first.
+        body = MultipartFile(fields, file_name)
+        try:
+            return self.__generic_api_call(call, method, body.content_type, body,
+                                           {"Content-Length": str(body.length)})
+        finally:
+            body.close()
     
     def get_import_status(self, batch_id):
         """
@@ -501,38 +3162,39 @@ class MarketoWrapper:
         method = "GET"
         return self.__generic_api_call(call, method)
     
-    def get_import_failure_file(self, batch_id):
+    def get_import_failure_file(self, batch_id, path=None):
         """
         If an import fails, the file containing the failure can be retrieved with this method.
+        If a path is given, the file is streamed to disk as it is downloaded.
         
         Args:
-            batch_id (int):     The id of the desired batch. This is given in the return
-                                JSON of the import_lead call.
+            batch_id (int):             The id of the desired batch. This is given in the return
+                                        JSON of the import_lead call.
+            path (string, optional):    Where to save the file. It is in the same format that was
+                                        used in the import_lead call.
         
         Returns:
-            dict:   The response from the server. It returns a file in the same
-                    format that was used in the import_lead call.
+            int or bytes:   The size of the file in bytes if a path was given, or else the contents of the file.
         """
-        call = "bulk/v1/leads/batch/"+str(batch_id)+"failures.json"
-        method = "GET"
-        return self.__generic_api_call(call, method)
+        call = "bulk/v1/leads/batch/"+str(batch_id)+"/failures.json"
+        return self.__download(call, path)
     
-    def get_import_warning_file(self, batch_id):
+    def get_import_warning_file(self, batch_id, path=None):
         """
         This is the same as get_import_failure_file except that it retrieves a file
         with warnings instead of failures.
         
         Args:
-            batch_id (int):     The id of the desired batch. This is given in the return
-                                JSON of the import_lead call.
+            batch_id (int):             The id of the desired batch. This is given in the return
+                                        JSON of the import_lead call.
+            path (string, optional):    Where to save the file. It is in the same format that was
+                                        used in the import_lead call.
         
         Returns:
-            dict:   The response from the server. It returns a file in the same
-                    format that was used in the import_lead call.
+            int or bytes:   The size of the file in bytes if a path was given, or else the contents of the file.
         """
-        call = "bulk/v1/leads/batch/"+str(batch_id)+"failures.json"
-        method = "GET"
-        return self.__generic_api_call(call, method)
+        call = "bulk/v1/leads/batch/"+str(batch_id)+"/warnings.json"
+        return self.__download(call, path)
 
     def describe_lead(self):
         """
@@ -548,7 +3210,7 @@ class MarketoWrapper:
         """
         call = "rest/v1/leads/describe.json"
         method = "GET"
-        return self.__generic_api_call(call, method)
+        return self.__generic_api_call(call, method, cache="describe_lead")
     
     def get_lead_activity_types(self):
         """
@@ -564,7 +3226,7 @@ class MarketoWrapper:
         """
         call = "rest/v1/activities/types.json"
         method = "GET"
-        return self.__generic_api_call(call, method)
+        return self.__generic_api_call(call, method, cache="get_lead_activity_types")
 	
     def get_lead_activities(self, activity_type_ids, paging_token, list_id=None, batch_size=None):
         """
@@ -591,14 +3253,14 @@ class MarketoWrapper:
             call += "&listId="+str(list_id)
         if batch_size is not None:
             call += "&batchSize="+str(batch_size)
-        call += lisitfy_parameter("activityTypeIds", activity_type_ids)
+        call += listify_parameter("activityTypeIds", activity_type_ids)
         method = "GET"
         return self.__generic_api_call(call, method)
     
-    #TODO - check for >300 activities
     def add_lead_activities(self, activities):
         """
-        This method appends the given activities to the Marketo lead database.
+        This method appends the given activities to the Marketo lead database. The server
+        accepts at most 300 activities per call. Use bulk_add_lead_activities() for more.
 
         Args:
             activities (list):  A list of dicts containing all of the activites to upload.
@@ -644,8 +3306,14 @@ class MarketoWrapper:
             batch_size (int, optional):	    How many results the server will return at a time. 
                                             Default and max is 300.
             list_id (int, optional):        The id of a list of leads to retrieve activities for.
+            
+        Returns:
+            dict:   The response from the server. The "result" attribute contains an array
+                    of dictionaries that represent the changes, and "nextPageToken" is the
+                    token to pass in to get the next page.
         """
-        call = "rest/v1/activities/leadchanges.json?"
+        call = "rest/v1/activities/leadchanges.json?nextPageToken="+str(paging_token)
+        call += "&fields="+",".join(map(str, fields))
         if batch_size is not None:
             call += "&batchSize="+str(batch_size)
         if list_id is not None:
@@ -674,7 +3342,7 @@ class MarketoWrapper:
         call = "rest/v1/leads.json"
         method = "DELETE"
         payload = {"input": leads}
-        return self.__generic_api_call(self, method, payload=json.dumps(payload))
+        return self.__generic_api_call(call, method, payload=json.dumps(payload))
     
     def get_deleted_leads(self, paging_token, batch_size=None):
         """
@@ -684,11 +3352,15 @@ class MarketoWrapper:
         
         Args: 
             paging_token (string):          This is used both to paginate through the response.
+            batch_size (int, optional):	    How many results the server will return at a time. 
+                                            Default and max is 300.
         Returns:
             dict:   The response from the server that has the lead ids that
                     were deleted as well as the date they were deleted.
         """
         call = "rest/v1/activities/deletedleads.json?nextPageToken="+str(paging_token)
+        if batch_size is not None:
+            call += "&batchSize="+str(batch_size)
         method = "GET"
         return self.__generic_api_call(call, method)
     
@@ -999,7 +3671,7 @@ class MarketoWrapper:
         """
         call = "rest/v1/opportunities/describe.json"
         method = "GET"
-        return self.__generic_api_call(call, method)
+        return self.__generic_api_call(call, method, cache="describe_opportunity")
     
     def create_update_opportunities(self, opps, action=None, dedupe_by=None):
         """
@@ -1105,7 +3777,7 @@ class MarketoWrapper:
         """
         call = "rest/v1/opportunities/roles/describe.json"
         method = "GET"
-        return self.__generic_api_call(call, method)
+        return self.__generic_api_call(call, method, cache="describe_opportunity_role")
     
     def create_update_opportunity_roles(self, roles, action=None, dedupe_by=None):
         """
@@ -1215,7 +3887,7 @@ class MarketoWrapper:
         """
         call = "rest/v1/companies/describe.json"
         method = "GET"
-        return self.__generic_api_call(call, method)
+        return self.__generic_api_call(call, method, cache="describe_company")
     
     def create_update_companies(self, companies, action=None, dedupe_by=None):
         """
@@ -1292,7 +3964,7 @@ class MarketoWrapper:
             dict:   The response from the server. It includes metadata on each object that matches
                     the search criteria such as created date, modified date, Marketo id etc.
         """
-        call = "rest/v1/opportunities/roles.json?_method=GET"
+        call = "rest/v1/companies.json?_method=GET"
         method = "POST"
         payload = {"filterType": str(filter_type)}
         if filter_values is not None:
@@ -1325,7 +3997,7 @@ class MarketoWrapper:
         """
         call = "rest/v1/salespersons/describe.json"
         method = "GET"
-        return self.__generic_api_call(call, method)
+        return self.__generic_api_call(call, method, cache="describe_sales_person")
     
     def create_update_sales_persons(self, people, action=None, dedupe_by=None):
         """
@@ -1438,7 +4110,7 @@ class MarketoWrapper:
         if names is not None:
             call += "&names="+",".join(map(str, names))
         method = "GET"
-        return self.__generic_api_call(call, method)
+        return self.__generic_api_call(call, method, cache="list_custom_objects")
     
     def describe_custom_object(self, name):
         """
@@ -1455,9 +4127,8 @@ class MarketoWrapper:
         """
         call = "rest/v1/customobjects/"+str(name)+"/describe.json"
         method = "GET"
-        return self.__generic_api_call(call, method)
+        return self.__generic_api_call(call, method, cache="describe_custom_object")
     
-    # TODO check for >300
     def create_update_custom_objects(self, name, objects, action=None, dedupe_by=None):
         """
         This method makes takes a list of dictionaries that represent all of the objects
@@ -1579,7 +4250,7 @@ class MarketoWrapper:
         method = "GET"
         
         if offset is not None:
-        	call += "&offSet="+str(offset)
+        	call += "&offset="+str(offset)
         if max_depth is not None:
             call += "&maxDepth="+str(max_depth)
         if max_return is not None:
@@ -1821,8 +4492,16 @@ class MarketoWrapper:
 					that represent the emails. It includes id, name, subject, from name, from email, 
 					whether it is operational, whether it is published to MSI etc.
         """
-        call = "rest/asset/v1/emails.json"
+        call = "rest/asset/v1/emails.json?"
         method = "GET"
+        if offset is not None:
+            call += "&offset="+str(offset)
+        if max_return is not None:
+            call += "&maxReturn="+str(max_return)
+        if status is not None:
+            call += "&status="+status
+        if folder is not None:
+            call += "&folder="+urllib.parse.quote(json.dumps(folder))
         return self.__generic_api_call(call, method)
     
     def get_email_by_id(self, email, status=None):
@@ -1882,8 +4561,14 @@ class MarketoWrapper:
                     that represent the email templates. It includes the id, the name, workspace, last
                     modified date etc.
         """
-        call = "rest/asset/v1/emailTemplates.json"
+        call = "rest/asset/v1/emailTemplates.json?"
         method = "GET"
+        if offset is not None:
+            call += "&offset="+str(offset)
+        if max_return is not None:
+            call += "&maxReturn="+str(max_return)
+        if status is not None:
+            call += "&status="+status
         return self.__generic_api_call(call, method)
 
     def get_email_template_by_id(self, template_id, status=None):
@@ -2149,6 +4834,580 @@ class MarketoWrapper:
         method = "GET"
         return self.__generic_api_call(call, method)
     
+############################################################################################
+#                                                                                          #
+#                                  Paged Readers                                           #
+#                                                                                          #
+############################################################################################
+# Each of these is the generator counterpart of a paged API call. It starts at the first
+# page, follows nextPageToken to the end, and yields one record at a time, so only one
+# page is ever held in memory. By default, pages are only requested as the records are
+# consumed. With prefetch, up to that many pages are fetched ahead on a worker thread so
+# the network round trips overlap with whatever the caller does with each record.
+#
+# The asset calls page by offset instead. Since every offset is known up front, their
+# pages are fetched in parallel and put back in order before the records are yielded.
+
+    def iter_multiple_leads_by_filter_type(self, filter_type, filter_values, fields=None, batch_size=None, prefetch=0):
+        """
+        This is the generator counterpart of get_multiple_leads_by_filter_type().
+        
+        Args:
+            filter_type (string):               This should be the API name of the lead field to filter on.
+            filter_values (list):               This is a list of possible values for the lead field.
+            fields (list, optional):            A list of desired lead fields to be included in the response.
+            batch_size (int, optional):         The number of leads to request per page. Default and max is 300.
+            prefetch (int, optional):           How many pages to fetch ahead on a worker thread. By
+                                                default, pages are fetched as the records are consumed.
+        
+        Returns:
+            generator:  A dictionary for each lead that matched the filter.
+        """
+        return self.__iter_records(self.__iter_pages(
+            lambda token: self.get_multiple_leads_by_filter_type(filter_type, filter_values, fields,
+                                                                 batch_size, token)), prefetch)
+    
+    def iter_multiple_leads_by_list_id(self, list_id, fields=None, batch_size=None, prefetch=0):
+        """
+        This is the generator counterpart of get_multiple_leads_by_list_id().
+        
+        Args:
+            list_id (int):                      The id of the desired static list.
+            fields (list, optional):            A list of desired lead fields to be included in the response.
+            batch_size (int, optional):         The number of leads to request per page. Default and max is 300.
+            prefetch (int, optional):           How many pages to fetch ahead on a worker thread. By
+                                                default, pages are fetched as the records are consumed.
+        
+        Returns:
+            generator:  A dictionary for each lead in the list.
+        """
+        return self.__iter_records(self.__iter_pages(
+            lambda token: self.get_multiple_leads_by_list_id(list_id, fields, batch_size, token)), prefetch)
+    
+    def iter_multiple_leads_by_program_id(self, program_id, fields=None, batch_size=None, prefetch=0):
+        """
+        This is the generator counterpart of get_multiple_leads_by_program_id().
+        
+        Args:
+            program_id (int):                   The id of the desired program.
+            fields (list, optional):            A list of desired lead fields to be included in the response.
+            batch_size (int, optional):         The number of leads to request per page. Default and max is 300.
+            prefetch (int, optional):           How many pages to fetch ahead on a worker thread. By
+                                                default, pages are fetched as the records are consumed.
+        
+        Returns:
+            generator:  A dictionary for each lead in the program.
+        """
+        return self.__iter_records(self.__iter_pages(
+            lambda token: self.get_multiple_leads_by_program_id(program_id, fields, batch_size, token)), prefetch)
+    
+    def iter_lead_activities(self, activity_type_ids, paging_token, list_id=None, batch_size=None, prefetch=0,
+                             checkpoints=None, job=None):
+        """
+        This is the generator counterpart of get_lead_activities().
+        
+        Args:
+            activity_type_ids (list):   A list of integers indicating the activity ids to filter on.
+            paging_token (string):      The paging token to start from. See get_paging_token().
+            list_id (int, optional):    The id of a list of leads to retrieve activities for.
+            batch_size (int, optional): The number of activities to request per page. Default and max is 300.
+            prefetch (int, optional):   How many pages to fetch ahead on a worker thread. By
+                                        default, pages are fetched as the records are consumed.
+            checkpoints (FileCheckpointStore, optional):    Where to keep the progress of the export. If the
+                                                            job has a checkpoint, the export resumes from it
+                                                            instead of paging_token. Records of the page that
+                                                            was being processed when it stopped are seen again.
+            job (string, optional):                         The name of the export. Required with checkpoints.
+        
+        Returns:
+            generator:  A dictionary for each activity.
+        """
+        paging_token, commit = self.__resume(checkpoints, job, paging_token)
+        return self.__iter_records(self.__iter_pages(
+            lambda token: self.get_lead_activities(activity_type_ids, token, list_id, batch_size),
+            paging_token), prefetch, commit)
+    
+    def iter_lead_changes(self, paging_token, fields, batch_size=None, list_id=None, prefetch=0,
+                          checkpoints=None, job=None):
+        """
+        This is the generator counterpart of get_lead_changes().
+        
+        Args:
+            paging_token (string):      The paging token to start from. See get_paging_token().
+            fields (list):              The fields to look for changes to.
+            batch_size (int, optional): The number of changes to request per page. Default and max is 300.
+            list_id (int, optional):    The id of a list of leads to retrieve changes for.
+            prefetch (int, optional):   How many pages to fetch ahead on a worker thread. By
+                                        default, pages are fetched as the records are consumed.
+            checkpoints (FileCheckpointStore, optional):    Where to keep the progress of the export. If the
+                                                            job has a checkpoint, the export resumes from it
+                                                            instead of paging_token. Records of the page that
+                                                            was being processed when it stopped are seen again.
+            job (string, optional):                         The name of the export. Required with checkpoints.
+        
+        Returns:
+            generator:  A dictionary for each change.
+        """
+        paging_token, commit = self.__resume(checkpoints, job, paging_token)
+        return self.__iter_records(self.__iter_pages(
+            lambda token: self.get_lead_changes(token, fields, batch_size, list_id), paging_token), prefetch, commit)
+    
+    def iter_deleted_leads(self, paging_token, batch_size=None, prefetch=0, checkpoints=None, job=None):
+        """
+        This is the generator counterpart of get_deleted_leads().
+        
+        Args:
+            paging_token (string):      The paging token to start from. See get_paging_token().
+            batch_size (int, optional): The number of leads to request per page. Default and max is 300.
+            prefetch (int, optional):   How many pages to fetch ahead on a worker thread. By
+                                        default, pages are fetched as the records are consumed.
+            checkpoints (FileCheckpointStore, optional):    Where to keep the progress of the export. If the
+                                                            job has a checkpoint, the export resumes from it
+                                                            instead of paging_token. Records of the page that
+                                                            was being processed when it stopped are seen again.
+            job (string, optional):                         The name of the export. Required with checkpoints.
+        
+        Returns:
+            generator:  A dictionary for each deleted lead.
+        """
+        paging_token, commit = self.__resume(checkpoints, job, paging_token)
+        return self.__iter_records(self.__iter_pages(
+            lambda token: self.get_deleted_leads(token, batch_size), paging_token), prefetch, commit)
+    
+    def iter_opportunities(self, filter_type, filter_values=None, fields=None, batch_size=None, prefetch=0):
+        """
+        This is the generator counterpart of get_opportunities().
+        
+        Args:
+            filter_type (string):               This should be the API name of the field to filter on.
+            filter_values (list, optional):     This is a list of possible values for the field.
+            fields (list, optional):            A list of desired fields to be included in the response.
+            batch_size (int, optional):         The number of objects to request per page. Default and max is 300.
+            prefetch (int, optional):           How many pages to fetch ahead on a worker thread. By
+                                                default, pages are fetched as the records are consumed.
+        
+        Returns:
+            generator:  A dictionary for each opportunity that matched the filter.
+        """
+        return self.__iter_records(self.__iter_pages(
+            lambda token: self.get_opportunities(filter_type, filter_values, fields, token, batch_size)), prefetch)
+    
+    def iter_companies(self, filter_type, filter_values=None, fields=None, batch_size=None, prefetch=0):
+        """
+        This is the generator counterpart of get_companies().
+        
+        Args:
+            filter_type (string):               This should be the API name of the field to filter on.
+            filter_values (list, optional):     This is a list of possible values for the field.
+            fields (list, optional):            A list of desired fields to be included in the response.
+            batch_size (int, optional):         The number of objects to request per page. Default and max is 300.
+            prefetch (int, optional):           How many pages to fetch ahead on a worker thread. By
+                                                default, pages are fetched as the records are consumed.
+        
+        Returns:
+            generator:  A dictionary for each company that matched the filter.
+        """
+        return self.__iter_records(self.__iter_pages(
+            lambda token: self.get_companies(filter_type, filter_values, fields, token, batch_size)), prefetch)
+    
+    def iter_sales_persons(self, filter_type, filter_values=None, fields=None, batch_size=None, prefetch=0):
+        """
+        This is the generator counterpart of get_sales_persons().
+        
+        Args:
+            filter_type (string):               This should be the API name of the field to filter on.
+            filter_values (list, optional):     This is a list of possible values for the field.
+            fields (list, optional):            A list of desired fields to be included in the response.
+            batch_size (int, optional):         The number of objects to request per page. Default and max is 300.
+            prefetch (int, optional):           How many pages to fetch ahead on a worker thread. By
+                                                default, pages are fetched as the records are consumed.
+        
+        Returns:
+            generator:  A dictionary for each sales person that matched the filter.
+        """
+        return self.__iter_records(self.__iter_pages(
+            lambda token: self.get_sales_persons(filter_type, filter_values, fields, token, batch_size)), prefetch)
+    
+    def iter_custom_objects(self, name, filter_type, filter_values=None, fields=None, batch_size=None, prefetch=0):
+        """
+        This is the generator counterpart of get_custom_objects().
+        
+        Args:
+            name (string):                      The name of the custom object definition.
+            filter_type (string):               This should be the API name of the field to filter on.
+            filter_values (list, optional):     This is a list of possible values for the field.
+            fields (list, optional):            A list of desired fields to be included in the response.
+            batch_size (int, optional):         The number of objects to request per page. Default and max is 300.
+            prefetch (int, optional):           How many pages to fetch ahead on a worker thread. By
+                                                default, pages are fetched as the records are consumed.
+        
+        Returns:
+            generator:  A dictionary for each custom object that matched the filter.
+        """
+        return self.__iter_records(self.__iter_pages(
+            lambda token: self.get_custom_objects(name, filter_type, filter_values, fields, token, batch_size)),
+            prefetch)
+    
+    def iter_folders(self, root, max_depth=None, workspace=None, page_size=200, workers=None):
+        """
+        This is the generator counterpart of browse_folders().
+        
+        Args:
+            root (int):                     The id of the parent folder
+            max_depth (int, optional):      Maximum levels of recursion (default 2)
+            workspace (string, optional):   Which workspace to search in
+            page_size (int, optional):      How many folders to request per call (default and max 200)
+            workers (int, optional):        The most calls to have in flight at once. It defaults to the
+                                            number of concurrent calls Marketo allows.
+        
+        Returns:
+            generator:  A dictionary for each folder.
+        """
+        return self.__iter_records(self.__crawl_offsets(
+            lambda offset: self.browse_folders(root, offset, max_depth, page_size, workspace), page_size, workers))
+    
+    def iter_emails(self, status=None, folder=None, page_size=200, workers=None):
+        """
+        This is the generator counterpart of get_emails().
+        
+        Args:
+            status (string, optional):      The status of the email asset. Either "Approved" or "Draft".
+            folder (dict, optional):        A specific folder in which to search for emails. See get_emails().
+            page_size (int, optional):      How many emails to request per call (default and max 200)
+            workers (int, optional):        The most calls to have in flight at once. It defaults to the
+                                            number of concurrent calls Marketo allows.
+        
+        Returns:
+            generator:  A dictionary for each email.
+        """
+        return self.__iter_records(self.__crawl_offsets(
+            lambda offset: self.get_emails(offset, page_size, status, folder), page_size, workers))
+    
+    def iter_email_templates(self, status=None, page_size=200, workers=None):
+        """
+        This is the generator counterpart of get_email_templates().
+        
+        Args:
+            status (string, optional):      The status of the email templates. Either "Approved" or "Draft".
+            page_size (int, optional):      How many templates to request per call (default and max 200)
+            workers (int, optional):        The most calls to have in flight at once. It defaults to the
+                                            number of concurrent calls Marketo allows.
+        
+        Returns:
+            generator:  A dictionary for each email template.
+        """
+        return self.__iter_records(self.__crawl_offsets(
+            lambda offset: self.get_email_templates(offset, page_size, status), page_size, workers))
+    
+############################################################################################
+#                                                                                          #
+#                                      Exports                                             #
+#                                                                                          #
+############################################################################################
+
+    def export_lead_activities(self, activity_type_ids, start, end, shards=None, list_id=None,
+                               batch_size=None, workers=None, by_shard=False):
+        """
+        This method exports every activity in a date range. A single paging token makes the
+        whole range one long chain of calls, so the range is split into shards instead. Each
+        shard gets its own paging token and the shards are paged at the same time.
+        
+        Args:
+            activity_type_ids (list):       A list of integers indicating the activity ids to filter on.
+            start (datetime.datetime):      The start of the range, in UTC.
+            end (datetime.datetime):        The end of the range, in UTC. Activities at this time are left out.
+            shards (int, optional):         How many equal pieces to split the range into. It defaults
+                                            to the number of workers.
+            list_id (int, optional):        The id of a list of leads to retrieve activities for.
+            batch_size (int, optional):     The number of activities to request per page. Default and max is 300.
+            workers (int, optional):        The most shards to page at once. It defaults to the number
+                                            of concurrent calls Marketo allows.
+            by_shard (bool, optional):      If true, each activity is yielded along with the index of its
+                                            shard, so the output can be partitioned.
+        
+        Returns:
+            generator:  A dictionary for each activity, or a tuple of the shard index and the dictionary
+                        if by_shard is true. The activities of each shard are in order, but the shards
+                        are interleaved as their pages come in.
+        """
+        if workers is None:
+            workers = self.__rate_limiter.max_concurrent
+        if shards is None:
+            shards = workers
+        width = (end - start) / shards
+        bounds = [(start + width*shard).strftime("%Y-%m-%dT%H:%M:%SZ") for shard in range(shards)]
+        bounds.append(end.strftime("%Y-%m-%dT%H:%M:%SZ"))
+        sources = [self.__activity_shard(activity_type_ids, bounds[shard], bounds[shard+1], list_id, batch_size)
+                   for shard in range(shards)]
+        for shard, activities in self.__fan_in(sources, workers, 2*workers):
+            for activity in activities:
+                yield (shard, activity) if by_shard else activity
+    
+############################################################################################
+#                                                                                          #
+#                                  Response Cache                                          #
+#                                                                                          #
+############################################################################################
+
+    def invalidate_cache(self, call=None):
+        """
+        This method throws away cached responses, for example after a field has been added
+        to the lead schema. The responses cached for every API user of the instance are thrown
+        away, not just those of this wrapper's.
+        
+        Args:
+            call (string, optional):    The name of the method whose responses should be thrown away,
+                                        e.g. "describe_lead". By default, every cached response for
+                                        this Marketo instance is thrown away.
+        
+        Returns:
+            None
+        """
+        if self.__response_cache is None:
+            return
+        prefix = self.__munchkin+":"
+        if call is not None:
+            prefix += call+":"
+        self.__response_cache.invalidate(prefix)
+    
+############################################################################################
+#                                                                                          #
+#                                   Bulk Helpers                                           #
+#                                                                                          #
+############################################################################################
+
+    def run_in_parallel(self, call, jobs, workers=None, adaptive=False):
+        """
+        This method makes the same API call many times in parallel, while staying under the
+        rate limits. For example, the following yields leads 1 to 1000 in order:
+        
+            marketo.run_in_parallel(marketo.get_lead_by_id, ((lead,) for lead in range(1, 1001)))
+        
+        Args:
+            call (callable):            The API call to make, usually a method of this object.
+            jobs (iterable):            A tuple of positional arguments for each call.
+            workers (int, optional):    The most calls to have in flight at once. It defaults to the
+                                        number of concurrent calls Marketo allows.
+            adaptive (bool, optional):  If true, the number of calls in flight is adjusted on the fly:
+                                        it grows while calls are fast and succeed, and is cut back when
+                                        calls are throttled or slow down. This is useful when other
+                                        integrations share the instance's limits.
+        
+        Returns:
+            generator:  The response of each call, in the same order as the jobs.
+        """
+        return self.__dispatch(call, jobs, workers, adaptive)
+    
+    def bulk_create_update_leads(self, leads, action=None, lookup_field=None, async_processing=None, partition=None,
+                                 workers=None, adaptive=False, dead_letter=None, coalesce=True, fingerprints=None):
+        """
+        This is the bulk counterpart of create_update_leads(). It takes any number of leads,
+        sends them in batches with several requests in flight, and hands back the result of
+        each lead as soon as its batch is done. Each batch holds up to 300 leads, or fewer if
+        they would not fit in one request body. See batch_records(). Leads that are skipped
+        for a reason that may go away, such as 1029, or whose request never reached the server,
+        are sent again in later requests on their own, rather than resending the whole batch.
+        Leads whose request failed after it was sent, for example with a 5xx or a timeout, may
+        already have been written, so they are not sent again, and neither are any leads of the
+        "createDuplicate" action whose request failed.
+        
+        Args:
+            leads (iterable):                   The dicts of the leads to upload. It can be a generator,
+                                                such as one reading a file line by line.
+            action (string, optional):          See create_update_leads().
+            lookup_field (string, optional):    See create_update_leads().
+            async_processing (bool, optional):  See create_update_leads().
+            partition (string, optional):       See create_update_leads().
+            workers (int, optional):            The most requests to have in flight at once. It defaults
+                                                to the number of concurrent calls Marketo allows.
+            adaptive (bool, optional):          If true, the number of requests in flight is adjusted on
+                                                the fly. See run_in_parallel().
+            dead_letter (string, optional):     A file to append each lead that failed for good to, as
+                                                a line of JSON with the "record" and its "result".
+            coalesce (bool, optional):          If true, leads of a batch with the same value of the lookup
+                                                field are merged into one before they are sent, and fields
+                                                of later leads win. Each of them gets the merged result.
+                                                It does not apply to the "createDuplicate" action.
+            fingerprints (FingerprintStore, optional):  If given, leads that are exactly the same as when
+                                                        they were last created or updated, with the same
+                                                        action and partition, are left out: they are neither
+                                                        sent nor yielded. The store is updated with each lead
+                                                        the server confirms.
+        
+        Returns:
+            generator:  A tuple of each lead and its final result, in the same order as the leads. Once
+                        a lead is waiting to be sent again, the results after it are held back until it
+                        has its final result.
+        """
+        key = None
+        if coalesce and action != "createDuplicate":
+            key = field_key(lookup_field or "email")
+        
+        def write(batch):
+            return self.create_update_leads(batch, action, lookup_field, async_processing, partition)
+        # Marketo takes a missing action to mean createOrUpdate.
+        scope = (action or "createOrUpdate", partition)
+        results = self.__bulk_write(write, self.__changed(leads, lookup_field or "email", scope, fingerprints),
+                                    workers, adaptive, dead_letter, key, action != "createDuplicate")
+        if fingerprints is None:
+            return results
+        return self.__remember(results, lookup_field or "email", scope, fingerprints)
+    
+    def bulk_add_lead_activities(self, activities, workers=None, adaptive=False, dead_letter=None):
+        """
+        This is the bulk counterpart of add_lead_activities(). It takes any number of
+        activities, sends them in batches with several requests in flight, and hands back
+        the status of each activity as soon as its batch is done. Batches are sized the
+        same way as in bulk_create_update_leads().
+        
+        Args:
+            activities (iterable):          The dicts of the activities to add. See add_lead_activities()
+                                            for the format. It can be a generator, such as one reading a
+                                            file line by line.
+            workers (int, optional):        The most requests to have in flight at once. It defaults to
+                                            the number of concurrent calls Marketo allows.
+            adaptive (bool, optional):      If true, the number of requests in flight is adjusted on the
+                                            fly. See run_in_parallel().
+            dead_letter (string, optional): A file to append each activity that failed for good to, as
+                                            a line of JSON with the "record" and its "result".
+        
+        Returns:
+            generator:  A tuple of each activity and its final result, in the same order as the activities.
+        """
+        # Adding the same activity twice records it twice.
+        return self.__bulk_write(self.add_lead_activities, activities, workers, adaptive, dead_letter,
+                                 idempotent=False)
+    
+    def bulk_create_update_opportunities(self, opps, action=None, dedupe_by=None, workers=None, adaptive=False,
+                                         dead_letter=None, coalesce=True):
+        """
+        This is the bulk counterpart of create_update_opportunities(). See bulk_create_update_leads().
+        
+        Args:
+            opps (iterable):                The dicts of the opportunities to upload.
+            action (string, optional):      See create_update_opportunities().
+            dedupe_by (string, optional):   See create_update_opportunities().
+            workers (int, optional):        The most requests to have in flight at once. It defaults to
+                                            the number of concurrent calls Marketo allows.
+            adaptive (bool, optional):      If true, the number of requests in flight is adjusted on the
+                                            fly. See run_in_parallel().
+            dead_letter (string, optional): A file to append each opportunity that failed for good to, as
+                                            a line of JSON with the "record" and its "result".
+            coalesce (bool, optional):      If true, opportunities of a batch with the same externalOpportunityId,
+                                            or marketoGUID when deduping by idField, are merged into one
+                                            before they are sent, and fields of later ones win.
+        
+        Returns:
+            generator:  A tuple of each opportunity and its final result, in the same order as the opportunities.
+        """
+        key = None
+        if coalesce and action != "createDuplicate":
+            key = field_key("marketoGUID" if dedupe_by == "idField" else "externalOpportunityId")
+        return self.__bulk_write(lambda batch: self.create_update_opportunities(batch, action, dedupe_by),
+                                 opps, workers, adaptive, dead_letter, key, action != "createDuplicate")
+    
+    def bulk_create_update_companies(self, companies, action=None, dedupe_by=None, workers=None, adaptive=False,
+                                     dead_letter=None):
+        """
+        This is the bulk counterpart of create_update_companies(). See bulk_create_update_leads().
+        
+        Args:
+            companies (iterable):           The dicts of the companies to upload.
+            action (string, optional):      See create_update_companies().
+            dedupe_by (string, optional):   See create_update_companies().
+            workers (int, optional):        The most requests to have in flight at once. It defaults to
+                                            the number of concurrent calls Marketo allows.
+            adaptive (bool, optional):      If true, the number of requests in flight is adjusted on the
+                                            fly. See run_in_parallel().
+            dead_letter (string, optional): A file to append each company that failed for good to, as
+                                            a line of JSON with the "record" and its "result".
+        
+        Returns:
+            generator:  A tuple of each company and its final result, in the same order as the companies.
+        """
+        return self.__bulk_write(lambda batch: self.create_update_companies(batch, action, dedupe_by),
+                                 companies, workers, adaptive, dead_letter, idempotent=action != "createDuplicate")
+    
+    def bulk_create_update_custom_objects(self, name, objects, action=None, dedupe_by=None, workers=None,
+                                          adaptive=False, dead_letter=None, coalesce=True):
+        """
+        This is the bulk counterpart of create_update_custom_objects(). See bulk_create_update_leads().
+        
+        Args:
+            name (string):                  The API name of the custom object.
+            objects (iterable):             The dicts of the objects to upload.
+            action (string, optional):      See create_update_custom_objects().
+            dedupe_by (string, optional):   See create_update_custom_objects().
+            workers (int, optional):        The most requests to have in flight at once. It defaults to
+                                            the number of concurrent calls Marketo allows.
+            adaptive (bool, optional):      If true, the number of requests in flight is adjusted on the
+                                            fly. See run_in_parallel().
+            dead_letter (string, optional): A file to append each object that failed for good to, as
+                                            a line of JSON with the "record" and its "result".
+            coalesce (bool, optional):      If true, objects of a batch with the same values for the dedupe
+                                            fields of the custom object, or its id field when deduping by
+                                            idField, are merged into one before they are sent, and fields
+                                            of later ones win. The fields are looked up with
+                                            describe_custom_object().
+        
+        Returns:
+            generator:  A tuple of each object and its final result, in the same order as the objects.
+        """
+        key = None
+        if coalesce and action != "createDuplicate":
+            response = self.describe_custom_object(name)
+            if not response.get("success") or not response.get("result"):
+                raise Exception(json.dumps(response.get("errors")))
+            description = response["result"][0]
+            key = field_key(description["idField"] if dedupe_by == "idField" else description["dedupeFields"])
+        return self.__bulk_write(lambda batch: self.create_update_custom_objects(name, batch, action, dedupe_by),
+                                 objects, workers, adaptive, dead_letter, key, action != "createDuplicate")
+    
+    def bulk_import_leads(self, file_format, file_name, lookup_field=None, list_id=None, partition=None,
+                          download_dir=None, max_poll_interval=60):
+        """
+        This is the end to end counterpart of import_lead(). Files over the 10 MB import limit
+        are split at record boundaries, with the header repeated in each piece, and the
+        pieces are imported concurrently, up to 10 at a time. It then waits for every import
+        to finish, checking its status less and less often.
+        
+        Args:
+            file_format (string):               The format of the file, which can be 'csv', 'tsv', or 'ssv'.
+            file_name (string):                 The path to the desired file. Its first line must be the header.
+            lookup_field (string, optional):    See import_lead().
+            list_id (int, optional):            See import_lead().
+            partition (string, optional):       See import_lead().
+            download_dir (string, optional):    If given, the failure and warning files of each import are
+                                                saved here, as <batch id>_failures.<format> and
+                                                <batch id>_warnings.<format>.
+            max_poll_interval (float, optional):    The longest to wait between status checks, in seconds.
+        
+        Returns:
+            list:   The final status of the import of each piece, in order. Each one includes the
+                    batch id, the status, and the number of rows processed, failed and with warnings.
+                    A piece that could not be uploaded, or whose status could not be checked, has the
+                    exception that stopped it in its place, so the caller can tell which pieces were
+                    imported and only retry the others. Nothing is raised.
+        """
+        fields = []
+        if lookup_field is not None:
+            fields.append(("lookupField", lookup_field))
+        if list_id is not None:
+            fields.append(("listId", list_id))
+        if partition is not None:
+            fields.append(("partitionName", partition))
+        header, pieces = split_import_file(file_name)
+        jobs = ((file_format, file_name, piece, header, fields, download_dir, max_poll_interval) for piece in pieces)
+        
+        def import_piece(*job):
+            # One piece failing must not lose the statuses of the pieces that were imported.
+            try:
+                return self.__import_piece(*job)
+            except Exception as e:
+                logging.warning("Importing a piece of "+file_name+" failed: "+str(e))
+                return e
+        return list(self.__dispatch(import_piece, jobs, MAX_CONCURRENT_IMPORTS))
+    
 ############################################################################################
 #                                                                                          #
 #                                        Main                                              # 
@@ -2156,6 +5415,9 @@ class MarketoWrapper:
 ############################################################################################
      
 if __name__ == "__main__":
+    # The credentials are only needed to run this file directly, so importing the module
+    # does not require a settings file.
+    import settings
     logging.basicConfig(filename="logs.log", filemode="w", level=logging.DEBUG)
     munchkin = settings.MUNCHKIN
     client_id = settings.CLIENT_ID
@@ -2168,50 +5430,45 @@ if __name__ == "__main__":
 #                                                                                       #
 #########################################################################################
     
-#    with open("Trello/Carter/update100k.json") as leads:
-#        lead_list = leads.readlines()
-#        lead_list = list(map(json.loads, lead_list))
-#        
-#    jj = 0
+#    The same upload can be run from the command line, with progress reports, as:
+#        python bulk_upload.py Trello/Carter/update100k.json --lookup-field id --partition Implementation
+#
 #    start = time.time()
+#    total = 0
 #    
-#    for ii in range(300, len(lead_list), 300):
-#        result = marketo.create_update_leads(lead_list[jj:ii], lookup_field="id", partition="Implementation")
-#        if result["success"] != True:
-#            print(json.dumps(result))
-##        time.sleep(0.2)
-#        jj = ii
+#    with open("Trello/Carter/update100k.json") as leads:
+#        lead_list = (json.loads(line) for line in leads)
+#        for lead, result in marketo.bulk_create_update_leads(lead_list, lookup_field="id", partition="Implementation"):
+#            total += 1
+#            if result["status"] == "skipped":
+#                print(json.dumps(result))
 #        
 #    execution_time = time.time() - start
 #    
 #    print("Execution time for 100k net new inserts into Marketo: "+str(execution_time)+" seconds")
-#    print("Total number of leads inserted: "+str(len(lead_list)))
-#    print("Sample JSON from a single lead record:\n"+json.dumps(lead_list[1]))
+#    print("Total number of leads inserted: "+str(total))
 
 #########################################################################################
 #                                                                                       #
 #                               Login Activities                                        #
 #                                                                                       #
 #########################################################################################
-#    with open("Trello/Carter/login-activities.json") as logins:
-#        lactivities = logins.readlines()
-#        lactivities = list(map(json.loads, lactivities))
+#    logins = open("Trello/Carter/login-activities.json")
+#    lactivities = batch_records((json.loads(line) for line in logins), 100)
 #    
 ##    output = {"num_requests": 1000, "batch_size": 1, "execution_times": [], "failures": 0, "total_time": 0,
 ##             "50th": 0, "90th": 0, "95th": 0}
 #    output = {"num_requests": 500, "batch_size": 10, "execution_times": [], "failures": 0, "total_time": 0,
 #             "50th": 0, "90th": 0, "95th": 0}
-#    jj=0
 #    start_time = time.time()
-##    for ii in range(1000): Batch Size 1
-#    for ii in range(100, 50000, 100):
+##    for batch in batch_records((json.loads(line) for line in logins), 1): Batch Size 1
+#    for batch in itertools.islice(lactivities, output["num_requests"]):
 #        call_time = time.time()
-##        result = marketo.add_lead_activities(list([lactivities[ii]])) Batch Size 1
-#        result = marketo.add_lead_activities(lactivities[jj:ii])
+#        result = marketo.add_lead_activities(batch)
 #        output["execution_times"].append(time.time()-call_time)
 #        if not result["success"]:
 #            output["failures"] += 1
-#        jj=ii    
+#    logins.close()
 #
 #    output["total_time"] = time.time()-start_time
 #    output["execution_times"] = sorted(output["execution_times"])
@@ -2228,29 +5485,19 @@ if __name__ == "__main__":
 #                                                                                       #
 #########################################################################################
 #    with open("Trello/Carter/invite-activities.json") as invites:
-#        iactivities = invites.readlines()
-#        iactivities = list(map(json.loads, iactivities))
-#    jj=0
-#    for ii in range(300, len(iactivities), 300):
-#        print("Processing...")
-#        print(marketo.add_lead_activities(iactivities[jj:ii]))
-#        print("Going to next iteration...")
-#        jj=ii
+#        iactivities = (json.loads(line) for line in invites)
+#        for activity, result in marketo.bulk_add_lead_activities(iactivities):
+#            print(result)
 #########################################################################################
 #                                                                                       #
 #                            Add Team Member Activities                                 #
 #                                                                                       #
 #########################################################################################
 #    with open("Trello/Carter/add-team-member-activities.json") as adds:
-#        aactivities = adds.readlines()
-#        aactivities = list(map(json.loads, aactivities))
-#    jj=0
-#    iteration=0
-#    for ii in range(300, len(aactivities), 300):
-#        iteration += 1
-#        print("Processing... "+str(iteration))
-#        marketo.add_lead_activities(aactivities[jj:ii])
-#        jj=ii
+#        aactivities = (json.loads(line) for line in adds)
+#        for activity, result in marketo.bulk_add_lead_activities(aactivities):
+#            if result["status"] == "skipped":
+#                print(json.dumps(activity))
 
 #########################################################################################
 #                                                                                       #
@@ -2258,15 +5505,10 @@ if __name__ == "__main__":
 #                                                                                       #
 #########################################################################################
 #    with open("Trello/Carter/joined-board-activities.json") as joins:
-#        jactivities = joins.readlines()
-#        jactivities = list(map(json.loads, jactivities))
-#    jj=0
-#    iteration=0
-#    for ii in range(300, len(jactivities), 300):
-#        iteration += 1
-#        print("Processing... "+str(iteration))
-#        marketo.add_lead_activities(jactivities[jj:ii])
-#        jj=ii    
+#        jactivities = (json.loads(line) for line in joins)
+#        for activity, result in marketo.bulk_add_lead_activities(jactivities):
+#            if result["status"] == "skipped":
+#                print(json.dumps(activity))
 
 #########################################################################################
 #                                                                                       #
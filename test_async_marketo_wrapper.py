@@ -0,0 +1,216 @@
+import asyncio
+import json
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web
+
+import async_marketo_wrapper
+from async_marketo_wrapper import AsyncMarketoWrapper
+from marketo_wrapper import RateLimiter
+
+############################################################################################
+#                                                                                          #
+#                                    Fake Server                                           #
+#                                                                                          #
+############################################################################################
+
+class FakeServer:
+    """
+    This class runs a local aiohttp server in place of the Marketo instance. The identity
+    endpoint hands out a new token each time unless told to fail, with each of the given
+    lifetimes in turn and then an hour. Every other request is answered by the handler,
+    which takes the aiohttp request and returns a web.Response or a dict to send back as JSON.
+    """
+
+    def __init__(self, handler, lifetimes=()):
+        self.handler = handler
+        self.lifetimes = list(lifetimes)
+        self.calls = []
+        self.tokens = 0
+        self.identity_calls = 0
+        self.identity_fails = False
+        self.runner = None
+        self.url = None
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", self.respond)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.url = "http://127.0.0.1:"+str(self.runner.addresses[0][1])+"/"
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.runner.cleanup()
+
+    async def respond(self, request):
+        if request.path.startswith("/identity/"):
+            self.identity_calls += 1
+            if self.identity_fails:
+                return web.Response(status=500, text="Identity is down")
+            self.tokens += 1
+            lifetime = self.lifetimes.pop(0) if self.lifetimes else 3600
+            return web.json_response({"access_token": "token"+str(self.tokens), "expires_in": lifetime})
+        self.calls.append((request.method, request.path_qs, request.headers.get("Authorization")))
+        response = self.handler(request)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response if isinstance(response, web.Response) else web.json_response(response)
+
+def run(handler, test, lifetimes=(), **options):
+    """
+    This method runs a test coroutine against a fresh server and client. The coroutine takes
+    the client and the server.
+    """
+    async def main():
+        async with FakeServer(handler, lifetimes) as server:
+            options.setdefault("rate_limiter", RateLimiter(max_calls=1000000))
+            async with AsyncMarketoWrapper("123-ABC-456", "client", "secret", endpoint=server.url,
+                                           **options) as marketo:
+                return await test(marketo, server)
+    return asyncio.run(main())
+
+def success(request):
+    return {"success": True, "result": [{"id": 1}]}
+
+############################################################################################
+#                                                                                          #
+#                                   Access Tokens                                          #
+#                                                                                          #
+############################################################################################
+
+def test_calls_share_one_token_request():
+    async def test(marketo, server):
+        await asyncio.gather(*(marketo.get_lead_by_id(lead) for lead in range(20)))
+        assert server.identity_calls == 1
+        assert set(authorization for _, _, authorization in server.calls) == {"Bearer token1"}
+    run(success, test)
+
+def test_a_token_inside_the_margin_is_refreshed_in_the_background():
+    async def test(marketo, server):
+        await marketo.get_lead_by_id(1)
+        # The token is already inside the margin, so the next call still uses it, and a new
+        # one is requested alongside.
+        await marketo.get_lead_by_id(2)
+        await asyncio.sleep(0.1)
+        await marketo.get_lead_by_id(3)
+        assert server.identity_calls == 2
+        assert [authorization for _, _, authorization in server.calls] == \
+            ["Bearer token1", "Bearer token1", "Bearer token2"]
+    # The first token is already inside the 60 second margin.
+    run(success, test, lifetimes=[30])
+
+def test_a_failed_background_refresh_is_not_retried_right_away():
+    async def test(marketo, server):
+        await marketo.get_lead_by_id(1)
+        server.identity_fails = True
+        for lead in range(2, 12):
+            await marketo.get_lead_by_id(lead)
+            await asyncio.sleep(0.01)
+        assert server.identity_calls == 2
+        assert all(authorization == "Bearer token1" for _, _, authorization in server.calls)
+    run(success, test, lifetimes=[30])
+
+def test_a_rejected_token_is_replaced():
+    responses = [{"success": False, "errors": [{"code": "601", "message": "Access token invalid"}]}]
+
+    def handler(request):
+        return responses.pop(0) if responses else success(request)
+
+    async def test(marketo, server):
+        assert (await marketo.get_lead_by_id(1))["success"]
+        assert [authorization for _, _, authorization in server.calls] == ["Bearer token1", "Bearer token2"]
+    run(handler, test)
+
+############################################################################################
+#                                                                                          #
+#                                   Mirrored Calls                                         #
+#                                                                                          #
+############################################################################################
+
+def test_a_mirrored_get_builds_the_same_request_as_marketo_wrapper():
+    async def test(marketo, server):
+        response = await marketo.get_lead_by_id(5, fields=["email", "firstName"])
+        assert response == {"success": True, "result": [{"id": 1}]}
+        assert server.calls == [("GET", "/rest/v1/lead/5.json?fields=email,firstName", "Bearer token1")]
+    run(success, test)
+
+def test_mirrored_writes_send_their_payload():
+    bodies = []
+
+    async def handler(request):
+        bodies.append((request.method, request.path_qs, await request.text()))
+        return success(request)
+
+    async def test(marketo, server):
+        await marketo.merge_lead(1, [2, 3], crm_merge=True)
+        await marketo.delete_lead([{"id": 4}])
+        assert bodies == [("POST", "/rest/v1/leads/1/merge.json?leadIds=2,3&mergeInCRM=true", ""),
+                          ("DELETE", "/rest/v1/leads.json", json.dumps({"input": [{"id": 4}]}))]
+    run(handler, test)
+
+def test_paging_follows_next_page_token():
+    def handler(request):
+        if request.path == "/rest/v1/activities/pagingtoken.json":
+            return {"success": True, "nextPageToken": "0"}
+        page = int(request.query["nextPageToken"])
+        response = {"success": True, "moreResult": page < 2, "result": [{"leadId": page}]}
+        if page < 2:
+            response["nextPageToken"] = str(page+1)
+        return response
+
+    async def test(marketo, server):
+        token = await marketo.get_paging_token("2016-01-01T00:00:00Z")
+        assert token == "0"
+        leads = []
+        while True:
+            response = await marketo.get_deleted_leads(token)
+            leads += response["result"]
+            if not response["moreResult"]:
+                break
+            token = response["nextPageToken"]
+        assert [lead["leadId"] for lead in leads] == [0, 1, 2]
+    run(handler, test)
+
+############################################################################################
+#                                                                                          #
+#                                     Downloads                                            #
+#                                                                                          #
+############################################################################################
+
+def test_a_download_retries_json_errors_and_streams_the_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(async_marketo_wrapper.asyncio, "sleep", fast_sleep(asyncio.sleep))
+    contents = b"email,Import Failure Reason\n" + b"lead@example.com,Bad email\n"*10000
+    responses = [{"success": False, "errors": [{"code": "606", "message": "Max rate limit exceeded"}]}]
+
+    def handler(request):
+        if responses:
+            return responses.pop(0)
+        return web.Response(body=contents, content_type="text/csv")
+
+    async def test(marketo, server):
+        path = tmp_path / "failures.csv"
+        assert await marketo.get_import_failure_file(1, str(path)) == len(contents)
+        assert path.read_bytes() == contents
+        assert await marketo.get_import_warning_file(1) == contents
+        assert [path for _, path, _ in server.calls] == ["/bulk/v1/leads/batch/1/failures.json"]*2 + \
+            ["/bulk/v1/leads/batch/1/warnings.json"]
+    run(handler, test)
+
+def fast_sleep(sleep):
+    """
+    This method makes a stand-in for asyncio.sleep that skips back offs, so retries do not
+    slow the tests down.
+    """
+    async def skip(delay, *args, **kwargs):
+        await sleep(0)
+    return skip
+
+def test_the_client_needs_aiohttp(monkeypatch):
+    monkeypatch.setattr(async_marketo_wrapper, "aiohttp", None)
+    with pytest.raises(ImportError, match="aiohttp"):
+        AsyncMarketoWrapper("123-ABC-456", "client", "secret")
@@ -0,0 +1,63 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+from bulk_upload import read_csv, read_ndjson, upload
+from test_marketo_wrapper import echo_leads, make_wrapper
+
+############################################################################################
+#                                                                                          #
+#                                     Readers                                              #
+#                                                                                          #
+############################################################################################
+
+def test_ndjson_is_read_one_record_per_line_skipping_blank_lines(tmp_path):
+    path = tmp_path / "leads.ndjson"
+    path.write_text('{"email": "a", "score": 1}\n\n   \n{"email": "b", "tags": ["x"]}\n')
+    assert list(read_ndjson(str(path))) == [{"email": "a", "score": 1}, {"email": "b", "tags": ["x"]}]
+
+def test_csv_rows_leave_out_empty_cells(tmp_path):
+    path = tmp_path / "leads.csv"
+    path.write_text('email,firstName,company\na,Ann,\nb,,"Acme, Inc."\n')
+    assert list(read_csv(str(path))) == [{"email": "a", "firstName": "Ann"},
+                                         {"email": "b", "company": "Acme, Inc."}]
+
+############################################################################################
+#                                                                                          #
+#                                     Uploader                                             #
+#                                                                                          #
+############################################################################################
+
+def test_upload_counts_each_status():
+    marketo, pool = make_wrapper(echo_leads(lambda lead: "created" if lead["id"] % 2 else "updated"))
+    statuses = upload(marketo, ({"email": str(index), "id": index} for index in range(5)))
+    assert statuses == {"created": 2, "updated": 3}
+    assert len(pool.calls) == 1
+
+def test_upload_passes_options_to_the_bulk_helper():
+    bodies = []
+    echo = echo_leads()
+
+    def handler(method, path, body):
+        bodies.append(json.loads(body))
+        return echo(method, path, body)
+
+    marketo, pool = make_wrapper(handler)
+    upload(marketo, [{"vin": "1"}], "custom_objects", name="car_c", action="updateOnly", coalesce=False)
+    assert pool.calls == [("POST", "rest/v1/customobjects/car_c.json")]
+    assert bodies[0]["action"] == "updateOnly"
+
+def test_upload_rejects_an_unknown_kind():
+    marketo, pool = make_wrapper(echo_leads())
+    with pytest.raises(Exception, match="Unknown record kind"):
+        upload(marketo, [], "widgets")
+
+def test_custom_objects_need_a_name_on_the_command_line(tmp_path):
+    path = tmp_path / "cars.ndjson"
+    path.write_text(json.dumps({"vin": "1"})+"\n")
+    process = subprocess.run([sys.executable, "bulk_upload.py", str(path), "--kind", "custom_objects"],
+                             capture_output=True, text=True)
+    assert process.returncode == 2
+    assert "--name is required" in process.stderr
@@ -0,0 +1,93 @@
+import urllib.parse
+
+import pytest
+
+from lead_sync import LeadSync
+from marketo_wrapper import FileCheckpointStore
+from test_marketo_wrapper import make_wrapper
+
+############################################################################################
+#                                                                                          #
+#                                    Fake Streams                                          #
+#                                                                                          #
+############################################################################################
+
+# The pages of each stream, by paging token. The paging token call starts both at "0".
+CHANGES = {
+    "0": {"result": [{"id": 1, "leadId": 1, "activityDate": "2016-01-01T00:00:01Z",
+                      "fields": [{"name": "email", "newValue": "a@example.com"}]},
+                     {"id": 3, "leadId": 2, "activityDate": "2016-01-01T00:00:03Z", "fields": []}],
+          "nextPageToken": "1", "moreResult": True},
+    "1": {"result": [{"id": 5, "leadId": 7, "activityDate": "2016-01-01T00:00:05Z", "fields": []}],
+          "nextPageToken": "2", "moreResult": False},
+}
+DELETED = {
+    "0": {"result": [{"id": 2, "leadId": 3, "activityDate": "2016-01-01T00:00:02Z"},
+                     {"id": 6, "leadId": 7, "activityDate": "2016-01-01T00:00:05Z"}],
+          "nextPageToken": "1", "moreResult": False},
+}
+
+def streams(method, path, body):
+    parts = urllib.parse.urlsplit(path)
+    query = urllib.parse.parse_qs(parts.query)
+    if parts.path == "rest/v1/activities/pagingtoken.json":
+        return {"success": True, "nextPageToken": "0"}
+    pages = CHANGES if parts.path == "rest/v1/activities/leadchanges.json" else DELETED
+    return dict(pages[query["nextPageToken"][0]], success=True)
+
+def make_sync(tmp_path, sink):
+    marketo, pool = make_wrapper(streams)
+    checkpoints = FileCheckpointStore(str(tmp_path / "checkpoints.json"))
+    return LeadSync(marketo, ["email"], sink, checkpoints, since="2016-01-01T00:00:00Z"), checkpoints, pool
+
+############################################################################################
+#                                                                                          #
+#                                       Polls                                              #
+#                                                                                          #
+############################################################################################
+
+def test_changes_and_deletes_are_merged_by_date_and_then_id(tmp_path):
+    events = []
+    sync, _, _ = make_sync(tmp_path, events.append)
+    assert sync.poll() == 5
+    assert [(event["type"], event["id"]) for event in events] == \
+        [("upsert", 1), ("delete", 2), ("upsert", 3), ("upsert", 5), ("delete", 6)]
+    assert events[0]["fields"] == {"email": "a@example.com"}
+    # Lead 7 is changed and then deleted in the same second, so the delete comes last.
+    assert [event["type"] for event in events if event["leadId"] == 7] == ["upsert", "delete"]
+
+def test_a_page_is_committed_only_after_the_sink_takes_its_last_event(tmp_path):
+    watermarks = []
+
+    def sink(event):
+        checkpoint = checkpoints.load("lead_sync:changes")
+        watermarks.append((event["id"], checkpoint and checkpoint["nextPageToken"]))
+    sync, checkpoints, _ = make_sync(tmp_path, sink)
+    sync.poll()
+    # The first page of changes is committed once the sink is done with event 3, and the
+    # second once it is done with event 5.
+    assert watermarks == [(1, None), (2, None), (3, None), (5, "1"), (6, "2")]
+    assert checkpoints.load("lead_sync:changes")["nextPageToken"] == "2"
+    assert checkpoints.load("lead_sync:deleted")["nextPageToken"] == "1"
+
+def test_a_poll_resumes_from_the_page_the_sink_failed_on(tmp_path):
+    events, failures = [], []
+
+    def sink(event):
+        if event["id"] == 5 and not failures:
+            failures.append(event)
+            raise Exception("The sink is down")
+        events.append((event["type"], event["id"]))
+    sync, checkpoints, pool = make_sync(tmp_path, sink)
+    with pytest.raises(Exception, match="The sink is down"):
+        sync.poll()
+    assert checkpoints.load("lead_sync:changes")["nextPageToken"] == "1"
+    assert checkpoints.load("lead_sync:deleted") is None
+    events.clear()
+    pool.calls.clear()
+    assert sync.poll() == 3
+    # The first page of changes was committed, so only the second one is read again. No page of
+    # deleted leads was, so that stream starts over.
+    assert events == [("delete", 2), ("upsert", 5), ("delete", 6)]
+    assert ("GET", "rest/v1/activities/leadchanges.json?nextPageToken=1&fields=email") in pool.calls
+    assert ("GET", "rest/v1/activities/leadchanges.json?nextPageToken=0&fields=email") not in pool.calls
@@ -0,0 +1,991 @@
+import contextlib
+import csv
+import datetime
+import http.client
+import io
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+import pytest
+
+import marketo_wrapper
+from marketo_wrapper import (MAX_BATCH_BYTES, MIN_TOKEN_REFRESH_INTERVAL, AccessTokenManager,
+                            AdaptiveConcurrencyLimiter, FileCheckpointStore, FileTokenStore, FingerprintStore,
+                            HttpConnectionPool, LeadWriteBuffer, MarketoWrapper, MultipartFile, QuotaExceededError,
+                            QuotaGovernor, RateLimiter, RequestNotSentError, ResponseCache, SingleFlight, batch_records,
+                            coalesce_records, field_key, split_import_file)
+
+############################################################################################
+#                                                                                          #
+#                                    Fake Server                                           #
+#                                                                                          #
+############################################################################################
+
+class FakeResponse:
+    """
+    This class stands in for an http.client.HTTPResponse.
+    """
+
+    def __init__(self, body, status=200, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.status = status
+        self.reason = "OK" if status == 200 else "Error"
+        self.__content_type = content_type
+        self.__body = io.BytesIO(body)
+
+    def getheader(self, name, default=None):
+        return self.__content_type if name.lower() == "content-type" else default
+
+    def read(self, size=-1):
+        return self.__body.read(size)
+
+class FakePool:
+    """
+    This class stands in for an HttpConnectionPool. The identity endpoint hands out a new
+    token each time, and every other request is answered by the handler, which takes the
+    method, the path and query string, and the body, and returns a FakeResponse or a dict
+    to send back as JSON.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.calls = []
+        self.tokens = 0
+        self.authorizations = []
+        self.lock = threading.Lock()
+
+    def request(self, url, method="GET", body=None, headers=None):
+        response = self.__respond(url, method, body, headers)
+        return response, response.read()
+
+    @contextlib.contextmanager
+    def stream(self, url, method="GET", body=None, headers=None):
+        yield self.__respond(url, method, body, headers)
+
+    def close(self):
+        pass
+
+    def __respond(self, url, method, body, headers):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path.lstrip("/") + ("?"+parts.query if parts.query else "")
+        with self.lock:
+            if path.startswith("identity/"):
+                self.tokens += 1
+                return FakeResponse({"access_token": "token"+str(self.tokens), "expires_in": 3600})
+            self.calls.append((method, path))
+            self.authorizations.append((headers or {}).get("Authorization"))
+        response = self.handler(method, path, body)
+        return response if isinstance(response, FakeResponse) else FakeResponse(response)
+
+def make_wrapper(handler, client_id="client", **options):
+    pool = FakePool(handler)
+    options.setdefault("rate_limiter", RateLimiter(max_calls=1000000))
+    marketo = MarketoWrapper("123-ABC-456", client_id, "secret", pool=pool, **options)
+    return marketo, pool
+
+############################################################################################
+#                                                                                          #
+#                                  Rate Limiting                                           #
+#                                                                                          #
+############################################################################################
+
+def test_adaptive_limit_grows_while_calls_are_healthy():
+    limiter = AdaptiveConcurrencyLimiter(initial=2, maximum=10)
+    for _ in range(100):
+        limiter.record(time.time(), 0.1, False)
+    assert limiter.limit == 10
+
+def test_adaptive_limit_is_halved_when_throttled():
+    limiter = AdaptiveConcurrencyLimiter(initial=8, maximum=10)
+    limiter.record(time.time(), 0.1, True)
+    assert limiter.limit == 4
+
+def test_adaptive_limit_ignores_throttling_of_calls_sent_before_the_last_cut():
+    limiter = AdaptiveConcurrencyLimiter(initial=8, maximum=10)
+    started = time.time()
+    limiter.record(started, 0.1, True)
+    limiter.record(started, 0.1, True)
+    assert limiter.limit == 4
+
+def test_adaptive_latency_baseline_is_kept_per_kind_of_call():
+    limiter = AdaptiveConcurrencyLimiter(initial=2, maximum=10)
+    limiter.record(time.time(), 0.1, False, "GET rest/v1/leads/describe.json")
+    for _ in range(200):
+        limiter.record(time.time(), 1.0, False, "POST rest/v1/leads.json")
+    assert limiter.limit == 10
+
+def test_adaptive_latency_baseline_follows_a_lasting_slowdown():
+    limiter = AdaptiveConcurrencyLimiter(initial=2, maximum=10)
+    limiter.record(time.time(), 0.1, False)
+    for _ in range(300):
+        limiter.record(time.time(), 1.0, False)
+    assert limiter.limit > 1
+
+def test_quota_reset_is_within_a_day():
+    seconds = QuotaGovernor()._QuotaGovernor__seconds_until_reset()
+    # A day is 25 hours long when daylight saving time ends.
+    assert 0 < seconds <= 25*3600
+
+def samples(*usages):
+    """
+    This method makes a stand-in for get_daily_usage() that returns each of the given usages
+    in turn, and then keeps returning the last one. An exception is raised instead of returned.
+    """
+    usages = list(usages)
+    taken = []
+
+    def sample_usage():
+        usage = usages.pop(0) if len(usages) > 1 else usages[0]
+        taken.append(usage)
+        if isinstance(usage, Exception):
+            raise usage
+        return usage
+    sample_usage.taken = taken
+    return sample_usage
+
+def test_quota_governor_paces_low_priority_calls_past_the_slow_down_point(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    governor = QuotaGovernor(daily_limit=1000)
+    sample_usage = samples(699)
+    governor.admit(sample_usage, low_priority=True)
+    # The call that reaches the slow down point goes right away, and the next one is paced.
+    governor.admit(sample_usage, low_priority=True)
+    assert sleeps == [0, 0]
+
+    governor.admit(sample_usage, low_priority=True)
+    # What is left before the pause point is spread over the rest of the day.
+    assert sleeps[2] > 60
+    governor.admit(sample_usage)
+    assert sleeps[3] == 0
+    assert sample_usage.taken == [699]
+
+def test_quota_governor_pauses_low_priority_calls_past_the_pause_point(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    governor = QuotaGovernor(daily_limit=1000, sample_interval=300)
+    governor.admit(samples(900))
+    assert sleeps == [0]
+
+    sample_usage = samples(900, 900, 100)
+    governor = QuotaGovernor(daily_limit=1000, sample_interval=300)
+    governor.admit(sample_usage, low_priority=True)
+    # The call waits, and samples again, until the usage drops below the pause point.
+    assert sample_usage.taken == [900, 900, 100]
+    assert len(sleeps) == 4 and 0 < sleeps[1] <= 300 and 0 < sleeps[2] <= 300 and sleeps[3] == 0
+    assert governor.estimated_usage() == 101
+
+def test_quota_governor_estimate_is_capped_while_sampling_fails(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    governor = QuotaGovernor(daily_limit=100, sample_interval=1)
+    sample_usage = samples(50, Exception("Sampling failed"))
+    governor.admit(sample_usage)
+    governor._QuotaGovernor__sampled_at = 0
+    for _ in range(500):
+        governor.admit(sample_usage)
+    assert len(sample_usage.taken) == 2
+    assert governor.estimated_usage() == 150
+
+    # Once the quota resets, the count from before it is dropped.
+    governor._QuotaGovernor__sampled_at = 0
+    governor._QuotaGovernor__resets_at = time.time() - 1
+    governor.admit(sample_usage, low_priority=True)
+    assert governor.estimated_usage() == 1
+
+def test_calls_past_the_call_budget_raise():
+    marketo, pool = make_wrapper(lambda method, path, body: {"success": True, "result": []}, call_budget=2)
+    marketo.get_lead_by_id(1)
+    marketo.get_lead_by_id(2)
+    with pytest.raises(QuotaExceededError):
+        marketo.get_lead_by_id(3)
+    assert len(pool.calls) == 2
+
+############################################################################################
+#                                                                                          #
+#                                  Access Tokens                                           #
+#                                                                                          #
+############################################################################################
+
+class FakeTimer:
+    """
+    This class stands in for threading.Timer. Timers are only recorded, so a test can see
+    when the next refresh is due and run it by hand.
+    """
+
+    scheduled = []
+
+    def __init__(self, delay, function):
+        self.delay = delay
+        self.function = function
+        self.cancelled = False
+        FakeTimer.scheduled.append(self)
+
+    def start(self):
+        pass
+
+    def cancel(self):
+        self.cancelled = True
+
+def counting_fetch(lifetime=3600):
+    """
+    This method makes a fetch_token function that hands out a new token each time, and
+    fails while the "fail" flag of the returned state is set.
+    """
+    state = {"calls": 0, "fail": False}
+
+    def fetch():
+        state["calls"] += 1
+        if state["fail"]:
+            raise Exception("Identity is down")
+        # Give concurrent callers time to pile up behind the first one.
+        time.sleep(0.05)
+        return "token"+str(state["calls"]), lifetime
+    return fetch, state
+
+def test_concurrent_callers_share_one_identity_call():
+    fetch, state = counting_fetch()
+    manager = AccessTokenManager(fetch)
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(manager.get_token())) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    manager.close()
+    assert state["calls"] == 1
+    assert tokens == ["token1"]*20
+
+def test_an_invalidated_token_is_replaced():
+    fetch, state = counting_fetch()
+    manager = AccessTokenManager(fetch)
+    assert manager.get_token() == "token1"
+    # A token that has already been replaced is ignored.
+    manager.invalidate("token0")
+    assert manager.get_token() == "token1"
+    manager.invalidate("token1")
+    assert manager.get_token() == "token2"
+    manager.close()
+    assert state["calls"] == 2
+
+def test_a_failed_background_refresh_is_not_retried_within_the_minimum_interval(monkeypatch):
+    monkeypatch.setattr(threading, "Timer", FakeTimer)
+    monkeypatch.setattr(FakeTimer, "scheduled", [])
+    fetch, state = counting_fetch(lifetime=2)
+    manager = AccessTokenManager(fetch, refresh_margin=60)
+    assert manager.get_token() == "token1"
+    # The token is already inside the margin, but the refresh still waits the minimum interval.
+    assert FakeTimer.scheduled[-1].delay == MIN_TOKEN_REFRESH_INTERVAL
+    state["fail"] = True
+    FakeTimer.scheduled[-1].function()
+    assert FakeTimer.scheduled[-1].delay >= MIN_TOKEN_REFRESH_INTERVAL
+    # Callers keep the current token instead of trying again themselves.
+    assert manager.get_token() == "token1"
+    assert state["calls"] == 2
+
+############################################################################################
+#                                                                                          #
+#                                     Retries                                              #
+#                                                                                          #
+############################################################################################
+
+def failing(*responses):
+    """
+    This method makes a handler that answers with each of the given responses in turn, and
+    with a successful one once they run out.
+    """
+    responses = list(responses)
+
+    def handler(method, path, body):
+        return responses.pop(0) if responses else {"success": True, "result": [{"id": 1}]}
+    return handler
+
+def error(code):
+    return {"success": False, "errors": [{"code": code, "message": "Error "+code}]}
+
+@pytest.mark.parametrize("code", ["601", "602"])
+def test_a_rejected_token_is_replaced_and_the_call_is_retried_once(code):
+    marketo, pool = make_wrapper(failing(error(code)))
+    assert marketo.get_lead_by_id(1)["success"]
+    assert pool.tokens == 2
+    assert pool.authorizations == ["Bearer token1", "Bearer token2"]
+
+@pytest.mark.parametrize("code", ["606", "615"])
+def test_a_throttled_call_backs_off_with_full_jitter_and_then_succeeds(monkeypatch, code):
+    sleeps, jitter = [], []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+
+    def uniform(low, high):
+        jitter.append((low, high))
+        return high/2
+    monkeypatch.setattr(marketo_wrapper.random, "uniform", uniform)
+    marketo, pool = make_wrapper(failing(error(code), error(code)),
+                                 retry_policy=marketo_wrapper.RetryPolicy(base_delay=1, max_delay=30))
+    # Writes are retried too, since Marketo never processes a throttled call.
+    assert marketo.create_update_leads([{"email": "a"}])["success"]
+    assert len(pool.calls) == 3
+    assert jitter == [(0, 1), (0, 2)]
+    # The rate limiter also sleeps, for no time at all, before each call.
+    assert [seconds for seconds in sleeps if seconds] == [0.5, 1]
+
+@pytest.mark.parametrize("code", ["604", "608", "611", "713"])
+def test_a_transient_error_is_only_retried_when_the_call_is_idempotent(monkeypatch, code):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    marketo, pool = make_wrapper(failing(error(code)))
+    assert marketo.get_lead_by_id(1)["success"]
+    assert pool.calls == [("GET", "rest/v1/lead/1.json")]*2
+
+    marketo, pool = make_wrapper(failing(error(code)))
+    response = marketo.create_update_leads([{"email": "a"}])
+    assert response["errors"][0]["code"] == code
+    assert len(pool.calls) == 1
+
+def test_retries_stop_after_the_last_attempt(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    marketo, pool = make_wrapper(lambda method, path, body: error("606"),
+                                 retry_policy=marketo_wrapper.RetryPolicy(max_attempts=3))
+    assert marketo.get_lead_by_id(1)["errors"][0]["code"] == "606"
+    assert len(pool.calls) == 3
+
+############################################################################################
+#                                                                                          #
+#                                  Response Cache                                          #
+#                                                                                          #
+############################################################################################
+
+def test_response_cache_round_trips_through_disk(tmp_path):
+    ResponseCache(directory=str(tmp_path)).set("abc:describe_lead:client:call", {"success": True}, 60)
+    assert ResponseCache(directory=str(tmp_path)).get("abc:describe_lead:client:call") == {"success": True}
+    assert [path.suffix for path in tmp_path.iterdir()] == [".json"]
+
+def test_response_cache_invalidates_by_prefix(tmp_path):
+    cache = ResponseCache(directory=str(tmp_path))
+    cache.set("abc:describe_lead:client:call", {"success": True}, 60)
+    cache.set("abc:describe_company:client:call", {"success": True}, 60)
+    cache.invalidate("abc:describe_lead:")
+    assert ResponseCache(directory=str(tmp_path)).get("abc:describe_lead:client:call") is None
+    assert ResponseCache(directory=str(tmp_path)).get("abc:describe_company:client:call") is not None
+
+def test_response_cache_is_kept_apart_for_each_api_user():
+    cache = ResponseCache()
+    first, first_pool = make_wrapper(lambda method, path, body: {"success": True, "result": ["first"]},
+                                     "first", response_cache=cache)
+    second, second_pool = make_wrapper(lambda method, path, body: {"success": True, "result": ["second"]},
+                                       "second", response_cache=cache)
+    assert first.describe_lead()["result"] == ["first"]
+    assert second.describe_lead()["result"] == ["second"]
+    assert first.describe_lead()["result"] == ["first"]
+    assert len(first_pool.calls) == 1 and len(second_pool.calls) == 1
+
+############################################################################################
+#                                                                                          #
+#                                Request Coalescing                                        #
+#                                                                                          #
+############################################################################################
+
+def test_single_flight_shares_one_call_and_hands_out_copies():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return {"result": [1]}
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("key", work)))
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=lambda: results.append(flight.do("key", work)))
+    follower.start()
+    # Give the follower time to join the work in flight before it finishes.
+    time.sleep(0.1)
+    release.set()
+    leader.join()
+    follower.join()
+    assert len(calls) == 1
+    assert results[0] == results[1] and results[0] is not results[1]
+    results[0]["result"].append(2)
+    assert results[1]["result"] == [1]
+
+############################################################################################
+#                                                                                          #
+#                                   Paged Readers                                          #
+#                                                                                          #
+############################################################################################
+
+def paged_leads(pages):
+    """
+    This method makes a handler that pages through the given number of pages of two leads
+    each, following nextPageToken.
+    """
+    def handler(method, path, body):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+        page = int(query.get("nextPageToken", ["0"])[0])
+        response = {"success": True, "result": [{"id": 2*page}, {"id": 2*page+1}]}
+        if page+1 < pages:
+            response["nextPageToken"] = str(page+1)
+        return response
+    return handler
+
+def test_prefetch_goes_through_fan_in(monkeypatch):
+    fan_in = MarketoWrapper._MarketoWrapper__fan_in
+    used = []
+
+    def spy(self, sources, workers, buffer):
+        used.append((workers, buffer))
+        return fan_in(self, sources, workers, buffer)
+    monkeypatch.setattr(MarketoWrapper, "_MarketoWrapper__fan_in", spy)
+    marketo, _ = make_wrapper(paged_leads(3))
+    leads = list(marketo.iter_multiple_leads_by_list_id(1, prefetch=2))
+    assert [lead["id"] for lead in leads] == list(range(6))
+    assert used == [(1, 2)]
+
+def test_offset_crawl_stops_shortly_after_the_last_page():
+    def handler(method, path, body):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+        offset, page_size = int(query["offset"][0]), int(query["maxReturn"][0])
+        emails = [{"id": index} for index in range(offset, min(offset+page_size, 450))]
+        return {"success": True, "result": emails} if emails else {"success": True}
+    marketo, pool = make_wrapper(handler)
+    emails = list(marketo.iter_emails())
+    assert [email["id"] for email in emails] == list(range(450))
+    # Three pages are needed. By the time the third one comes back short, the crawl has ramped
+    # up to four pages in flight, so at most three past the end are requested.
+    assert len(pool.calls) <= 6
+
+def test_paging_stops_when_more_result_is_false_even_with_a_next_page_token():
+    def handler(method, path, body):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+        page = int(query["nextPageToken"][0])
+        response = {"success": True, "result": [{"leadId": page}], "moreResult": page < 2}
+        # Marketo hands out a nextPageToken on the last page too, to resume from later. The
+        # fake runs out a few pages on, so a reader that ignores moreResult still ends.
+        if page < 5:
+            response["nextPageToken"] = str(page+1)
+        return response
+    marketo, pool = make_wrapper(handler)
+    leads = list(marketo.iter_deleted_leads("0"))
+    assert [lead["leadId"] for lead in leads] == [0, 1, 2]
+    assert len(pool.calls) == 3
+
+############################################################################################
+#                                                                                          #
+#                                      Exports                                             #
+#                                                                                          #
+############################################################################################
+
+def hourly_activities(hours):
+    """
+    This method makes a handler that serves one activity an hour from the start of
+    2016-01-01, four to a page. A paging token is the index of the first activity at or
+    after its date.
+    """
+    start = datetime.datetime(2016, 1, 1)
+    dates = [(start + datetime.timedelta(hours=hour)).strftime("%Y-%m-%dT%H:%M:%SZ") for hour in range(hours)]
+
+    def handler(method, path, body):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+        if path.startswith("rest/v1/activities/pagingtoken.json"):
+            since = query["sinceDatetime"][0]
+            return {"success": True, "nextPageToken": str(sum(date < since for date in dates))}
+        first = int(query["nextPageToken"][0])
+        result = [{"id": index, "activityDate": dates[index]} for index in range(first, min(first+4, hours))]
+        return {"success": True, "result": result, "nextPageToken": str(first+4), "moreResult": first+4 < hours}
+    return handler
+
+def test_export_splits_the_range_into_shards_with_a_token_each():
+    marketo, pool = make_wrapper(hourly_activities(30))
+    activities = list(marketo.export_lead_activities([1], datetime.datetime(2016, 1, 1),
+                                                     datetime.datetime(2016, 1, 2), shards=4, workers=2))
+    # The activity at the end of the range, and those after it, are left out.
+    assert sorted(activity["id"] for activity in activities) == list(range(24))
+    tokens = [path for _, path in pool.calls if path.startswith("rest/v1/activities/pagingtoken.json")]
+    assert sorted(tokens) == ["rest/v1/activities/pagingtoken.json?sinceDatetime=2016-01-01T"+hour+":00:00Z"
+                              for hour in ("00", "06", "12", "18")]
+    # Each shard stops at the first page that runs past its end, which is its second page.
+    assert len(pool.calls) == 4 + 4*2
+
+def test_export_by_shard_tags_each_activity_with_its_shard_in_order():
+    marketo, pool = make_wrapper(hourly_activities(30))
+    activities = list(marketo.export_lead_activities([1], datetime.datetime(2016, 1, 1),
+                                                     datetime.datetime(2016, 1, 2), shards=4, by_shard=True))
+    for shard in range(4):
+        assert [activity["id"] for index, activity in activities if index == shard] == \
+            list(range(6*shard, 6*shard+6))
+
+############################################################################################
+#                                                                                          #
+#                                    File Stores                                           #
+#                                                                                          #
+############################################################################################
+
+def test_token_store_only_generates_a_token_once_it_has_expired(tmp_path):
+    store = FileTokenStore(str(tmp_path / "tokens.json"))
+    generated = []
+
+    def generate():
+        generated.append(1)
+        return "token"+str(len(generated)), 3600
+    assert store.fetch("key", generate)[0] == "token1"
+    assert FileTokenStore(str(tmp_path / "tokens.json")).fetch("key", generate)[0] == "token1"
+    store.invalidate("key", "token1")
+    assert store.fetch("key", generate)[0] == "token2"
+    assert os.stat(str(tmp_path / "tokens.json")).st_mode & 0o777 == 0o600
+
+def test_checkpoint_store_saves_loads_and_clears(tmp_path):
+    store = FileCheckpointStore(str(tmp_path / "checkpoints.json"))
+    assert store.load("job") is None
+    store.save("job", "token", 300)
+    assert FileCheckpointStore(str(tmp_path / "checkpoints.json")).load("job") == \
+        {"nextPageToken": "token", "count": 300}
+    store.clear("job")
+    assert store.load("job") is None
+
+############################################################################################
+#                                                                                          #
+#                                     Batching                                             #
+#                                                                                          #
+############################################################################################
+
+def test_batches_are_split_at_300_records():
+    batches = list(batch_records({"id": index} for index in range(601)))
+    assert [len(batch) for batch in batches] == [300, 300, 1]
+    assert [record["id"] for batch in batches for record in batch] == list(range(601))
+
+def test_batches_are_split_before_the_1_mb_limit():
+    # Each record takes up about 10 KB, so a full batch of 300 would be about 3 MB.
+    records = [{"id": index, "notes": "x"*10000} for index in range(300)]
+    batches = list(batch_records(records))
+    assert len(batches) > 1
+    for batch in batches:
+        assert len(json.dumps({"input": batch})) <= MAX_BATCH_BYTES + 20
+        assert len(json.dumps({"input": batch, "action": "createOrUpdate", "lookupField": "email"})) < 1000000
+    assert sum(len(batch) for batch in batches) == 300
+    # Each batch is filled as far as the limit allows.
+    assert len(json.dumps(batches[0] + batches[1][:1])) > MAX_BATCH_BYTES
+
+def test_a_record_over_the_byte_limit_is_sent_on_its_own():
+    batches = list(batch_records([{"id": 1}, {"id": 2, "notes": "x"*200}, {"id": 3}], max_bytes=100))
+    assert [[record["id"] for record in batch] for batch in batches] == [[1], [2], [3]]
+
+def test_coalesce_merges_records_with_the_same_key_and_later_fields_win():
+    records = [{"email": "a", "x": 1, "y": 1}, {"email": "b", "x": 2}, {"email": "a", "x": 3}, {"x": 4}, {"x": 5}]
+    [(batch, originals)] = list(coalesce_records(records, field_key("email")))
+    assert batch == [{"email": "a", "x": 3, "y": 1}, {"email": "b", "x": 2}, {"x": 4}, {"x": 5}]
+    assert [index for _, index in originals] == [0, 1, 0, 2, 3]
+    assert records[0] == {"email": "a", "x": 1, "y": 1}
+
+def test_coalesce_starts_a_new_batch_once_the_window_is_full():
+    records = [{"email": "a", "x": index} for index in range(5)]
+    batches = list(coalesce_records(records, field_key("email"), window=2))
+    assert [batch for batch, _ in batches] == [[{"email": "a", "x": 1}], [{"email": "a", "x": 3}], [{"email": "a", "x": 4}]]
+
+def test_field_key_uses_every_field_and_skips_records_missing_one():
+    key = field_key(["a", "b"])
+    assert key({"a": 1, "b": 2}) == (1, 2)
+    assert key({"a": 1}) is None
+
+def test_rate_limiter_books_calls_past_a_full_window():
+    limiter = RateLimiter(max_calls=3, period=20)
+    delays = [limiter.reserve() for _ in range(7)]
+    assert delays[:3] == [0, 0, 0]
+    assert all(19 < delay <= 20 for delay in delays[3:6])
+    assert 39 < delays[6] <= 40
+
+############################################################################################
+#                                                                                          #
+#                                    Bulk Writes                                           #
+#                                                                                          #
+############################################################################################
+
+def echo_leads(status=lambda lead: "updated"):
+    """
+    This method makes a handler that answers create_update_leads() with one result for
+    each lead it was sent, in order, carrying the lead's fields so tests can tell them apart.
+    """
+    def handler(method, path, body):
+        leads = json.loads(body)["input"]
+        results = []
+        for lead in leads:
+            result = dict(lead, status=status(lead))
+            if result["status"] == "skipped":
+                result["reasons"] = [{"code": "1004", "message": "Lead not found"}]
+            results.append(result)
+        return {"success": True, "result": results}
+    return handler
+
+def test_bulk_write_pairs_each_record_with_its_own_result():
+    marketo, pool = make_wrapper(echo_leads(lambda lead: "skipped" if lead["id"] % 7 == 0 else "updated"))
+    leads = [{"email": str(index), "id": index} for index in range(650)]
+    results = list(marketo.bulk_create_update_leads(leads, workers=3))
+    assert len(pool.calls) == 3
+    assert [lead["id"] for lead, _ in results] == list(range(650))
+    for lead, result in results:
+        assert result["id"] == lead["id"]
+        assert result["status"] == ("skipped" if lead["id"] % 7 == 0 else "updated")
+
+def test_bulk_write_gives_merged_records_the_result_of_the_merged_record():
+    marketo, pool = make_wrapper(echo_leads())
+    leads = [{"email": "a", "x": 1}, {"email": "b", "x": 2}, {"email": "a", "x": 3}]
+    results = list(marketo.bulk_create_update_leads(leads))
+    assert len(pool.calls) == 1
+    assert [(lead["x"], result["x"]) for lead, result in results] == [(1, 3), (2, 2), (3, 3)]
+
+############################################################################################
+#                                                                                          #
+#                                   Bulk Import                                            #
+#                                                                                          #
+############################################################################################
+
+def test_import_file_is_split_at_line_boundaries_with_room_for_the_header(tmp_path):
+    path = tmp_path / "leads.csv"
+    path.write_bytes(b"email,name\n" + b"".join(b"lead%d@example.com,Lead %d\n" % (index, index) for index in range(100)))
+    header, pieces = split_import_file(str(path), max_bytes=200)
+    assert header == b"email,name\n"
+    contents = path.read_bytes()
+    assert pieces[0][0] == len(header) and pieces[-1][1] == len(contents)
+    for (start, end), (next_start, _) in zip(pieces, pieces[1:]):
+        assert end == next_start
+    for start, end in pieces:
+        assert len(header) + end - start <= 200
+        assert contents[start:end].endswith(b"\n")
+
+def test_import_file_is_never_split_inside_a_quoted_field(tmp_path):
+    path = tmp_path / "leads.csv"
+    rows = [["lead%d@example.com" % index, "Line one\nLine \"two\"\r\nLine three"] for index in range(50)]
+    with open(str(path), "w", newline="") as import_file:
+        writer = csv.writer(import_file)
+        writer.writerow(["email", "notes"])
+        writer.writerows(rows)
+    header, pieces = split_import_file(str(path), max_bytes=300)
+    contents = path.read_bytes()
+    assert len(pieces) > 1
+    parsed = []
+    for start, end in pieces:
+        piece = (header + contents[start:end]).decode("utf-8")
+        parsed += list(csv.reader(io.StringIO(piece, newline="")))[1:]
+    assert parsed == rows
+
+def test_bulk_import_reports_every_piece_when_one_fails(monkeypatch, tmp_path):
+    split = marketo_wrapper.split_import_file
+    monkeypatch.setattr(marketo_wrapper, "split_import_file", lambda path: split(path, max_bytes=40))
+    path = tmp_path / "leads.tsv"
+    path.write_bytes(b"email\n" + b"".join(b"lead%d@example.com\n" % index for index in range(4)))
+
+    def handler(method, path, body):
+        if path == "bulk/v1/leads.json":
+            if b"lead0@example.com" in body.read():
+                return {"success": True, "result": [{"batchId": 1}]}
+            return {"success": False, "errors": [{"code": "1016", "message": "Too many imports"}]}
+        if path == "bulk/v1/leads/batch/1.json":
+            return {"success": True, "result": [{"batchId": 1, "status": "Complete", "numOfRowsFailed": 1}]}
+        return FakeResponse(b"email\tImport Failure Reason\n", content_type="text/plain")
+    marketo, _ = make_wrapper(handler)
+    statuses = marketo.bulk_import_leads("tsv", str(path), download_dir=str(tmp_path))
+    # Each piece holds one lead, and only the first one is imported.
+    assert len(statuses) == 4
+    assert statuses[0]["status"] == "Complete"
+    assert all(isinstance(status, Exception) and "1016" in str(status) for status in statuses[1:])
+    assert (tmp_path / "1_failures.tsv").exists()
+
+def test_multipart_file_streams_part_of_a_file_and_can_be_rewound(tmp_path):
+    path = tmp_path / "leads.csv"
+    path.write_bytes(b"email\na@example.com\nb@example.com\nc@example.com\n")
+    body = MultipartFile([("format", "csv")], str(path), 20, 34, b"email\n")
+    try:
+        data = b""
+        while True:
+            block = body.read(7)
+            if not block:
+                break
+            data += block
+        assert len(data) == body.length
+        assert b"name=\"format\"\r\n\r\ncsv\r\n" in data
+        assert b"\r\n\r\nemail\nb@example.com\n\r\n--" in data
+        assert b"a@example.com" not in data and b"c@example.com" not in data
+        assert data.endswith(b"--\r\n")
+        assert body.content_type.endswith(data.split(b"\r\n")[0][2:].decode("utf-8"))
+        body.seek(0)
+        assert body.read() == data
+    finally:
+        body.close()
+
+def test_a_batch_that_never_reached_the_server_is_retried_without_losing_the_others(monkeypatch, tmp_path):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    handle = echo_leads()
+    failures = []
+
+    def handler(method, path, body):
+        leads = json.loads(body)["input"]
+        if leads[0]["id"] == 300 and not failures:
+            failures.append(1)
+            raise RequestNotSentError("Connection refused")
+        return handle(method, path, body)
+    marketo, pool = make_wrapper(handler)
+    leads = [{"email": str(index), "id": index} for index in range(650)]
+    results = list(marketo.bulk_create_update_leads(leads, workers=3, dead_letter=str(tmp_path / "dead.ndjson")))
+    assert len(pool.calls) == 4
+    assert sorted(lead["id"] for lead, _ in results) == list(range(650))
+    assert all(result["status"] == "updated" for _, result in results)
+    assert not (tmp_path / "dead.ndjson").exists()
+
+def test_a_batch_that_failed_after_it_was_sent_is_not_retried(monkeypatch, tmp_path):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    marketo, pool = make_wrapper(lambda method, path, body: FakeResponse(b"Gateway Timeout", 504, "text/html"))
+    dead_letter = tmp_path / "dead.ndjson"
+    results = list(marketo.bulk_add_lead_activities([{"leadId": 1}, {"leadId": 2}], dead_letter=str(dead_letter)))
+    assert len(pool.calls) == 1
+    assert [result["reasons"][0]["code"] for _, result in results] == ["send_failed", "send_failed"]
+    assert len(dead_letter.read_text().splitlines()) == 2
+
+def test_a_write_that_is_not_idempotent_is_not_retried_even_if_it_never_reached_the_server(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+
+    def handler(method, path, body):
+        raise RequestNotSentError("Connection refused")
+    marketo, pool = make_wrapper(handler)
+    results = list(marketo.bulk_create_update_leads([{"email": "a"}], action="createDuplicate"))
+    assert len(pool.calls) == 1
+    assert results[0][1]["reasons"][0]["code"] == "send_failed"
+
+def test_records_of_a_batch_that_never_sends_go_to_the_dead_letter_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    marketo, _ = make_wrapper(lambda method, path, body: FakeResponse(b"Unavailable", 503, "text/html"))
+    dead_letter = tmp_path / "dead.ndjson"
+    results = list(marketo.bulk_create_update_leads([{"email": "a"}, {"email": "b"}], dead_letter=str(dead_letter)))
+    assert [result["reasons"][0]["code"] for _, result in results] == ["send_failed", "send_failed"]
+    assert results[0][1] is not results[1][1]
+    assert [json.loads(line)["record"] for line in dead_letter.read_text().splitlines()] == \
+        [{"email": "a"}, {"email": "b"}]
+
+def test_results_of_resent_records_are_yielded_in_input_order(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    busy = [1, 3]
+
+    def status(lead):
+        if lead["id"] in busy:
+            busy.remove(lead["id"])
+            return "skipped"
+        return "updated"
+
+    def handler(method, path, body):
+        response = echo_leads(status)(method, path, body)
+        for result in response["result"]:
+            if result["status"] == "skipped":
+                result["reasons"] = [{"code": "1029", "message": "Too many jobs in queue"}]
+        return response
+    marketo, pool = make_wrapper(handler)
+    leads = [{"email": str(index), "id": index} for index in range(5)]
+    results = list(marketo.bulk_create_update_leads(leads))
+    assert len(pool.calls) == 2
+    assert [lead["id"] for lead, _ in results] == list(range(5))
+    assert [result["id"] for _, result in results] == list(range(5))
+    assert all(result["status"] == "updated" for _, result in results)
+
+def test_records_missing_from_the_results_are_reported_as_skipped():
+    def handler(method, path, body):
+        response = echo_leads()(method, path, body)
+        response["result"] = response["result"][:-1]
+        return response
+    marketo, _ = make_wrapper(handler)
+    results = list(marketo.bulk_create_update_leads([{"email": "a"}, {"email": "b"}]))
+    assert [result["status"] for _, result in results] == ["updated", "skipped"]
+    assert results[1][1]["reasons"][0]["code"] == "missing_result"
+
+def test_write_buffer_resolves_every_future_when_results_are_missing():
+    def handler(method, path, body):
+        return {"success": True, "result": []}
+    marketo, _ = make_wrapper(handler)
+    with LeadWriteBuffer(marketo, linger=0.01) as buffer:
+        futures = [buffer.submit({"email": str(index)}) for index in range(3)]
+    assert [future.result(timeout=5)["status"] for future in futures] == ["skipped"]*3
+
+def test_batches_that_share_a_key_land_in_order():
+    landed = {}
+    lock = threading.Lock()
+
+    def handler(method, path, body):
+        leads = json.loads(body)["input"]
+        # The first batch is slow, so without ordering the second one would land first.
+        if any(lead.get("x") == "old" for lead in leads):
+            time.sleep(0.2)
+        with lock:
+            for lead in leads:
+                landed[lead["email"]] = lead.get("x")
+        return echo_leads()(method, path, body)
+    marketo, pool = make_wrapper(handler)
+    # The first batch is full by the time the second "a" comes along, so it cannot be merged.
+    leads = [{"email": "a", "x": "old"}] + [{"email": str(index)} for index in range(300)] + [{"email": "a", "x": "new"}]
+    results = list(marketo.bulk_create_update_leads(leads, workers=2))
+    assert len(pool.calls) == 2
+    assert landed["a"] == "new"
+    assert len(results) == 302
+
+def test_a_resent_record_never_overwrites_a_later_one_with_the_same_key(monkeypatch, tmp_path):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    landed = {}
+    skipped = []
+    lock = threading.Lock()
+
+    def handler(method, path, body):
+        response = echo_leads()(method, path, body)
+        with lock:
+            for result in response["result"]:
+                if result.get("x") == "old" and not skipped:
+                    skipped.append(1)
+                    result["status"] = "skipped"
+                    result["reasons"] = [{"code": "1029", "message": "Too many jobs in queue"}]
+                else:
+                    landed[result["email"]] = result.get("x")
+        return response
+    marketo, pool = make_wrapper(handler)
+    # The old "a" is skipped in the first batch, and the new one is written in the second.
+    leads = [{"email": "a", "x": "old"}] + [{"email": str(index)} for index in range(300)] + [{"email": "a", "x": "new"}]
+    dead_letter = tmp_path / "dead.ndjson"
+    results = list(marketo.bulk_create_update_leads(leads, workers=2, dead_letter=str(dead_letter)))
+    assert len(pool.calls) == 2
+    assert landed["a"] == "new"
+    assert results[0][1]["reasons"][0]["code"] == "superseded"
+    assert results[-1][1]["status"] == "updated"
+    assert not dead_letter.exists()
+
+def test_unchanged_leads_are_not_sent_again(tmp_path):
+    marketo, pool = make_wrapper(echo_leads())
+    with FingerprintStore(str(tmp_path / "fingerprints")) as fingerprints:
+        leads = [{"email": "a", "x": 1}, {"email": "b", "x": 2}]
+        assert len(list(marketo.bulk_create_update_leads(leads, fingerprints=fingerprints))) == 2
+        assert list(marketo.bulk_create_update_leads(leads, fingerprints=fingerprints)) == []
+        assert len(pool.calls) == 1
+
+def test_a_changed_field_is_sent_again(tmp_path):
+    marketo, pool = make_wrapper(echo_leads())
+    with FingerprintStore(str(tmp_path / "fingerprints")) as fingerprints:
+        list(marketo.bulk_create_update_leads([{"email": "a", "x": 1}, {"email": "b", "x": 2}],
+                                              fingerprints=fingerprints))
+        results = list(marketo.bulk_create_update_leads([{"email": "a", "x": 1}, {"email": "b", "x": 3}],
+                                                        fingerprints=fingerprints))
+        assert [lead for lead, _ in results] == [{"email": "b", "x": 3}]
+
+def test_a_fingerprint_is_only_stored_once_the_server_confirms_the_lead(tmp_path):
+    marketo, pool = make_wrapper(echo_leads(lambda lead: "skipped" if lead["email"] == "b" else "created"))
+    with FingerprintStore(str(tmp_path / "fingerprints")) as fingerprints:
+        leads = [{"email": "a"}, {"email": "b"}]
+        list(marketo.bulk_create_update_leads(leads, fingerprints=fingerprints))
+        assert fingerprints.unchanged("email", leads[0], ("createOrUpdate", None))
+        assert not fingerprints.unchanged("email", leads[1], ("createOrUpdate", None))
+        results = list(marketo.bulk_create_update_leads(leads, fingerprints=fingerprints))
+        assert [lead for lead, _ in results] == [{"email": "b"}]
+
+def test_a_lead_sent_with_another_action_or_partition_is_not_unchanged(tmp_path):
+    marketo, pool = make_wrapper(echo_leads())
+    with FingerprintStore(str(tmp_path / "fingerprints")) as fingerprints:
+        leads = [{"email": "a"}]
+        list(marketo.bulk_create_update_leads(leads, fingerprints=fingerprints))
+        assert len(list(marketo.bulk_create_update_leads(leads, "updateOnly", fingerprints=fingerprints))) == 1
+        assert len(list(marketo.bulk_create_update_leads(leads, partition="Other", fingerprints=fingerprints))) == 1
+        # Leaving the action out is the same as createOrUpdate.
+        assert list(marketo.bulk_create_update_leads(leads, "createOrUpdate", fingerprints=fingerprints)) == []
+        assert len(pool.calls) == 3
+
+def test_custom_objects_coalesce_on_their_dedupe_fields_by_default():
+    def handler(method, path, body):
+        if path.endswith("describe.json"):
+            return {"success": True, "result": [{"name": "car", "idField": "marketoGUID",
+                                                 "dedupeFields": ["vin"]}]}
+        objects = json.loads(body)["input"]
+        return {"success": True, "result": [{"seq": index, "status": "updated"} for index in range(len(objects))]}
+    marketo, pool = make_wrapper(handler)
+    cars = [{"vin": "1", "color": "red"}, {"vin": "2"}, {"vin": "1", "color": "blue"}]
+    results = list(marketo.bulk_create_update_custom_objects("car", cars))
+    assert [result["seq"] for _, result in results] == [0, 1, 0]
+    assert len(pool.calls) == 2
+
+class FakeConnection:
+    """
+    This class stands in for an http.client.HTTPSConnection. A stale connection reads the
+    body and then fails, as if the server had closed it while it sat idle.
+    """
+
+    opened = []
+
+    def __init__(self, host, timeout=None):
+        self.stale = False
+        self.sent = []
+        FakeConnection.opened.append(self)
+
+    def request(self, method, path, body=None, headers=None):
+        data = body.read() if hasattr(body, "read") else body
+        if self.stale:
+            raise http.client.RemoteDisconnected("Remote end closed connection without response")
+        self.sent.append(data)
+
+    def getresponse(self):
+        return FakeResponse({"success": True})
+
+    def close(self):
+        pass
+
+def test_a_rewindable_body_is_sent_again_after_a_stale_connection(monkeypatch, tmp_path):
+    monkeypatch.setattr(http.client, "HTTPSConnection", FakeConnection)
+    monkeypatch.setattr(FakeConnection, "opened", [])
+    path = tmp_path / "leads.csv"
+    path.write_bytes(b"email\na@example.com\n")
+    pool = HttpConnectionPool()
+    pool.request("https://example.com/identity")
+    FakeConnection.opened[0].stale = True
+    body = MultipartFile([("format", "csv")], str(path))
+    try:
+        response, _ = pool.request("https://example.com/bulk/v1/leads.json", "POST", body)
+        body.seek(0)
+        assert response.status == 200
+        assert len(FakeConnection.opened) == 2
+        assert FakeConnection.opened[1].sent == [body.read()]
+    finally:
+        body.close()
+
+def test_a_request_that_could_not_be_written_is_reported_as_not_sent(monkeypatch):
+    def refuse(self, method, path, body=None, headers=None):
+        raise ConnectionRefusedError("Connection refused")
+    monkeypatch.setattr(http.client, "HTTPSConnection", FakeConnection)
+    monkeypatch.setattr(FakeConnection, "request", refuse)
+    with pytest.raises(RequestNotSentError):
+        HttpConnectionPool().request("https://example.com/rest/v1/leads.json", "POST", b"{}")
+
+def test_failure_file_download_retries_json_errors_instead_of_saving_them(monkeypatch, tmp_path):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    responses = [{"success": False, "errors": [{"code": "601", "message": "Access token invalid"}]},
+                 {"success": False, "errors": [{"code": "606", "message": "Max rate limit exceeded"}]},
+                 FakeResponse(b"email,Import Failure Reason\na,Bad email\n", content_type="text/csv")]
+    marketo, pool = make_wrapper(lambda method, path, body: responses.pop(0))
+    path = tmp_path / "failures.csv"
+    assert marketo.get_import_failure_file(1, str(path)) == path.stat().st_size
+    assert path.read_bytes() == b"email,Import Failure Reason\na,Bad email\n"
+    assert len(pool.calls) == 3
+
+def test_failure_file_download_raises_on_errors_that_cannot_be_retried(tmp_path):
+    error = {"success": False, "errors": [{"code": "1003", "message": "Batch not found"}]}
+    marketo, _ = make_wrapper(lambda method, path, body: error)
+    with pytest.raises(Exception, match="1003"):
+        marketo.get_import_failure_file(1, str(tmp_path / "failures.csv"))
+    assert not (tmp_path / "failures.csv").exists()
+
+def test_failure_file_is_returned_when_no_path_is_given():
+    marketo, _ = make_wrapper(lambda method, path, body: FakeResponse(b"email\na\n", content_type="text/csv"))
+    assert marketo.get_import_failure_file(1) == b"email\na\n"
+    assert marketo.get_import_warning_file(1) == b"email\na\n"
+
+def test_multipart_file_can_be_read_again_after_it_is_closed(tmp_path):
+    path = tmp_path / "leads.csv"
+    path.write_bytes(b"email\na@example.com\n")
+    body = MultipartFile([], str(path))
+    data = body.read()
+    body.close()
+    body.seek(0)
+    assert body.read() == data
+    body.close()